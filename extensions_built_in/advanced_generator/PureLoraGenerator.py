@@ -94,7 +94,11 @@ class PureLoraGenerator(BaseExtensionProcess):
                 ))
 
             # send to be generated
-            self.sd.generate_images(gen_img_config_list, sampler=sample_config.sampler)
+            self.sd.generate_images(
+                gen_img_config_list,
+                sampler=sample_config.sampler,
+                max_batch_size=sample_config.batch_size,
+            )
             print("Done generating images")
             # cleanup
             del self.sd
@@ -59,6 +59,9 @@ class SDTrainer(BaseSDTrainProcess):
         self.batch_negative_prompt: Union[List[str], None] = None
 
         self.scaler = torch.cuda.amp.GradScaler()
+        # bool tensor set when the loss of the current micro batch was nan, like the scaler's found_inf. Kept on
+        # the device so checking for nan never syncs
+        self.found_nan_loss: Optional[torch.Tensor] = None
 
         self.is_bfloat = self.train_config.dtype == "bfloat16" or self.train_config.dtype == "bf16"
 
@@ -165,8 +168,15 @@ class SDTrainer(BaseSDTrainProcess):
                     raise ValueError("Cannot unload text encoder if training text encoder")
                 # cache embeddings
 
+                is_caching_text_embeddings = any(
+                    [dataset.cache_text_embeddings for dataset in (self.datasets or []) + (self.datasets_reg or [])]
+                )
                 print("\n***** UNLOADING TEXT ENCODER *****")
-                print("This will train only with a blank prompt or trigger word, if set")
+                if is_caching_text_embeddings:
+                    print("Datasets with cached text embeddings will train on their cached captions")
+                    print("All other datasets will train only with a blank prompt or trigger word, if set")
+                else:
+                    print("This will train only with a blank prompt or trigger word, if set")
                 print("If this is not what you want, remove the unload_text_encoder flag")
                 print("***********************************")
                 print("")
@@ -1113,6 +1123,17 @@ class SDTrainer(BaseSDTrainProcess):
             prompts_1 = batch.get_caption_short_list()
             prompts_2 = conditioned_prompts
 
+        # use the cached text embeddings from the dataset if they were encoded from the exact same prompts
+        cached_conditional_embeds = None
+        if batch.prompt_embeds is not None and \
+                not grad_on_text_encoder and \
+                not isinstance(self.adapter, CustomAdapter) and \
+                not self.train_config.single_item_batching and \
+                prompts_2 is None and \
+                self.train_config.prompt_dropout_prob == 0.0 and \
+                batch.get_text_embedding_caption_list() == prompts_1:
+            cached_conditional_embeds = batch.prompt_embeds
+
             # make the batch splits
         if self.train_config.single_item_batching:
             if self.model_config.refiner_name_or_path is not None:
@@ -1212,7 +1233,25 @@ class SDTrainer(BaseSDTrainProcess):
 
                 with self.timer('encode_prompt'):
                     unconditional_embeds = None
-                    if self.train_config.unload_text_encoder:
+                    if cached_conditional_embeds is not None:
+                        with torch.set_grad_enabled(False):
+                            conditional_embeds = cached_conditional_embeds.clone().detach().to(
+                                self.device_torch, dtype=dtype
+                            )
+                            if self.train_config.do_cfg:
+                                if self.train_config.unload_text_encoder:
+                                    unconditional_embeds = concat_prompt_embeds(
+                                        [self.cached_blank_embeds] * noisy_latents.shape[0]
+                                    )
+                                else:
+                                    unconditional_embeds = self.sd.encode_prompt(
+                                        self.batch_negative_prompt,
+                                        long_prompts=self.do_long_prompts)
+                                unconditional_embeds = unconditional_embeds.to(
+                                    self.device_torch, dtype=dtype
+                                ).detach()
+
+                    elif self.train_config.unload_text_encoder:
                         with torch.set_grad_enabled(False):
                             embeds_to_use = self.cached_blank_embeds.clone().detach().to(
                                 self.device_torch, dtype=dtype
@@ -1586,10 +1625,11 @@ class SDTrainer(BaseSDTrainProcess):
                             mask_multiplier=mask_multiplier,
                             prior_pred=prior_pred,
                         )
-                # check if nan
-                if torch.isnan(loss):
-                    print("loss is nan")
-                    loss = torch.zeros_like(loss).requires_grad_(True)
+                # check if nan. The gradients it adds are discarded after the backward pass
+                is_nan = torch.isnan(loss).any()
+                self.found_nan_loss = is_nan
+                self.metrics.add('nan_loss', is_nan)
+                loss = torch.where(is_nan, torch.zeros_like(loss), loss)
 
                 with self.timer('backward'):
                     # todo we have multiplier seperated. works for now as res are not in same batch, but need to change
@@ -1611,6 +1651,27 @@ class SDTrainer(BaseSDTrainProcess):
         return loss.detach()
         # flush()
 
+    def clone_grads(self):
+        return {
+            param: param.grad.clone()
+            for group in self.optimizer.param_groups
+            for param in group['params']
+            if param.grad is not None
+        }
+
+    def discard_nan_loss_grads(self, found_nan_loss: torch.Tensor, prior_grads: Optional[dict] = None):
+        # undoes what the last micro batch added to the gradients if its loss was nan. Selected on the device
+        # instead of reading the flag back, so the other micro batches of the step are kept
+        for group in self.optimizer.param_groups:
+            for param in group['params']:
+                if param.grad is None:
+                    continue
+                is_nan = found_nan_loss.to(param.grad.device, non_blocking=True)
+                if prior_grads is not None and param in prior_grads:
+                    param.grad.copy_(torch.where(is_nan, prior_grads[param], param.grad))
+                else:
+                    param.grad.masked_fill_(is_nan, 0.0)
+
     def hook_train_loop(self, batch: Union[DataLoaderBatchDTO, List[DataLoaderBatchDTO]]):
         if isinstance(batch, list):
             batch_list = batch
@@ -1618,8 +1679,14 @@ class SDTrainer(BaseSDTrainProcess):
             batch_list = [batch]
         total_loss = None
         self.optimizer.zero_grad()
-        for batch in batch_list:
+        for i, batch in enumerate(batch_list):
+            self.found_nan_loss = None
+            # later micro batches need the gradients from before their backward pass to undo a nan loss
+            prior_grads = self.clone_grads() if i > 0 else None
             loss = self.train_single_accumulation(batch)
+            if self.found_nan_loss is not None:
+                self.discard_nan_loss_grads(self.found_nan_loss, prior_grads)
+            del prior_grads
             if total_loss is None:
                 total_loss = loss
             else:
@@ -1634,10 +1701,16 @@ class SDTrainer(BaseSDTrainProcess):
                 if self.do_grad_scale:
                     self.scaler.unscale_(self.optimizer)
                 if isinstance(self.params[0], dict):
+                    grad_norms = []
                     for i in range(len(self.params)):
-                        torch.nn.utils.clip_grad_norm_(self.params[i]['params'], self.train_config.max_grad_norm)
+                        grad_norms.append(
+                            torch.nn.utils.clip_grad_norm_(self.params[i]['params'], self.train_config.max_grad_norm)
+                        )
+                    grad_norm = torch.linalg.vector_norm(torch.stack(grad_norms))
                 else:
-                    torch.nn.utils.clip_grad_norm_(self.params, self.train_config.max_grad_norm)
+                    grad_norm = torch.nn.utils.clip_grad_norm_(self.params, self.train_config.max_grad_norm)
+                # stays on the device until the next metrics step
+                self.metrics.add('grad_norm', grad_norm)
             # only step if we are not accumulating
             with self.timer('optimizer_step'):
                 # self.optimizer.step()
@@ -1670,8 +1743,9 @@ class SDTrainer(BaseSDTrainProcess):
                 # Let's make sure we don't update any embedding weights besides the newly added token
                 self.adapter.restore_embeddings()
 
+        # left on the device, the train loop reads it back on metrics steps
         loss_dict = OrderedDict(
-            {'loss': loss.item()}
+            {'loss': loss}
         )
 
         self.end_of_training_loop()
@@ -7,7 +7,7 @@ import shutil
 from collections import OrderedDict
 import os
 import re
-from typing import Union, List, Optional
+from typing import Union, List, Optional, Dict
 
 import numpy as np
 import yaml
@@ -21,10 +21,14 @@ import torch.backends.cuda
 from huggingface_hub import HfApi, Repository, interpreter_login
 from huggingface_hub.utils import HfFolder
 
+from toolkit.async_checkpoint import AsyncCheckpointWriter
+from toolkit.optimizer_checkpoint import get_optimizer_checkpoint, save_optimizer_checkpoint, \
+    load_optimizer_checkpoint, get_optimizer_checkpoint_path, is_optimizer_checkpoint, \
+    get_optimizer_checkpoint_mtime, save_optimizer_state_dict
 from toolkit.basic import value_map
 from toolkit.clip_vision_adapter import ClipVisionAdapter
 from toolkit.custom_adapter import CustomAdapter
-from toolkit.data_loader import get_dataloader_from_datasets, trigger_dataloader_setup_epoch
+from toolkit.data_loader import get_dataloader_from_datasets, trigger_dataloader_setup_epoch, DevicePrefetcher
 from toolkit.data_transfer_object.data_loader import FileItemDTO, DataLoaderBatchDTO
 from toolkit.ema import ExponentialMovingAverage
 from toolkit.embedding import Embedding
@@ -41,6 +45,7 @@ from toolkit.paths import CONFIG_ROOT
 from toolkit.progress_bar import ToolkitProgressBar
 from toolkit.reference_adapter import ReferenceAdapter
 from toolkit.sampler import get_sampler
+from toolkit.samplers.timestep_utils import get_sigmas_for_timesteps
 from toolkit.saving import save_t2i_from_diffusers, load_t2i_model, save_ip_adapter_from_diffusers, \
     load_ip_adapter_model, load_custom_adapter_model
 
@@ -58,8 +63,11 @@ from tqdm import tqdm
 
 from toolkit.config_modules import SaveConfig, LoggingConfig, SampleConfig, NetworkConfig, TrainConfig, ModelConfig, \
     GenerateImageConfig, EmbeddingConfig, DatasetConfig, preprocess_dataset_raw_config, AdapterConfig, GuidanceConfig, validate_configs, \
-    DecoratorConfig
+    DecoratorConfig, ProfilerConfig
 from toolkit.logging import create_logger
+from toolkit.metrics import MetricsAccumulator
+from toolkit.profiler import StepProfiler
+from toolkit.telemetry import TrainingTelemetry
 from diffusers import FluxTransformer2DModel
 
 def flush():
@@ -97,6 +105,9 @@ class BaseSDTrainProcess(BaseTrainProcess):
         self.model_config = ModelConfig(**model_config)
 
         self.save_config = SaveConfig(**self.get_conf('save', {}))
+        self.checkpoint_writer: Union[AsyncCheckpointWriter, None] = None
+        if self.save_config.async_save:
+            self.checkpoint_writer = AsyncCheckpointWriter()
         self.sample_config = SampleConfig(**self.get_conf('sample', {}))
         first_sample_config = self.get_conf('first_sample', None)
         if first_sample_config is not None:
@@ -107,6 +118,15 @@ class BaseSDTrainProcess(BaseTrainProcess):
             self.first_sample_config = self.sample_config
         self.logging_config = LoggingConfig(**self.get_conf('logging', {}))
         self.logger = create_logger(self.logging_config, config)
+        # per step losses, grad norms and lr, read back from the device every logging_config.metrics_every steps
+        self.metrics = MetricsAccumulator()
+        self.profiler_config = ProfilerConfig(**self.get_conf('profiler', {}))
+        if getattr(self.job, 'torch_profiler', False):
+            # job level torch_profiler flag profiles the default window with torch.profiler
+            self.profiler_config.enabled = True
+            self.profiler_config.torch_profiler = True
+        self.profiler = StepProfiler(self.profiler_config, os.path.join(self.save_root, 'profiler'))
+        self.timer.profiler = self.profiler
         self.optimizer: torch.optim.Optimizer = None
         self.lr_scheduler = None
         self.data_loader: Union[DataLoader, None] = None
@@ -301,7 +321,11 @@ class BaseSDTrainProcess(BaseTrainProcess):
             self.ema.eval()
 
         # send to be generated
-        self.sd.generate_images(gen_img_config_list, sampler=sample_config.sampler)
+        self.sd.generate_images(
+            gen_img_config_list,
+            sampler=sample_config.sampler,
+            max_batch_size=sample_config.batch_size,
+        )
 
         if self.ema is not None:
             self.ema.train()
@@ -414,10 +438,18 @@ class BaseSDTrainProcess(BaseTrainProcess):
         return latest_item
 
     def post_save_hook(self, save_path):
-        # override in subclass
+        # override in subclass. Runs on the checkpoint writer thread when async_save is set
         pass
 
+    def finish_save(self, file_path):
+        self.print(f"Saved to {file_path}")
+        self.clean_up_saves()
+        self.post_save_hook(file_path)
+
     def save(self, step=None):
+        if self.checkpoint_writer is not None:
+            # the pinned buffers are reused, the last save has to be written first
+            self.checkpoint_writer.wait()
         flush()
         if self.ema is not None:
             # always save params as ema
@@ -463,7 +495,8 @@ class BaseSDTrainProcess(BaseTrainProcess):
                     file_path,
                     dtype=get_torch_dtype(self.save_config.dtype),
                     metadata=save_meta,
-                    extra_state_dict=embedding_dict
+                    extra_state_dict=embedding_dict,
+                    checkpoint_writer=self.checkpoint_writer
                 )
                 self.network.multiplier = prev_multiplier
                 # if we have an embedding as well, pair it with the network
@@ -485,14 +518,20 @@ class BaseSDTrainProcess(BaseTrainProcess):
                 dec_filename = f'{self.job.name}{step_num}.safetensors'
                 dec_file_path = os.path.join(self.save_root, dec_filename)
                 decorator_state_dict = self.decorator.state_dict()
-                for key, value in decorator_state_dict.items():
-                    if isinstance(value, torch.Tensor):
-                        decorator_state_dict[key] = value.clone().to('cpu', dtype=get_torch_dtype(self.save_config.dtype))
-                save_file(
-                    decorator_state_dict,
-                    dec_file_path,
-                    metadata=save_meta,
-                )
+                if self.checkpoint_writer is not None:
+                    decorator_state_dict = self.checkpoint_writer.snapshot(
+                        decorator_state_dict, 'decorator', dtype=get_torch_dtype(self.save_config.dtype)
+                    )
+                    self.checkpoint_writer.save_file(decorator_state_dict, dec_file_path, metadata=save_meta)
+                else:
+                    for key, value in decorator_state_dict.items():
+                        if isinstance(value, torch.Tensor):
+                            decorator_state_dict[key] = value.clone().to('cpu', dtype=get_torch_dtype(self.save_config.dtype))
+                    save_file(
+                        decorator_state_dict,
+                        dec_file_path,
+                        metadata=save_meta,
+                    )
 
             if self.adapter is not None and self.adapter_config.train:
                 adapter_name = self.job.name
@@ -586,20 +625,42 @@ class BaseSDTrainProcess(BaseTrainProcess):
             with open(path_to_save, 'w') as f:
                 json.dump(json_data, f, indent=4)
 
-        # save optimizer
-        if self.optimizer is not None:
+        # save optimizer. The other format's file is removed once it is written, so a resume loads this one
+        if self.optimizer is not None and self.save_config.optimizer_format == 'safetensors':
+            try:
+                optimizer_path = get_optimizer_checkpoint_path(self.save_root)
+                replaces = os.path.join(self.save_root, 'optimizer.pt')
+                index, tensors = get_optimizer_checkpoint(self.optimizer, self.get_optimizer_param_names())
+                if self.checkpoint_writer is not None:
+                    tensors = self.checkpoint_writer.snapshot(tensors, 'optimizer')
+                    self.checkpoint_writer.submit(
+                        save_optimizer_checkpoint, optimizer_path, index, tensors, replaces=replaces
+                    )
+                else:
+                    save_optimizer_checkpoint(optimizer_path, index, tensors, replaces=replaces)
+            except Exception as e:
+                print(e)
+                print("Could not save optimizer")
+        elif self.optimizer is not None:
             try:
                 filename = f'optimizer.pt'
                 file_path = os.path.join(self.save_root, filename)
+                replaces = get_optimizer_checkpoint_path(self.save_root)
                 state_dict = self.optimizer.state_dict()
-                torch.save(state_dict, file_path)
+                if self.checkpoint_writer is not None:
+                    state_dict = self.checkpoint_writer.snapshot(state_dict, 'optimizer')
+                    self.checkpoint_writer.submit(save_optimizer_state_dict, state_dict, file_path, replaces=replaces)
+                else:
+                    save_optimizer_state_dict(state_dict, file_path, replaces=replaces)
             except Exception as e:
                 print(e)
                 print("Could not save optimizer")
 
-        self.print(f"Saved to {file_path}")
-        self.clean_up_saves()
-        self.post_save_hook(file_path)
+        if self.checkpoint_writer is not None:
+            # runs after the queued writes, so cleanup and the hook see the finished files
+            self.checkpoint_writer.submit(self.finish_save, file_path)
+        else:
+            self.finish_save(file_path)
 
         if self.ema is not None:
             self.ema.train()
@@ -621,6 +682,27 @@ class BaseSDTrainProcess(BaseTrainProcess):
     def hook_before_train_loop(self):
         self.logger.start()
 
+    def get_optimizer_param_names(self) -> Dict[int, str]:
+        # stable names for the trained params, so saved optimizer state is matched by name on resume
+        modules = OrderedDict([
+            ('network', self.network),
+            ('decorator', self.decorator),
+            ('adapter', self.adapter),
+            ('unet', self.sd.unet),
+            ('refiner_unet', self.sd.refiner_unet),
+        ])
+        text_encoders = self.sd.text_encoder if isinstance(self.sd.text_encoder, list) else [self.sd.text_encoder]
+        for i, text_encoder in enumerate(text_encoders):
+            modules[f'text_encoder_{i}'] = text_encoder
+
+        param_names = {}
+        for prefix, module in modules.items():
+            if not isinstance(module, torch.nn.Module):
+                continue
+            for name, param in module.named_parameters():
+                param_names.setdefault(id(param), f"{prefix}.{name}")
+        return param_names
+
     def ensure_params_requires_grad(self, force=False):
         if self.train_config.do_paramiter_swapping and not force:
             # the optimizer will handle this if we are not forcing
@@ -770,14 +852,7 @@ class BaseSDTrainProcess(BaseTrainProcess):
     def get_sigmas(self, timesteps, n_dim=4, dtype=torch.float32):
         sigmas = self.sd.noise_scheduler.sigmas.to(device=self.device, dtype=dtype)
         schedule_timesteps = self.sd.noise_scheduler.timesteps.to(self.device)
-        timesteps = timesteps.to(self.device)
-
-        step_indices = [(schedule_timesteps == t).nonzero().item() for t in timesteps]
-
-        sigma = sigmas[step_indices].flatten()
-        while len(sigma.shape) < n_dim:
-            sigma = sigma.unsqueeze(-1)
-        return sigma
+        return get_sigmas_for_timesteps(sigmas, schedule_timesteps, timesteps, n_dim)
 
     def get_noise(self, latents, batch_size, dtype=torch.float32):
         # get noise
@@ -806,6 +881,11 @@ class BaseSDTrainProcess(BaseTrainProcess):
 
         return noise
 
+    def get_dataloader_iterator(self, dataloader: DataLoader):
+        if self.train_config.prefetch_to_device:
+            return DevicePrefetcher(iter(dataloader), self.device_torch)
+        return iter(dataloader)
+
     def process_general_training_batch(self, batch: 'DataLoaderBatchDTO'):
         with torch.no_grad():
             with self.timer('prepare_prompt'):
@@ -1038,9 +1118,9 @@ class BaseSDTrainProcess(BaseTrainProcess):
                 #         mode_scale=1.29,
                 #     )
                 #     timestep_indices = (u * self.sd.noise_scheduler.config.num_train_timesteps).long()
-                # convert the timestep_indices to a timestep
-                timesteps = [self.sd.noise_scheduler.timesteps[x.item()] for x in timestep_indices]
-                timesteps = torch.stack(timesteps, dim=0)
+                # convert the timestep_indices to a timestep. One gather, so there is no sync per item
+                schedule_timesteps = self.sd.noise_scheduler.timesteps
+                timesteps = schedule_timesteps[timestep_indices.long().to(schedule_timesteps.device)]
 
                 # get noise
                 noise = self.get_noise(latents, batch_size, dtype=dtype)
@@ -1629,7 +1709,13 @@ class BaseSDTrainProcess(BaseTrainProcess):
         # check if it exists
         optimizer_state_filename = f'optimizer.pt'
         optimizer_state_file_path = os.path.join(self.save_root, optimizer_state_filename)
-        if os.path.exists(optimizer_state_file_path):
+        optimizer_checkpoint_path = get_optimizer_checkpoint_path(self.save_root)
+        has_optimizer_checkpoint = is_optimizer_checkpoint(optimizer_checkpoint_path)
+        if has_optimizer_checkpoint and os.path.exists(optimizer_state_file_path):
+            # both formats are left from before switching optimizer_format, use the newer one
+            has_optimizer_checkpoint = \
+                get_optimizer_checkpoint_mtime(optimizer_checkpoint_path) >= os.path.getmtime(optimizer_state_file_path)
+        if has_optimizer_checkpoint or os.path.exists(optimizer_state_file_path):
             # try to load
             # previous param groups
             # previous_params = copy.deepcopy(optimizer.param_groups)
@@ -1638,13 +1724,17 @@ class BaseSDTrainProcess(BaseTrainProcess):
                 previous_lrs.append(group['lr'])
 
             try:
-                print(f"Loading optimizer state from {optimizer_state_file_path}")
-                optimizer_state_dict = torch.load(optimizer_state_file_path, weights_only=True)
-                optimizer.load_state_dict(optimizer_state_dict)
-                del optimizer_state_dict
+                if has_optimizer_checkpoint:
+                    print(f"Loading optimizer state from {optimizer_checkpoint_path}")
+                    load_optimizer_checkpoint(optimizer, optimizer_checkpoint_path, self.get_optimizer_param_names())
+                else:
+                    print(f"Loading optimizer state from {optimizer_state_file_path}")
+                    optimizer_state_dict = torch.load(optimizer_state_file_path, weights_only=True)
+                    optimizer.load_state_dict(optimizer_state_dict)
+                    del optimizer_state_dict
                 flush()
             except Exception as e:
-                print(f"Failed to load optimizer state from {optimizer_state_file_path}")
+                print(f"Failed to load optimizer state from {optimizer_checkpoint_path if has_optimizer_checkpoint else optimizer_state_file_path}")
                 print(e)
 
             # update the optimizer LR from the params
@@ -1674,10 +1764,13 @@ class BaseSDTrainProcess(BaseTrainProcess):
         self.before_dataset_load()
         # load datasets if passed in the root process
         if self.datasets is not None:
-            self.data_loader = get_dataloader_from_datasets(self.datasets, self.train_config.batch_size, self.sd)
+            self.data_loader = get_dataloader_from_datasets(self.datasets, self.train_config.batch_size, self.sd,
+                                                            trigger_word=self.trigger_word,
+                                                            pin_memory=self.train_config.prefetch_to_device)
         if self.datasets_reg is not None:
             self.data_loader_reg = get_dataloader_from_datasets(self.datasets_reg, self.train_config.batch_size,
-                                                                self.sd)
+                                                                self.sd, trigger_word=self.trigger_word,
+                                                                pin_memory=self.train_config.prefetch_to_device)
 
         flush()
         ### HOOK ###
@@ -1705,14 +1798,14 @@ class BaseSDTrainProcess(BaseTrainProcess):
 
         if self.data_loader is not None:
             dataloader = self.data_loader
-            dataloader_iterator = iter(dataloader)
+            dataloader_iterator = self.get_dataloader_iterator(dataloader)
         else:
             dataloader = None
             dataloader_iterator = None
 
         if self.data_loader_reg is not None:
             dataloader_reg = self.data_loader_reg
-            dataloader_iterator_reg = iter(dataloader_reg)
+            dataloader_iterator_reg = self.get_dataloader_iterator(dataloader_reg)
         else:
             dataloader_reg = None
             dataloader_iterator_reg = None
@@ -1740,9 +1833,20 @@ class BaseSDTrainProcess(BaseTrainProcess):
 
         start_step_num = self.step_num
         did_first_flush = False
+        telemetry_jsonl_path = None
+        if self.logging_config.telemetry and self.logging_config.telemetry_jsonl:
+            telemetry_jsonl_path = os.path.join(self.save_root, 'telemetry.jsonl')
+        self.telemetry = TrainingTelemetry(
+            self.logger,
+            telemetry_jsonl_path,
+            report_every=self.logging_config.telemetry_every if self.logging_config.telemetry else 0,
+            vae_scale_factor=getattr(self.sd, 'vae_scale_factor', 8),
+        )
         for step in range(start_step_num, self.train_config.steps):
             if self.train_config.do_paramiter_swapping:
                 self.optimizer.swap_paramiters()
+            self.profiler.step_start(step)
+            self.telemetry.step_start()
             self.timer.start('train_loop')
             if self.train_config.do_random_cfg:
                 self.train_config.do_cfg = True
@@ -1771,27 +1875,27 @@ class BaseSDTrainProcess(BaseTrainProcess):
                     if batch_step % 2 == 0 and dataloader_reg is not None and not is_save_step and not is_sample_step:
                         try:
                             with self.timer('get_batch:reg'):
-                                batch = next(dataloader_iterator_reg)
+                                batch = self.telemetry.next_batch(dataloader_iterator_reg)
                         except StopIteration:
                             with self.timer('reset_batch:reg'):
                                 # hit the end of an epoch, reset
                                 self.progress_bar.pause()
-                                dataloader_iterator_reg = iter(dataloader_reg)
+                                dataloader_iterator_reg = self.get_dataloader_iterator(dataloader_reg)
                                 trigger_dataloader_setup_epoch(dataloader_reg)
 
                             with self.timer('get_batch:reg'):
-                                batch = next(dataloader_iterator_reg)
+                                batch = self.telemetry.next_batch(dataloader_iterator_reg)
                             self.progress_bar.unpause()
                         is_reg_step = True
                     elif dataloader is not None:
                         try:
                             with self.timer('get_batch'):
-                                batch = next(dataloader_iterator)
+                                batch = self.telemetry.next_batch(dataloader_iterator)
                         except StopIteration:
                             with self.timer('reset_batch'):
                                 # hit the end of an epoch, reset
                                 self.progress_bar.pause()
-                                dataloader_iterator = iter(dataloader)
+                                dataloader_iterator = self.get_dataloader_iterator(dataloader)
                                 trigger_dataloader_setup_epoch(dataloader)
                                 self.epoch_num += 1
                                 if self.train_config.gradient_accumulation_steps == -1:
@@ -1799,7 +1903,7 @@ class BaseSDTrainProcess(BaseTrainProcess):
                                     self.is_grad_accumulation_step = False
                                     self.grad_accumulation_step = 0
                             with self.timer('get_batch'):
-                                batch = next(dataloader_iterator)
+                                batch = self.telemetry.next_batch(dataloader_iterator)
                             self.progress_bar.unpause()
                     else:
                         batch = None
@@ -1825,6 +1929,7 @@ class BaseSDTrainProcess(BaseTrainProcess):
             
             loss_dict = self.hook_train_loop(batch_list)
             self.timer.stop('train_loop')
+            self.telemetry.step_end()
             if not did_first_flush:
                 flush()
                 did_first_flush = True
@@ -1849,11 +1954,30 @@ class BaseSDTrainProcess(BaseTrainProcess):
                 else:
                     learning_rate = optimizer.param_groups[0]['lr']
 
-                prog_bar_string = f"lr: {learning_rate:.1e}"
-                for key, value in loss_dict.items():
-                    prog_bar_string += f" {key}: {value:.3e}"
-
-                self.progress_bar.set_postfix_str(prog_bar_string)
+                # losses and lr can be device tensors. They are only read back on metrics steps
+                self.metrics.add('learning_rate', learning_rate)
+                self.metrics.add_dict(loss_dict, prefix='loss/')
+                is_log_step = self.logging_config.log_every is None or (
+                    self.logging_config.log_every and self.step_num % self.logging_config.log_every == 0
+                )
+                is_metrics_step = is_log_step or self.step_num == start_step_num or \
+                    self.step_num == self.train_config.steps - 1 or (
+                        self.logging_config.metrics_every and
+                        self.step_num % self.logging_config.metrics_every == 0
+                    )
+                if is_metrics_step:
+                    with self.timer('reduce_metrics'):
+                        # averages since the last metrics step
+                        metrics = self.metrics.reduce()
+                    if metrics.get('nan_loss', 0.0) > 0:
+                        self.print(f"loss was nan in {metrics['nan_loss'] * 100:.0f}% of batches since the last "
+                                   f"metrics step, their gradients were discarded")
+                    prog_bar_string = f"lr: {metrics['learning_rate']:.1e}"
+                    for key, value in metrics.items():
+                        if key.startswith('loss/'):
+                            prog_bar_string += f" {key[len('loss/'):]}: {value:.3e}"
+
+                    self.progress_bar.set_postfix_str(prog_bar_string)
 
                 # if the batch is a DataLoaderBatchDTO, then we need to clean it up
                 if isinstance(batch, DataLoaderBatchDTO):
@@ -1868,7 +1992,9 @@ class BaseSDTrainProcess(BaseTrainProcess):
                         # print above the progress bar
                         if self.train_config.free_u:
                             self.sd.pipeline.disable_freeu()
+                        self.timer.start('sample')
                         self.sample(self.step_num)
+                        self.timer.stop('sample')
                         if self.train_config.unload_text_encoder:
                             # make sure the text encoder is unloaded
                             self.sd.text_encoder_to('cpu')
@@ -1881,37 +2007,28 @@ class BaseSDTrainProcess(BaseTrainProcess):
                         # print above the progress bar
                         self.progress_bar.pause()
                         self.print(f"Saving at step {self.step_num}")
+                        self.timer.start('save')
                         self.save(self.step_num)
+                        self.timer.stop('save')
                         self.ensure_params_requires_grad()
                         self.progress_bar.unpause()
 
-                    if self.logging_config.log_every and self.step_num % self.logging_config.log_every == 0:
+                    if self.logging_config.log_every and is_log_step:
                         self.progress_bar.pause()
                         with self.timer('log_to_tensorboard'):
                             # log to tensorboard
                             if self.writer is not None:
-                                for key, value in loss_dict.items():
+                                for key, value in metrics.items():
+                                    if key == 'learning_rate':
+                                        key = 'lr'
+                                    elif key.startswith('loss/'):
+                                        key = key[len('loss/'):]
                                     self.writer.add_scalar(f"{key}", value, self.step_num)
-                                self.writer.add_scalar(f"lr", learning_rate, self.step_num)
                             self.progress_bar.unpause()
-                        
+
+                    if is_log_step:
                         # log to logger
-                        self.logger.log({
-                            'learning_rate': learning_rate,
-                        })
-                        for key, value in loss_dict.items():
-                            self.logger.log({
-                                f'loss/{key}': value,
-                            })
-                    elif self.logging_config.log_every is None: 
-                        # log every step
-                        self.logger.log({
-                            'learning_rate': learning_rate,
-                        })
-                        for key, value in loss_dict.items():
-                            self.logger.log({
-                                f'loss/{key}': value,
-                            })
+                        self.logger.log(metrics)
 
 
                     if self.performance_log_every > 0 and self.step_num % self.performance_log_every == 0:
@@ -1921,6 +2038,14 @@ class BaseSDTrainProcess(BaseTrainProcess):
                         self.timer.reset()
                         self.progress_bar.unpause()
                 
+                telemetry_report = self.telemetry.maybe_report(self.step_num)
+                if telemetry_report is not None and self.logging_config.verbose:
+                    self.print(
+                        f"{telemetry_report['images_per_sec']:.2f} images/s, "
+                        f"{telemetry_report['data_wait_fraction'] * 100:.1f}% of step time waiting on data, "
+                        f"queue depth {telemetry_report['queue_depth_mean']:.1f}"
+                    )
+
                 # commit log
                 self.logger.commit(step=self.step_num)
 
@@ -1934,6 +2059,7 @@ class BaseSDTrainProcess(BaseTrainProcess):
                 # update various steps
                 self.step_num = step + 1
                 self.grad_accumulation_step += 1
+                self.profiler.step_end()
 
 
         ###################################################################
@@ -1941,6 +2067,8 @@ class BaseSDTrainProcess(BaseTrainProcess):
         ###################################################################
 
         self.progress_bar.close()
+        # writes the profile if training ended inside the window
+        self.profiler.finish()
         if self.train_config.free_u:
             self.sd.pipeline.disable_freeu()
         if not self.train_config.disable_sampling:
@@ -1948,6 +2076,9 @@ class BaseSDTrainProcess(BaseTrainProcess):
             self.logger.commit(step=self.step_num)
         print("")
         self.save()
+        if self.checkpoint_writer is not None:
+            # everything has to be on disk before pushing or exiting
+            self.checkpoint_writer.close()
         self.logger.finish()
 
         if self.save_config.push_to_hub:
@@ -35,6 +35,8 @@ class GenerateConfig:
         self.ext = kwargs.get('ext', 'png')
         self.prompt_file = kwargs.get('prompt_file', False)
         self.num_repeats = kwargs.get('num_repeats', 1)
+        # most images generated in one pipeline call, images of the same size are batched together
+        self.batch_size = kwargs.get('batch_size', 1)
         self.prompts_in_file = self.prompts
         if self.prompts is None:
             raise ValueError("Prompts must be set")
@@ -137,7 +139,11 @@ class GenerateProcess(BaseProcess):
                         add_prompt_file=self.generate_config.prompt_file
                     ))
             # generate images
-            self.sd.generate_images(prompt_image_configs, sampler=self.generate_config.sampler)
+            self.sd.generate_images(
+                prompt_image_configs,
+                sampler=self.generate_config.sampler,
+                max_batch_size=self.generate_config.batch_size,
+            )
 
             print("Done generating images")
             # cleanup
@@ -0,0 +1,257 @@
+import argparse
+import itertools
+import json
+import os
+import random
+import resource
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+import numpy as np
+
+ROOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.append(ROOT_DIR)
+
+# dataset config overrides for every mode and augment preset
+MODES = {
+    'folder': {},
+    'cache_resized_images': {'cache_resized_images': True},
+    'pack': {},
+    'streaming': {'streaming': True},
+}
+AUGMENTS = {
+    'none': {},
+    'flip': {'flip_x': True},
+    'albumentations': {
+        'augmentations': [
+            {'method': 'RandomBrightnessContrast', 'params': {'p': 1.0}},
+            {'method': 'HueSaturationValue', 'params': {'p': 1.0}},
+        ],
+    },
+}
+CAPTION_WORDS = ['a', 'photo', 'of', 'cat', 'dog', 'sitting', 'on', 'red', 'blue', 'chair', 'in', 'the', 'park',
+                 'painting', 'style', 'bright', 'dark', 'portrait', 'landscape', 'close', 'up']
+
+parser = argparse.ArgumentParser(description='Benchmark the training dataloader on cpu with a synthetic dataset. '
+                                             'Every configuration runs in its own process.')
+parser.add_argument("--dataset_dir", type=str, default=None, help="Where to generate the synthetic dataset. Reused if it exists. Defaults to a temp folder that is removed")
+parser.add_argument("--num_images", type=int, default=512, help="Images in the synthetic dataset")
+parser.add_argument("--image_size", type=int, default=1024, help="Long side of the synthetic images")
+parser.add_argument("--aspects", type=str, nargs='+', default=['1:1', '4:3', '3:4', '16:9', '9:16'], help="Aspect ratios the images cycle through")
+parser.add_argument("--resolution", type=int, default=512, help="Dataset resolution")
+parser.add_argument("--batch_size", type=int, default=4, help="Batch size")
+parser.add_argument("--num_workers", type=int, nargs='+', default=[0, 2, 4], help="num_workers values to run")
+parser.add_argument("--prefetch_factor", type=int, nargs='+', default=[2], help="prefetch_factor values to run, only used with workers")
+parser.add_argument("--modes", type=str, nargs='+', default=list(MODES.keys()), choices=list(MODES.keys()), help="Dataset modes to run")
+parser.add_argument("--augments", type=str, nargs='+', default=['none', 'flip'], choices=list(AUGMENTS.keys()), help="Augment presets to run")
+parser.add_argument("--num_batches", type=int, default=100, help="Timed batches per run, after the first one")
+parser.add_argument("--output", type=str, default=None, help="Write the results as json to this file, - for stdout. The table goes to stderr then")
+parser.add_argument("--run_config", type=str, default=None, help=argparse.SUPPRESS)
+
+
+def get_peak_rss_mb(who) -> float:
+    # ru_maxrss is in kilobytes on linux and bytes on mac
+    peak = resource.getrusage(who).ru_maxrss
+    if sys.platform == 'darwin':
+        return peak / (1024 * 1024)
+    return peak / 1024
+
+
+def run_config(params: dict) -> dict:
+    # runs in a child process so startup time and peak memory belong to this config only
+    from toolkit.config_modules import DatasetConfig
+    from toolkit.data_loader import get_dataloader_from_datasets, trigger_dataloader_setup_epoch
+
+    dataset_config = DatasetConfig(**params['dataset'])
+    start = time.perf_counter()
+    dataloader = get_dataloader_from_datasets([dataset_config], batch_size=params['batch_size'], sd=None)
+    iterator = iter(dataloader)
+    next(iterator)
+    startup_time = time.perf_counter() - start
+
+    num_batches = params['num_batches']
+    max_epochs = params.get('max_epochs', None)
+    batches = 0
+    items = 0
+    epochs = 1
+    start = time.perf_counter()
+    while num_batches is None or batches < num_batches:
+        try:
+            batch = next(iterator)
+        except StopIteration:
+            if max_epochs is not None and epochs >= max_epochs:
+                break
+            trigger_dataloader_setup_epoch(dataloader)
+            iterator = iter(dataloader)
+            epochs += 1
+            continue
+        items += len(batch.file_items)
+        batches += 1
+        batch.cleanup()
+    elapsed = time.perf_counter() - start
+    # shuts the workers down so they are counted in the children usage
+    del iterator
+    del dataloader
+
+    return {
+        'startup_time': startup_time,
+        'batches': batches,
+        'items': items,
+        'epochs': epochs,
+        'elapsed': elapsed,
+        'items_per_sec': items / elapsed if elapsed > 0 else 0.0,
+        'batches_per_sec': batches / elapsed if elapsed > 0 else 0.0,
+        'peak_rss_mb': get_peak_rss_mb(resource.RUSAGE_SELF),
+        'peak_worker_rss_mb': get_peak_rss_mb(resource.RUSAGE_CHILDREN),
+    }
+
+
+def reset_dataset_metadata(folder: str):
+    # sizes and stats are cached in the dataset folder, remove them so every run starts up cold
+    from toolkit.dataset_metadata import DATABASE_FILENAME
+
+    for suffix in ['', '-wal', '-shm', '-journal']:
+        path = os.path.join(folder, f"{DATABASE_FILENAME}{suffix}")
+        if os.path.exists(path):
+            os.remove(path)
+
+
+def make_dataset(folder: str, num_images: int, image_size: int, aspects: list, seed: int = 42):
+    from PIL import Image
+
+    os.makedirs(folder, exist_ok=True)
+    rng = random.Random(seed)
+    np_rng = np.random.default_rng(seed)
+    for i in range(num_images):
+        aspect_w, aspect_h = [float(x) for x in aspects[i % len(aspects)].split(':')]
+        scale = image_size / max(aspect_w, aspect_h)
+        width = int(aspect_w * scale) // 8 * 8
+        height = int(aspect_h * scale) // 8 * 8
+        # upscaled noise compresses roughly like a photo
+        noise = np_rng.integers(0, 256, (max(height // 16, 1), max(width // 16, 1), 3), dtype=np.uint8)
+        img = Image.fromarray(noise).resize((width, height), Image.BICUBIC)
+        img.save(os.path.join(folder, f"{i:06d}.jpg"), quality=90)
+        caption = ' '.join(rng.choices(CAPTION_WORDS, k=rng.randint(5, 20)))
+        with open(os.path.join(folder, f"{i:06d}.txt"), 'w') as f:
+            f.write(caption)
+
+
+def make_pack(image_folder: str, pack_folder: str):
+    from PIL import Image
+    from toolkit.dataset_pack import DatasetPackWriter, get_dataset_files
+
+    writer = DatasetPackWriter(pack_folder)
+    for file in get_dataset_files(image_folder):
+        with Image.open(file) as img:
+            width, height = img.size
+        caption_path = f"{os.path.splitext(file)[0]}.txt"
+        writer.add(os.path.relpath(file, image_folder).replace(os.sep, '/'), file, width, height, {'txt': caption_path})
+    writer.close()
+
+
+def run_child(params: dict) -> dict:
+    result = subprocess.run(
+        [sys.executable, os.path.abspath(__file__), '--run_config', json.dumps(params)],
+        capture_output=True,
+        text=True,
+    )
+    for line in reversed(result.stdout.splitlines()):
+        if line.startswith('RESULT '):
+            return json.loads(line[len('RESULT '):])
+    return {'error': result.stderr.strip().splitlines()[-1] if result.stderr.strip() else f"exit code {result.returncode}"}
+
+
+def main(args):
+    if args.run_config is not None:
+        print(f"RESULT {json.dumps(run_config(json.loads(args.run_config)))}")
+        return
+
+    # keeps stdout for the json
+    log_file = sys.stderr if args.output == '-' else sys.stdout
+    remove_dataset = args.dataset_dir is None
+    dataset_root = args.dataset_dir if args.dataset_dir is not None else tempfile.mkdtemp(prefix='aitk_dataloader_bench_')
+    image_folder = os.path.join(dataset_root, 'images')
+    pack_folder = os.path.join(dataset_root, 'pack')
+    if not os.path.isdir(image_folder):
+        print(f"Generating {args.num_images} images in {image_folder}", file=log_file)
+        make_dataset(image_folder, args.num_images, args.image_size, args.aspects)
+    if 'pack' in args.modes and not os.path.isdir(pack_folder):
+        print(f"Packing dataset to {pack_folder}", file=log_file)
+        make_pack(image_folder, pack_folder)
+
+    base_dataset = {
+        'resolution': args.resolution,
+        'buckets': True,
+        'caption_ext': 'txt',
+        'default_caption': 'default',
+    }
+
+    runs = []
+    if 'cache_resized_images' in args.modes:
+        # one pass to build the cache so the timed runs read from it
+        runs.append(('cache_resized_images (build)', 0, 2, 'none', {
+            'dataset': {**base_dataset, **MODES['cache_resized_images'], 'dataset_path': image_folder, 'num_workers': 0},
+            'batch_size': args.batch_size,
+            'num_batches': None,
+            'max_epochs': 1,
+        }))
+    for mode, augment, num_workers in itertools.product(args.modes, args.augments, args.num_workers):
+        # prefetch_factor does nothing without workers
+        prefetch_factors = args.prefetch_factor if num_workers > 0 else args.prefetch_factor[:1]
+        for prefetch_factor in prefetch_factors:
+            dataset = {
+                **base_dataset,
+                **MODES[mode],
+                **AUGMENTS[augment],
+                'dataset_path': pack_folder if mode == 'pack' else image_folder,
+                'num_workers': num_workers,
+                'prefetch_factor': prefetch_factor,
+            }
+            runs.append((mode, num_workers, prefetch_factor, augment, {
+                'dataset': dataset,
+                'batch_size': args.batch_size,
+                'num_batches': args.num_batches,
+            }))
+
+    print(f"{'mode':>28} | {'workers':>7} | {'prefetch':>8} | {'augment':>14} | {'startup s':>9} | "
+          f"{'items/s':>9} | {'rss mb':>8} | {'worker rss mb':>13}", file=log_file)
+    results = []
+    for mode, num_workers, prefetch_factor, augment, params in runs:
+        result = {
+            'mode': mode,
+            'num_workers': num_workers,
+            'prefetch_factor': prefetch_factor,
+            'augment': augment,
+            'batch_size': args.batch_size,
+        }
+        reset_dataset_metadata(params['dataset']['dataset_path'])
+        result.update(run_child(params))
+        results.append(result)
+        if 'error' in result:
+            print(f"{mode:>28} | {num_workers:>7} | {prefetch_factor:>8} | {augment:>14} | error: {result['error']}",
+                  file=log_file)
+            continue
+        print(f"{mode:>28} | {num_workers:>7} | {prefetch_factor:>8} | {augment:>14} | "
+              f"{result['startup_time']:>9.2f} | {result['items_per_sec']:>9.1f} | {result['peak_rss_mb']:>8.0f} | "
+              f"{result['peak_worker_rss_mb']:>13.0f}", file=log_file)
+
+    output = {
+        'config': {k: v for k, v in vars(args).items() if k != 'run_config'},
+        'results': results,
+    }
+    if args.output == '-':
+        print(json.dumps(output, indent=2))
+    elif args.output is not None:
+        with open(args.output, 'w') as f:
+            json.dump(output, f, indent=2)
+        print(f"Results written to {args.output}", file=log_file)
+
+    if remove_dataset:
+        shutil.rmtree(dataset_root)
+
+
+if __name__ == '__main__':
+    main(parser.parse_args())
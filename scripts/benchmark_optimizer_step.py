@@ -0,0 +1,90 @@
+import argparse
+import os
+import sys
+import time
+
+import torch
+
+ROOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.append(ROOT_DIR)
+
+from toolkit.optimizers.adafactor import Adafactor
+from toolkit.optimizers.adam8bit import Adam8bit
+from toolkit.optimizers.automagic import Automagic
+from toolkit.optimizers.prodigy_8bit import Prodigy8bit
+
+parser = argparse.ArgumentParser(description='Compare per parameter and multi tensor optimizer steps on a LoRA sized set of parameters.')
+parser.add_argument("--device", type=str, default='cpu', help="Device to run on")
+parser.add_argument("--dtype", type=str, default='float32', choices=['float32', 'bfloat16', 'float16'], help="Parameter dtype")
+parser.add_argument("--num_modules", type=int, default=2000, help="LoRA modules, each adds a down and an up tensor")
+parser.add_argument("--rank", type=int, default=4, help="LoRA rank")
+parser.add_argument("--features", type=int, nargs='+', default=[320, 640, 1280], help="Module in / out features to cycle through")
+parser.add_argument("--iters", type=int, default=10, help="Timed steps per optimizer")
+parser.add_argument("--optimizers", type=str, nargs='+', default=['adam8bit', 'prodigy8bit', 'adafactor', 'automagic'], help="Optimizers to time")
+
+args = parser.parse_args()
+device = torch.device(args.device)
+dtype = getattr(torch, args.dtype)
+
+optimizer_classes = {
+    'adam8bit': lambda params, foreach: Adam8bit(params, lr=1e-4, foreach=foreach),
+    'prodigy8bit': lambda params, foreach: Prodigy8bit(params, lr=1.0, foreach=foreach),
+    'adafactor': lambda params, foreach: Adafactor(
+        params, lr=1e-4, relative_step=False, scale_parameter=False, foreach=foreach
+    ),
+    'automagic': lambda params, foreach: Automagic(params, lr=1e-4, foreach=foreach),
+}
+
+
+def sync():
+    if device.type == 'cuda':
+        torch.cuda.synchronize(device)
+
+
+def make_params():
+    # same seed for both runs so the results can be compared
+    generator = torch.Generator().manual_seed(42)
+    params = []
+    for i in range(args.num_modules):
+        in_features = args.features[i % len(args.features)]
+        out_features = args.features[(i + 1) % len(args.features)]
+        down = torch.randn((args.rank, in_features), generator=generator) * 0.01
+        up = torch.randn((out_features, args.rank), generator=generator) * 0.01
+        params.append(torch.nn.Parameter(down.to(device, dtype=dtype)))
+        params.append(torch.nn.Parameter(up.to(device, dtype=dtype)))
+    return params
+
+
+def set_grads(params, generator):
+    for param in params:
+        param.grad = (torch.randn(param.shape, generator=generator) * 0.01).to(device, dtype=dtype)
+
+
+def time_optimizer(name, foreach):
+    params = make_params()
+    optimizer = optimizer_classes[name](params, foreach)
+    generator = torch.Generator().manual_seed(0)
+    # the first step builds the state, keep it out of the timing
+    set_grads(params, generator)
+    optimizer.step()
+    sync()
+    total = 0.0
+    for _ in range(args.iters):
+        set_grads(params, generator)
+        sync()
+        start = time.perf_counter()
+        optimizer.step()
+        sync()
+        total += time.perf_counter() - start
+    return total / args.iters * 1000, params
+
+
+num_params = args.num_modules * 2
+numel = sum(p.numel() for p in make_params())
+print(f"Device: {device}, {args.dtype}, {num_params:,} tensors, {numel:,} parameters, {args.iters} iters")
+print(f"{'optimizer':>12} | {'loop ms':>10} | {'foreach ms':>10} | {'speedup':>8} | {'max diff':>10}")
+for name in args.optimizers:
+    loop_ms, loop_params = time_optimizer(name, foreach=False)
+    foreach_ms, foreach_params = time_optimizer(name, foreach=True)
+    max_diff = max((a.float() - b.float()).abs().max().item() for a, b in zip(loop_params, foreach_params))
+    print(f"{name:>12} | {loop_ms:>10.2f} | {foreach_ms:>10.2f} | {loop_ms / foreach_ms:>7.2f}x | {max_diff:>10.2e}")
@@ -0,0 +1,79 @@
+import argparse
+import os
+import sys
+import time
+
+import torch
+
+ROOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.append(ROOT_DIR)
+
+from toolkit.samplers.timestep_utils import get_timestep_indices, get_sigmas_for_timesteps
+
+parser = argparse.ArgumentParser(description='Compare per timestep and vectorized timestep / sigma lookups across batch sizes.')
+parser.add_argument("--device", type=str, default='cuda' if torch.cuda.is_available() else 'cpu', help="Device to run on")
+parser.add_argument("--batch_sizes", type=int, nargs='+', default=[1, 4, 16, 64, 256], help="Batch sizes to time")
+parser.add_argument("--num_timesteps", type=int, default=1000, help="Length of the schedule")
+parser.add_argument("--iters", type=int, default=100, help="Timed iterations per batch size")
+
+args = parser.parse_args()
+device = torch.device(args.device)
+
+
+def sync():
+    if device.type == 'cuda':
+        torch.cuda.synchronize(device)
+
+
+def old_get_sigmas(sigmas, schedule_timesteps, timesteps, n_dim):
+    # the lookup this replaces, one nonzero().item() per timestep
+    step_indices = [(schedule_timesteps == t).nonzero().item() for t in timesteps]
+    sigma = sigmas[step_indices].flatten()
+    while len(sigma.shape) < n_dim:
+        sigma = sigma.unsqueeze(-1)
+    return sigma
+
+
+def old_gather(schedule_timesteps, timestep_indices):
+    return torch.stack([schedule_timesteps[x.item()] for x in timestep_indices], dim=0)
+
+
+def new_gather(schedule_timesteps, timestep_indices):
+    return schedule_timesteps[timestep_indices]
+
+
+def time_fn(fn, *fn_args):
+    for _ in range(5):
+        fn(*fn_args)
+    sync()
+    start = time.perf_counter()
+    for _ in range(args.iters):
+        fn(*fn_args)
+    sync()
+    return (time.perf_counter() - start) / args.iters * 1000
+
+
+# sorted high to low like the flow match training schedule
+t = torch.sigmoid(torch.randn((args.num_timesteps,), device=device))
+schedule_timesteps, _ = torch.sort((1 - t) * 1000, descending=True)
+sigmas = torch.cat([schedule_timesteps / 1000, torch.zeros(1, device=device)])
+
+print(f"Device: {device}, schedule of {args.num_timesteps} timesteps, {args.iters} iters")
+print(f"{'batch':>6} | {'gather old ms':>13} | {'gather new ms':>13} | {'sigmas old ms':>13} | {'sigmas new ms':>13}")
+for batch_size in args.batch_sizes:
+    timestep_indices = torch.randint(0, args.num_timesteps, (batch_size,), device=device)
+    timesteps = schedule_timesteps[timestep_indices]
+
+    # make sure both paths agree before timing them
+    assert torch.equal(old_gather(schedule_timesteps, timestep_indices), new_gather(schedule_timesteps, timestep_indices))
+    assert torch.equal(get_timestep_indices(schedule_timesteps, timesteps), timestep_indices)
+    assert torch.equal(
+        old_get_sigmas(sigmas, schedule_timesteps, timesteps, 4),
+        get_sigmas_for_timesteps(sigmas, schedule_timesteps, timesteps, 4)
+    )
+
+    old_gather_ms = time_fn(old_gather, schedule_timesteps, timestep_indices)
+    new_gather_ms = time_fn(new_gather, schedule_timesteps, timestep_indices)
+    old_sigmas_ms = time_fn(old_get_sigmas, sigmas, schedule_timesteps, timesteps, 4)
+    new_sigmas_ms = time_fn(get_sigmas_for_timesteps, sigmas, schedule_timesteps, timesteps, 4)
+    print(f"{batch_size:>6} | {old_gather_ms:>13.4f} | {new_gather_ms:>13.4f} | {old_sigmas_ms:>13.4f} | {new_sigmas_ms:>13.4f}")
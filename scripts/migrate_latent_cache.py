@@ -0,0 +1,51 @@
+import argparse
+import os
+import sys
+from collections import OrderedDict
+
+from safetensors import safe_open
+from tqdm import tqdm
+
+ROOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.append(ROOT_DIR)
+
+from toolkit.sharded_store import ShardedTensorStore
+
+parser = argparse.ArgumentParser(description='Move per file latent caches into a sharded latent store.')
+parser.add_argument("input_folder", type=str, help="Path to dataset folder. Searched recursively for _latent_cache folders")
+parser.add_argument("--delete", action="store_true", help="Delete the per file caches once they are in the store")
+
+args = parser.parse_args()
+
+# find all latent cache folders
+cache_dirs = []
+for root, dirs, _ in os.walk(args.input_folder):
+    if os.path.basename(root) == '_latent_cache':
+        cache_dirs.append(root)
+print(f"Found {len(cache_dirs)} latent cache folders")
+
+num_migrated = 0
+num_skipped = 0
+
+for cache_dir in cache_dirs:
+    latent_files = sorted([f for f in os.listdir(cache_dir) if f.endswith('.safetensors')])
+    if len(latent_files) == 0:
+        continue
+    store = ShardedTensorStore(cache_dir)
+    for filename in tqdm(latent_files, desc=f"Migrating {cache_dir}"):
+        latent_path = os.path.join(cache_dir, filename)
+        key = os.path.splitext(filename)[0]
+        if key in store:
+            num_skipped += 1
+        else:
+            with safe_open(latent_path, framework='pt', device='cpu') as f:
+                meta = f.metadata()
+                state_dict = OrderedDict([(k, f.get_tensor(k)) for k in f.keys()])
+            store.put(key, state_dict, metadata=meta)
+            num_migrated += 1
+        if args.delete:
+            os.remove(latent_path)
+    store.close()
+
+print(f"Migrated {num_migrated} latents, skipped {num_skipped} already in a store")
+print("Done")
@@ -0,0 +1,52 @@
+import argparse
+import os
+import sys
+
+from PIL import Image
+from PIL.ImageOps import exif_transpose
+from tqdm import tqdm
+
+ROOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.append(ROOT_DIR)
+
+from toolkit.dataset_pack import DatasetPackWriter, get_dataset_files, SIDECAR_EXTENSIONS, DEFAULT_MAX_SHARD_SIZE
+from toolkit.image_utils import probe_oriented_image_size
+
+parser = argparse.ArgumentParser(description='Pack a dataset folder into a few large shards that can be used as a dataset path.')
+parser.add_argument("input_folder", type=str, help="Path to dataset folder. Searched recursively for images")
+parser.add_argument("output_folder", type=str, help="Folder to write the pack to")
+parser.add_argument("--max_shard_size", type=int, default=DEFAULT_MAX_SHARD_SIZE // (1024 * 1024), help="Shard size in MB")
+
+args = parser.parse_args()
+
+input_folder = os.path.abspath(args.input_folder)
+output_folder = os.path.abspath(args.output_folder)
+if output_folder == input_folder or output_folder.startswith(input_folder + os.sep):
+    raise ValueError("output_folder must be outside of input_folder")
+
+file_list = get_dataset_files(input_folder)
+print(f"Found {len(file_list)} images")
+
+writer = DatasetPackWriter(output_folder, max_shard_size=args.max_shard_size * 1024 * 1024)
+num_skipped = 0
+for file in tqdm(file_list, desc="Packing"):
+    size = probe_oriented_image_size(file)
+    if size is None:
+        try:
+            size = exif_transpose(Image.open(file)).size
+        except Exception as e:
+            print(f"Error reading image, skipping: {file}")
+            print(e)
+            num_skipped += 1
+            continue
+    path_no_ext = os.path.splitext(file)[0]
+    sidecar_paths = {}
+    for ext in SIDECAR_EXTENSIONS:
+        if os.path.exists(f"{path_no_ext}.{ext}"):
+            sidecar_paths[ext] = f"{path_no_ext}.{ext}"
+    rel_path = os.path.relpath(file, input_folder).replace(os.sep, '/')
+    writer.add(rel_path, file, size[0], size[1], sidecar_paths)
+writer.close()
+
+print(f"Packed {len(file_list) - num_skipped} images into {writer.shard_idx + 1} shards, skipped {num_skipped}")
+print("Done")
@@ -0,0 +1,66 @@
+import argparse
+import os
+import random
+import sys
+
+import numpy as np
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from toolkit.buckets import get_bucket_for_image_size, get_bucket_sizes, get_buckets_for_image_sizes
+
+# checks that the vectorized get_buckets_for_image_sizes picks the same bucket as get_bucket_for_image_size
+
+parser = argparse.ArgumentParser()
+parser.add_argument('--num_sizes', type=int, default=5000, help='random image sizes per resolution and divisibility')
+parser.add_argument('--seed', type=int, default=42)
+parser.add_argument('--resolutions', type=int, nargs='+', default=[256, 512, 768, 1024, 1536])
+parser.add_argument('--divisibilities', type=int, nargs='+', default=[1, 8, 16, 64])
+args = parser.parse_args()
+
+
+def get_test_sizes(rng: random.Random, resolution: int, divisibility: int, num_sizes: int):
+    sizes = []
+    # exact bucket sizes take the exact match path
+    for bucket in get_bucket_sizes(resolution, divisibility):
+        # large divisibilities round some buckets down to 0 at low resolutions
+        if bucket["width"] == 0 or bucket["height"] == 0:
+            continue
+        sizes.append((bucket["width"], bucket["height"]))
+    # images smaller than the resolution use buckets for their own resolution
+    for _ in range(num_sizes // 4):
+        sizes.append((rng.randint(16, resolution), rng.randint(16, resolution)))
+    # extreme aspect ratios
+    for _ in range(num_sizes // 4):
+        short_side = rng.randint(16, 256)
+        long_side = rng.randint(resolution, resolution * 8)
+        sizes.append((short_side, long_side) if rng.random() < 0.5 else (long_side, short_side))
+    while len(sizes) < num_sizes:
+        sizes.append((rng.randint(16, resolution * 4), rng.randint(16, resolution * 4)))
+    return sizes
+
+
+rng = random.Random(args.seed)
+num_checked = 0
+num_mismatched = 0
+for resolution in args.resolutions:
+    for divisibility in args.divisibilities:
+        sizes = get_test_sizes(rng, resolution, divisibility, args.num_sizes)
+        widths = np.array([size[0] for size in sizes])
+        heights = np.array([size[1] for size in sizes])
+        # a small chunk size also covers chunks with mixed small and large images
+        for chunk_size in [65536, 97]:
+            buckets = get_buckets_for_image_sizes(
+                widths, heights, resolution=resolution, divisibility=divisibility, chunk_size=chunk_size
+            )
+            for (width, height), bucket in zip(sizes, buckets.tolist()):
+                expected = get_bucket_for_image_size(width, height, resolution=resolution, divisibility=divisibility)
+                num_checked += 1
+                if bucket != [expected["width"], expected["height"]]:
+                    num_mismatched += 1
+                    if num_mismatched <= 20:
+                        print(f"mismatch resolution {resolution} divisibility {divisibility} size {width}x{height}: "
+                              f"got {bucket[0]}x{bucket[1]}, expected {expected['width']}x{expected['height']}")
+
+print(f"checked {num_checked} sizes, {num_mismatched} mismatched")
+if num_mismatched > 0:
+    sys.exit(1)
@@ -0,0 +1,84 @@
+import os
+import sys
+
+import torch
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from toolkit.metrics import MetricsAccumulator
+
+# checks MetricsAccumulator.reduce against plain python means, and that it reads back once per device
+
+devices = ['cpu']
+if torch.cuda.is_available():
+    devices += [f"cuda:{i}" for i in range(torch.cuda.device_count())]
+
+generator = torch.Generator().manual_seed(42)
+accumulator = MetricsAccumulator()
+expected_values = {}
+
+
+def add(name, value):
+    accumulator.add(name, value)
+    if isinstance(value, torch.Tensor):
+        value = value.float().mean().item()
+    expected_values.setdefault(name, []).append(float(value))
+
+
+for step in range(25):
+    device = devices[step % len(devices)]
+    # tensors from every device, in several dtypes and shapes
+    add('loss/loss', torch.rand(1, generator=generator).to(device))
+    add('loss/prior', torch.rand(4, generator=generator).to(device, dtype=torch.bfloat16))
+    add('grad_norm', torch.rand((), generator=generator).to(device, dtype=torch.float16))
+    add('nan_loss', torch.tensor(step % 7 == 0, device=device))
+    # python numbers
+    add('learning_rate', 1e-4 * (step + 1))
+    add('step', step)
+    # per key counts differ
+    if step % 3 == 0:
+        add('every_third', torch.tensor(float(step), device=device))
+    if step % 5 == 0:
+        add('mixed', float(step))
+    elif step % 5 == 1:
+        add('mixed', torch.tensor(float(step), device=devices[-1]))
+
+num_added = sum(len(values) for values in expected_values.values())
+assert len(accumulator) == num_added, f"len is {len(accumulator)}, expected {num_added}"
+
+# count the concatenations, one per device
+cat_calls = []
+original_cat = torch.cat
+
+
+def counting_cat(tensors, *args, **kwargs):
+    cat_calls.append(tensors[0].device)
+    return original_cat(tensors, *args, **kwargs)
+
+
+torch.cat = counting_cat
+try:
+    metrics = accumulator.reduce()
+finally:
+    torch.cat = original_cat
+
+failures = []
+if sorted(set(str(d) for d in cat_calls)) != sorted(set(str(torch.device(d)) for d in devices)) \
+        or len(cat_calls) != len(devices):
+    failures.append(f"concatenated on {cat_calls}, expected once on each of {devices}")
+if list(metrics.keys()) != list(expected_values.keys()):
+    failures.append(f"keys {list(metrics.keys())}, expected {list(expected_values.keys())}")
+for name, values in expected_values.items():
+    expected = sum(values) / len(values)
+    # bfloat16 and float16 values are averaged in float32
+    if name not in metrics or abs(metrics[name] - expected) > 1e-5 * max(1.0, abs(expected)):
+        failures.append(f"{name} is {metrics.get(name, None)}, expected {expected}")
+    elif not isinstance(metrics[name], float):
+        failures.append(f"{name} is a {type(metrics[name])}, expected a float")
+if len(accumulator) != 0 or accumulator.reduce() != {}:
+    failures.append('reduce did not clear the accumulator')
+
+for failure in failures:
+    print(f"FAIL {failure}")
+if len(failures) > 0:
+    sys.exit(1)
+print(f"ok   {len(metrics)} metrics from {num_added} values on {', '.join(devices)}")
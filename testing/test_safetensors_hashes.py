@@ -0,0 +1,101 @@
+import io
+import json
+import os
+import sys
+from collections import OrderedDict
+
+import torch
+from safetensors.torch import save
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from toolkit.train_tools import get_safetensors_header, addnet_hashes_for_state_dict, addnet_hash_safetensors, \
+    addnet_hash_legacy
+
+# checks that get_safetensors_header and addnet_hashes_for_state_dict match what safetensors.torch.save writes.
+# safetensors writes metadata keys in a random order (a rust HashMap), so with more than one key the header is
+# compared as the same length, tensor layout and metadata instead of byte for byte
+
+
+def get_test_cases():
+    generator = torch.Generator().manual_seed(42)
+
+    def randn(*shape, dtype=torch.float32):
+        return torch.randn(*shape, generator=generator).to(dtype)
+
+    mixed = OrderedDict([
+        ('lora_up.weight', randn(64, 8, dtype=torch.float16)),
+        ('lora_down.weight', randn(8, 64, dtype=torch.bfloat16)),
+        ('alpha', torch.tensor(8.0)),
+        ('scale', randn(3, dtype=torch.float64)),
+        ('step', torch.tensor(100, dtype=torch.int64)),
+        ('counts', torch.arange(10, dtype=torch.int32)),
+        ('ids', torch.arange(10, dtype=torch.int16)),
+        ('bytes', torch.arange(10, dtype=torch.uint8)),
+        ('signed_bytes', torch.arange(-5, 5, dtype=torch.int8)),
+        ('mask', torch.tensor([True, False, True])),
+        ('flag', torch.tensor(True)),
+        ('empty', torch.zeros(0, 4)),
+        ('empty_half', torch.zeros(0, dtype=torch.float16)),
+    ])
+    # big enough that the legacy hash window at 1mb falls inside the tensor data
+    large = OrderedDict([
+        (f"block_{i}.weight", randn(128, 256, dtype=torch.float16 if i % 2 else torch.float32)) for i in range(12)
+    ])
+    large['z_bias'] = randn(256)
+
+    return [
+        ('mixed dtypes, no metadata', mixed, None),
+        ('mixed dtypes, one metadata key', mixed, {'ss_network_dim': '8'}),
+        ('mixed dtypes, metadata', mixed, {'ss_network_dim': '8', 'ss_output_name': 'test'}),
+        ('unicode metadata', mixed, {'ss_tag': 'café 猫 \U0001F408 line\nbreak "quoted"'}),
+        ('unicode metadata, several keys', mixed, {'ss_tag': 'café 猫 \U0001F408', 'ss_note': 'line\nbreak "quoted"'}),
+        ('unicode keys', OrderedDict([('über.weight', randn(4)), ('猫', randn(2, 2))]), None),
+        ('empty metadata', mixed, {}),
+        ('only empty tensors', OrderedDict([('a', torch.zeros(0)), ('b', torch.zeros(0, 3))]), None),
+        ('only 0-d tensors', OrderedDict([('a', torch.tensor(1.5)), ('b', torch.tensor(2, dtype=torch.int8))]), None),
+        ('large', large, {'ss_network_dim': '128'}),
+    ]
+
+
+num_failed = 0
+for name, state_dict, metadata in get_test_cases():
+    file_bytes = save(state_dict, metadata=metadata)
+    failures = []
+
+    names, prefix = get_safetensors_header(state_dict, metadata)
+    file_prefix = file_bytes[:len(prefix)]
+    if metadata is None or len(metadata) <= 1:
+        if file_prefix != prefix:
+            failures.append('header bytes differ')
+    elif file_prefix[:8] != prefix[:8]:
+        failures.append('header lengths differ')
+    else:
+        file_header = json.loads(file_prefix[8:], object_pairs_hook=list)
+        header = json.loads(prefix[8:], object_pairs_hook=list)
+        if file_header[1:] != header[1:] or sorted(file_header[0][1]) != sorted(header[0][1]):
+            failures.append('headers differ')
+    # tensor data starts right after the header, in the returned order
+    position = len(prefix)
+    for tensor_name in names:
+        data = state_dict[tensor_name].reshape(-1).view(torch.uint8).numpy().tobytes()
+        if file_bytes[position:position + len(data)] != data:
+            failures.append(f"tensor {tensor_name} is not where the header order puts it")
+            break
+        position += len(data)
+    if position != len(file_bytes):
+        failures.append(f"header and tensors are {position} bytes, file is {len(file_bytes)}")
+
+    expected = (addnet_hash_safetensors(io.BytesIO(file_bytes)), addnet_hash_legacy(io.BytesIO(file_bytes)))
+    hashes = addnet_hashes_for_state_dict(state_dict, metadata)
+    if hashes != expected:
+        failures.append(f"hashes {hashes}, expected {expected}")
+
+    if len(failures) > 0:
+        num_failed += 1
+        print(f"FAIL {name}: {', '.join(failures)}")
+    else:
+        print(f"ok   {name}")
+
+if num_failed > 0:
+    print(f"{num_failed} cases failed")
+    sys.exit(1)
@@ -0,0 +1,139 @@
+import atexit
+import os
+import queue
+import threading
+import traceback
+from collections import OrderedDict
+from typing import Dict, Union
+
+import torch
+from safetensors.torch import save_file
+
+from toolkit.optimizers.optimizer_utils import Auto8bitTensor
+
+# immutable values a snapshot can share with the live state
+SNAPSHOT_IMMUTABLE_TYPES = (type(None), bool, int, float, complex, str, bytes, torch.dtype, torch.device)
+
+
+def get_temp_save_path(path: str) -> str:
+    # hidden so the retention globs never pick up a half written file
+    return os.path.join(os.path.dirname(path), f".{os.path.basename(path)}.tmp")
+
+
+def atomic_save_file(
+        state_dict: Dict[str, torch.Tensor],
+        path: str,
+        metadata: Union[dict, None] = None,
+        add_model_hash: bool = False
+):
+    if add_model_hash:
+        # hashes exactly what is written. Copied so the caller's metadata is not changed from this thread
+        from toolkit.metadata import add_model_hash_to_meta
+        metadata = add_model_hash_to_meta(state_dict, OrderedDict(metadata if metadata is not None else {}))
+    temp_path = get_temp_save_path(path)
+    save_file(state_dict, temp_path, metadata)
+    os.replace(temp_path, path)
+
+
+def atomic_torch_save(obj, path: str):
+    temp_path = get_temp_save_path(path)
+    torch.save(obj, temp_path)
+    os.replace(temp_path, path)
+
+
+class AsyncCheckpointWriter:
+    """
+    Writes checkpoints on a background thread so a save step only costs copying the state off the device.
+
+    Tensors are copied into pinned cpu buffers that are kept and reused by name, so later saves do not allocate
+    or pin memory again. Auto8bitTensor optimizer state is copied the same way, any other value that is not
+    immutable raises instead of being shared with the live state. Serializing, hashing, writing and cleanup run as
+    jobs on a single worker thread in the order they were submitted. Files are written under a temporary name and
+    renamed once complete, so an interrupted write never leaves a partial checkpoint under the real name.
+
+    Buffers are reused, so wait() has to be called before snapshotting the same state again.
+    """
+
+    def __init__(self):
+        self.buffers: Dict[str, torch.Tensor] = {}
+        self.queue = queue.Queue()
+        self._has_pending_copies = False
+        self.thread = threading.Thread(target=self._run, name='checkpoint_writer', daemon=True)
+        self.thread.start()
+        # daemon threads are killed at exit, make sure queued saves still land
+        atexit.register(self.close)
+
+    def _run(self):
+        while True:
+            job = self.queue.get()
+            try:
+                if job is None:
+                    return
+                fn, args, kwargs = job
+                fn(*args, **kwargs)
+            except Exception as e:
+                print(traceback.format_exc())
+                print(f"Error writing checkpoint in the background: {e}")
+            finally:
+                self.queue.task_done()
+
+    def snapshot_tensor(self, name: str, tensor: torch.Tensor, dtype: Union[torch.dtype, None] = None) -> torch.Tensor:
+        tensor = tensor.detach()
+        if dtype is not None:
+            # cast on the device so only the saved dtype crosses to the host
+            tensor = tensor.to(dtype)
+        buffer = self.buffers.get(name, None)
+        if buffer is None or buffer.shape != tensor.shape or buffer.dtype != tensor.dtype:
+            buffer = torch.empty(tensor.shape, dtype=tensor.dtype, device='cpu', pin_memory=torch.cuda.is_available())
+            self.buffers[name] = buffer
+        buffer.copy_(tensor, non_blocking=True)
+        self._has_pending_copies = True
+        return buffer
+
+    def snapshot(self, obj, name: str, dtype: Union[torch.dtype, None] = None):
+        # copies every tensor in nested dicts, lists and tuples (state dicts, optimizer states) to pinned buffers.
+        # Anything else that could still change while it is written raises instead of being shared
+        if isinstance(obj, torch.Tensor):
+            return self.snapshot_tensor(name, obj, dtype)
+        if isinstance(obj, Auto8bitTensor):
+            # optimizers update its quantized data and scale in place. The int8 data is never cast
+            return Auto8bitTensor({
+                'quantized': self.snapshot_tensor(f"{name}.quantized", obj.quantized),
+                'scale': obj.scale,
+                'orig_dtype': obj.orig_dtype,
+            })
+        if isinstance(obj, dict):
+            return obj.__class__([(k, self.snapshot(v, f"{name}.{k}", dtype)) for k, v in obj.items()])
+        if isinstance(obj, (list, tuple)):
+            return obj.__class__([self.snapshot(v, f"{name}.{i}", dtype) for i, v in enumerate(obj)])
+        if isinstance(obj, SNAPSHOT_IMMUTABLE_TYPES):
+            return obj
+        raise TypeError(f"Can not snapshot {name} of type {type(obj)} for a background save")
+
+    def submit(self, fn, *args, **kwargs):
+        if self._has_pending_copies:
+            # the copies into the pinned buffers have to be done before the worker reads them
+            if torch.cuda.is_available():
+                torch.cuda.synchronize()
+            self._has_pending_copies = False
+        self.queue.put((fn, args, kwargs))
+
+    def save_file(
+            self,
+            state_dict: Dict[str, torch.Tensor],
+            path: str,
+            metadata: Union[dict, None] = None,
+            add_model_hash: bool = False
+    ):
+        self.submit(atomic_save_file, state_dict, path, metadata, add_model_hash=add_model_hash)
+
+    def save_torch(self, obj, path: str):
+        self.submit(atomic_torch_save, obj, path)
+
+    def wait(self):
+        self.queue.join()
+
+    def close(self):
+        if self.thread.is_alive():
+            self.queue.put(None)
+            self.thread.join()
@@ -1,5 +1,8 @@
+from functools import lru_cache
 from typing import Type, List, Union, TypedDict
 
+import numpy as np
+
 
 class BucketResolution(TypedDict):
     width: int
@@ -172,3 +175,67 @@ def get_bucket_for_image_size(
         raise ValueError("No suitable bucket found")
 
     return closest_bucket
+
+
+@lru_cache(maxsize=None)
+def get_bucket_size_table(resolution: int = 512, divisibility: int = 8) -> np.ndarray:
+    # same buckets as get_bucket_sizes as an array of [width, height] rows, computed once per resolution
+    table = np.array(
+        [[bucket["width"], bucket["height"]] for bucket in get_bucket_sizes(resolution, divisibility)],
+        dtype=np.int64
+    )
+    table.setflags(write=False)
+    return table
+
+
+def get_buckets_for_image_sizes(
+        widths: np.ndarray,
+        heights: np.ndarray,
+        resolution: int,
+        divisibility: int = 8,
+        chunk_size: int = 65536
+) -> np.ndarray:
+    """
+    Vectorized get_bucket_for_image_size(width, height, resolution=resolution, divisibility=divisibility)
+    for many images at once. Returns an array of [width, height] bucket rows, one per image, matching the
+    scalar version exactly.
+    """
+    widths = np.asarray(widths, dtype=np.int64)
+    heights = np.asarray(heights, dtype=np.int64)
+    base_table = get_bucket_size_table(1024, 1)
+    base_widths = base_table[:, 0][None, :]
+    base_heights = base_table[:, 1][None, :]
+    buckets = np.zeros((len(widths), 2), dtype=np.int64)
+
+    for start in range(0, len(widths), chunk_size):
+        width = widths[start:start + chunk_size][:, None]
+        height = heights[start:start + chunk_size][:, None]
+
+        # images smaller than the resolution use buckets for their own resolution
+        real_resolution = np.floor(np.sqrt(width * height)).astype(np.int64)
+        if (real_resolution >= resolution).all():
+            table = get_bucket_size_table(resolution, divisibility)
+            bucket_widths = np.broadcast_to(table[:, 0][None, :], (len(width), len(table)))
+            bucket_heights = np.broadcast_to(table[:, 1][None, :], (len(width), len(table)))
+        else:
+            scaler = np.minimum(resolution, real_resolution) / 1024
+            bucket_widths = np.floor(base_widths * scaler).astype(np.int64)
+            bucket_heights = np.floor(base_heights * scaler).astype(np.int64)
+            bucket_widths -= bucket_widths % divisibility
+            bucket_heights -= bucket_heights % divisibility
+
+        exact = (bucket_widths == width) & (bucket_heights == height)
+
+        # use the larger scale factor to minimize the amount that has to be cropped
+        scale = np.maximum(bucket_widths / width, bucket_heights / height)
+        new_widths = np.floor(width * scale).astype(np.int64)
+        new_heights = np.floor(height * scale).astype(np.int64)
+        removed_pixels = (new_widths - bucket_widths) * new_heights + (new_heights - bucket_heights) * new_widths
+
+        # argmax and argmin return the first match, same as the scalar loops
+        bucket_idx = np.where(exact.any(axis=1), exact.argmax(axis=1), removed_pixels.argmin(axis=1))
+        rows = np.arange(len(bucket_idx))
+        buckets[start:start + chunk_size, 0] = bucket_widths[rows, bucket_idx]
+        buckets[start:start + chunk_size, 1] = bucket_heights[rows, bucket_idx]
+
+    return buckets
@@ -28,10 +28,45 @@ class SaveConfig:
         self.push_to_hub: bool = kwargs.get("push_to_hub", False)
         self.hf_repo_id: Optional[str] = kwargs.get("hf_repo_id", None)
         self.hf_private: Optional[str] = kwargs.get("hf_private", False)
+        # copy the state to pinned cpu memory on save steps and write it, the optimizer and cleanup on a
+        # background thread. Keeps a pinned copy of everything saved for the whole run
+        self.async_save: bool = kwargs.get("async_save", False)
+        # safetensors stores the optimizer state in shards keyed by param name, keeping 8 bit state quantized,
+        # so it loads one param group at a time and still resumes after the trained params change.
+        # pt saves the whole state_dict to optimizer.pt like before
+        self.optimizer_format: str = kwargs.get("optimizer_format", "safetensors")
+        if self.optimizer_format not in ['safetensors', 'pt']:
+            raise ValueError(f"optimizer_format must be safetensors or pt, got {self.optimizer_format}")
+
+class ProfilerConfig:
+    def __init__(self, **kwargs):
+        # record every timer span for a window of steps, then write a chrome trace and a summary with percentiles
+        self.enabled: bool = kwargs.get('enabled', False)
+        # first step of the window. Leave a few steps before it so warmup is not profiled
+        self.start_step: int = kwargs.get('start_step', 10)
+        self.num_steps: int = kwargs.get('num_steps', 20)
+        # also time every span on the gpu with cuda events. They are only read at the end of the window
+        self.device_timing: bool = kwargs.get('device_timing', True)
+        # synchronize the gpu at the start and end of every span so host times include the queued gpu work.
+        # Slows the profiled steps down
+        self.synchronize: bool = kwargs.get('synchronize', False)
+        # run torch.profiler over the window as well and write its kernel level trace
+        self.torch_profiler: bool = kwargs.get('torch_profiler', False)
+        # defaults to a profiler folder in the training folder
+        self.output_dir: Optional[str] = kwargs.get('output_dir', None)
+
 
 class LoggingConfig:
     def __init__(self, **kwargs):
         self.log_every: int = kwargs.get('log_every', 100)
+        # how often losses are read back from the device and the progress bar is updated. Values in between are
+        # averaged. Log steps always read them back
+        self.metrics_every: int = kwargs.get('metrics_every', 10)
+        # throughput and dataloader wait telemetry, reported every telemetry_every steps (defaults to log_every)
+        # to the logger and appended to telemetry.jsonl in the training folder
+        self.telemetry: bool = kwargs.get('telemetry', True)
+        self.telemetry_every: int = kwargs.get('telemetry_every', self.log_every if self.log_every else 100)
+        self.telemetry_jsonl: bool = kwargs.get('telemetry_jsonl', True)
         self.verbose: bool = kwargs.get('verbose', False)
         self.use_wandb: bool = kwargs.get('use_wandb', False)
         self.project_name: str = kwargs.get('project_name', 'ai-toolkit')
@@ -57,6 +92,9 @@ class SampleConfig:
         self.refiner_start_at = kwargs.get('refiner_start_at',
                                            0.5)  # step to start using refiner on sample if it exists
         self.extra_values = kwargs.get('extra_values', [])
+        # most samples generated in one pipeline call. Samples are batched when their size, steps, guidance and
+        # network multiplier match. Uses more vram while sampling
+        self.batch_size: int = kwargs.get('batch_size', 1)
 
 
 class LormModuleSettingsConfig:
@@ -400,6 +438,9 @@ class TrainConfig:
         self.paramiter_swapping_factor = kwargs.get('paramiter_swapping_factor', 0.1)
         # bypass the guidance embedding for training. For open flux with guidance embedding
         self.bypass_guidance_embedding = kwargs.get('bypass_guidance_embedding', False)
+        # pin batches in the dataloader and copy the next one to the device on a side stream while the current
+        # step runs. Keeps one extra batch on the device. Pinning is off the training thread when num_workers > 0
+        self.prefetch_to_device = kwargs.get('prefetch_to_device', False)
 
 
 class ModelConfig:
@@ -611,11 +652,40 @@ class DatasetConfig:
         self.poi: Union[str, None] = kwargs.get('poi',
                                                 None)  # if one is set and in json data, will be used as auto crop scale point of interes
         self.num_repeats: int = kwargs.get('num_repeats', 1)  # number of times to repeat dataset
+        # how often this dataset is sampled per epoch relative to its size when mixed with other datasets.
+        # 2.0 sees every batch twice, 0.5 sees a random half of them
+        self.sampling_weight: float = kwargs.get('sampling_weight', 1.0)
+        # stream items from the folder or dataset pack instead of loading every item up front. Items are bucketed
+        # as they are read, so memory stays bounded no matter how large the dataset is. Caching is not supported
+        self.streaming: bool = kwargs.get('streaming', False)
+        # most items held per bucket while streaming. Batches are drawn at random from full buckets, so larger
+        # values shuffle better at the cost of memory
+        self.streaming_reservoir_size: int = kwargs.get('streaming_reservoir_size', 64)
         # cache latents will store them in memory
         self.cache_latents: bool = kwargs.get('cache_latents', False)
         # cache latents to disk will store them on disk. If both are true, it will save to disk, but keep in memory
         self.cache_latents_to_disk: bool = kwargs.get('cache_latents_to_disk', False)
+        # number of images to encode through the vae at once when caching latents. Images are grouped by bucket
+        self.cache_latents_batch_size: int = kwargs.get('cache_latents_batch_size', 1)
+        # when not caching latents, keeps bucket images decoded and resized (before cropping) in a memory mapped
+        # store next to the images so they are only decoded and resized once per size. Uses a lot of disk.
+        # Skipped for poi and random_scale, which pick a new size every epoch
+        self.cache_resized_images: bool = kwargs.get('cache_resized_images', False)
+        # where resized images of a dataset pack are cached, in the folders they have in the pack. Defaults to a
+        # folder next to the pack, packs are often on read only mounts so nothing is written inside them
+        self.resized_image_cache_path: Union[str, None] = kwargs.get('resized_image_cache_path', None)
+        # store disk cached latents in a few large memory mapped shard files instead of one file per image
+        self.cache_latents_sharded: bool = kwargs.get('cache_latents_sharded', False)
         self.cache_clip_vision_to_disk: bool = kwargs.get('cache_clip_vision_to_disk', False)
+        # number of clip images to run through the vision encoder at once when caching clip vision
+        self.cache_clip_vision_batch_size: int = kwargs.get('cache_clip_vision_batch_size', 1)
+        # store cached clip vision embeddings in memory mapped shard files instead of one file per image
+        self.cache_clip_vision_sharded: bool = kwargs.get('cache_clip_vision_sharded', False)
+        # only keep the hidden state the adapter uses (its clip_layer) instead of all of them
+        self.cache_clip_vision_used_layer_only: bool = kwargs.get('cache_clip_vision_used_layer_only', False)
+        # encodes every caption once and stores the prompt embeds on disk so the text encoder can be skipped
+        # while training. Only works with static captions (no dropout, shuffling, or random triggers)
+        self.cache_text_embeddings: bool = kwargs.get('cache_text_embeddings', False)
 
         self.standardize_images: bool = kwargs.get('standardize_images', False)
 
@@ -630,6 +700,9 @@ class DatasetConfig:
             print(f"WARNING: Augments are not supported with caching latents. Setting cache_latents to False")
             self.cache_latents = False
             self.cache_latents_to_disk = False
+        if self.cache_resized_images and (self.cache_latents or self.cache_latents_to_disk):
+            # the images are only loaded once to encode them
+            self.cache_resized_images = False
 
         # legacy compatability
         legacy_caption_type = kwargs.get('caption_type', None)
@@ -654,6 +727,13 @@ class DatasetConfig:
         # apply same augmentations to control images. Usually want this true unless special case
         self.replay_transforms: bool = kwargs.get('replay_transforms', True)
 
+        has_dynamic_captions = self.caption_dropout_rate > 0 or self.token_dropout_rate > 0 or \
+            self.shuffle_tokens or len(self.random_triggers) > 0
+        if self.cache_text_embeddings and has_dynamic_captions:
+            print(f"WARNING: Caption dropout, token dropout, shuffling and random triggers are not supported with "
+                  f"caching text embeddings. Setting cache_text_embeddings to False")
+            self.cache_text_embeddings = False
+
 
 def preprocess_dataset_raw_config(raw_config: List[dict]) -> List[dict]:
     """
@@ -1,10 +1,12 @@
-import copy
 import json
+import math
 import os
 import random
+import sqlite3
 import traceback
+from concurrent.futures import ProcessPoolExecutor
 from functools import lru_cache
-from typing import List, TYPE_CHECKING
+from typing import List, Tuple, TYPE_CHECKING
 
 import cv2
 import numpy as np
@@ -12,14 +14,19 @@ import torch
 from PIL import Image
 from PIL.ImageOps import exif_transpose
 from torchvision import transforms
-from torch.utils.data import Dataset, DataLoader, ConcatDataset
+from torch.utils.data import Dataset, DataLoader, ConcatDataset, Sampler, IterableDataset, get_worker_info
 from tqdm import tqdm
 import albumentations as A
 
+from toolkit import image_utils
 from toolkit.buckets import get_bucket_for_image_size, BucketResolution
 from toolkit.config_modules import DatasetConfig, preprocess_dataset_raw_config
-from toolkit.dataloader_mixins import CaptionMixin, BucketsMixin, LatentCachingMixin, Augments, CLIPCachingMixin
+from toolkit.dataloader_mixins import CaptionMixin, BucketsMixin, LatentCachingMixin, Augments, CLIPCachingMixin, \
+    TextEmbeddingCachingMixin
 from toolkit.data_transfer_object.data_loader import FileItemDTO, DataLoaderBatchDTO
+from toolkit.dataset_metadata import get_dataset_metadata_db, get_file_stats, LEGACY_SIZE_FILENAME
+from toolkit.dataset_pack import is_dataset_pack, get_dataset_pack, get_dataset_pack_path, \
+    get_dataset_pack_shard_ranges, iter_dataset_pack_entries
 
 import platform
 
@@ -366,13 +373,33 @@ class PairedImageDataset(Dataset):
         return img, prompt, (self.neg_weight, self.pos_weight)
 
 
-class AiToolkitDataset(LatentCachingMixin, CLIPCachingMixin, BucketsMixin, CaptionMixin, Dataset):
+def get_dataset_transform(dataset_config: 'DatasetConfig', sd: 'StableDiffusion' = None):
+    if dataset_config.standardize_images:
+        if sd.is_xl or sd.is_vega or sd.is_ssd:
+            NormalizeMethod = NormalizeSDXLTransform
+        else:
+            NormalizeMethod = NormalizeSD15Transform
+
+        return transforms.Compose([
+            transforms.ToTensor(),
+            RescaleTransform(),
+            NormalizeMethod(),
+        ])
+    else:
+        return transforms.Compose([
+            transforms.ToTensor(),
+            RescaleTransform(),
+        ])
+
+
+class AiToolkitDataset(LatentCachingMixin, CLIPCachingMixin, TextEmbeddingCachingMixin, BucketsMixin, CaptionMixin, Dataset):
 
     def __init__(
             self,
             dataset_config: 'DatasetConfig',
             batch_size=1,
             sd: 'StableDiffusion' = None,
+            trigger_word: str = None,
     ):
         super().__init__()
         self.dataset_config = dataset_config
@@ -385,12 +412,16 @@ class AiToolkitDataset(LatentCachingMixin, CLIPCachingMixin, BucketsMixin, Capti
         self.is_caching_latents_to_memory = dataset_config.cache_latents
         self.is_caching_latents_to_disk = dataset_config.cache_latents_to_disk
         self.is_caching_clip_vision_to_disk = dataset_config.cache_clip_vision_to_disk
+        self.is_caching_text_embeddings = dataset_config.cache_text_embeddings
         self.epoch_num = 0
 
         self.sd = sd
+        self.trigger_word = trigger_word
 
         if self.sd is None and self.is_caching_latents:
             raise ValueError(f"sd is required for caching latents")
+        if self.sd is None and self.is_caching_text_embeddings:
+            raise ValueError(f"sd is required for caching text embeddings")
 
         self.caption_type = dataset_config.caption_ext
         self.default_caption = dataset_config.default_caption
@@ -403,8 +434,13 @@ class AiToolkitDataset(LatentCachingMixin, CLIPCachingMixin, BucketsMixin, Capti
         self.caption_dict = None
         self.file_list: List['FileItemDTO'] = []
 
+        # packed datasets are read from their index instead of walking the folder
+        self.is_dataset_pack = os.path.isdir(self.dataset_path) and is_dataset_pack(self.dataset_path)
+
         # check if dataset_path is a folder or json
-        if os.path.isdir(self.dataset_path):
+        if self.is_dataset_pack:
+            file_list = get_dataset_pack(self.dataset_path).get_image_paths()
+        elif os.path.isdir(self.dataset_path):
             file_list = [os.path.join(root, file) for root, _, files in os.walk(self.dataset_path) for file in files if file.lower().endswith(('.jpg', '.jpeg', '.png', '.webp'))]
         else:
             # assume json
@@ -417,22 +453,7 @@ class AiToolkitDataset(LatentCachingMixin, CLIPCachingMixin, BucketsMixin, Capti
             # repeat the list
             file_list = file_list * self.dataset_config.num_repeats
 
-        if self.dataset_config.standardize_images:
-            if self.sd.is_xl or self.sd.is_vega or self.sd.is_ssd:
-                NormalizeMethod = NormalizeSDXLTransform
-            else:
-                NormalizeMethod = NormalizeSD15Transform
-
-            self.transform = transforms.Compose([
-                transforms.ToTensor(),
-                RescaleTransform(),
-                NormalizeMethod(),
-            ])
-        else:
-            self.transform = transforms.Compose([
-                transforms.ToTensor(),
-                RescaleTransform(),
-            ])
+        self.transform = get_dataset_transform(self.dataset_config, self.sd)
 
         # this might take a while
         print(f"Dataset: {self.dataset_path}")
@@ -440,25 +461,29 @@ class AiToolkitDataset(LatentCachingMixin, CLIPCachingMixin, BucketsMixin, Capti
         dataset_folder = self.dataset_path
         if not os.path.isdir(self.dataset_path):
             dataset_folder = os.path.dirname(dataset_folder)
-        dataset_size_file = os.path.join(dataset_folder, '.aitk_size.json')
-        dataloader_version = "0.1.1"
-        if os.path.exists(dataset_size_file):
-            try:
-                with open(dataset_size_file, 'r') as f:
-                    self.size_database = json.load(f)
-                
-                if "__version__" not in self.size_database or self.size_database["__version__"] != dataloader_version:
-                    print("Upgrading size database to new version")
-                    # old version, delete and recreate
-                    self.size_database = {}
-            except Exception as e:
-                print(f"Error loading size database: {dataset_size_file}")
-                print(e)
-                self.size_database = {}
+        self.dataset_folder = dataset_folder
+        if self.is_dataset_pack:
+            # the pack index already has every size, there is nothing to stat or probe
+            file_stats = {}
+            self.metadata_db = None
+            self.size_database = {
+                get_dataset_pack_path(dataset_folder, entry).replace(dataset_folder, ''): (entry['width'], entry['height'])
+                for entry in get_dataset_pack(self.dataset_path).entries.values()
+            }
         else:
-            self.size_database = {}
-        
-        self.size_database["__version__"] = dataloader_version
+            # sizes are only trusted while the file's mtime and size match, so only new or changed files are read
+            file_stats = get_file_stats(file_list, dataset_folder)
+            self.metadata_db = get_dataset_metadata_db(dataset_folder)
+            if self.metadata_db is not None:
+                num_imported = self.metadata_db.import_legacy_size_file(file_stats)
+                if num_imported > 0:
+                    print(f"  -  Imported {num_imported} image sizes from {LEGACY_SIZE_FILENAME}")
+                self.size_database = self.metadata_db.get_sizes(file_stats)
+            else:
+                self.size_database = {}
+        known_size_keys = set(self.size_database.keys())
+
+        self.probe_image_sizes(file_list, dataset_folder)
 
         bad_count = 0
         for file in tqdm(file_list):
@@ -470,6 +495,8 @@ class AiToolkitDataset(LatentCachingMixin, CLIPCachingMixin, BucketsMixin, Capti
                     dataloader_transforms=self.transform,
                     size_database=self.size_database,
                     dataset_root=dataset_folder,
+                    dataset_pack_root=self.dataset_path if self.is_dataset_pack else None,
+                    dataset_pack_entry=get_dataset_pack(self.dataset_path).get_entry(file) if self.is_dataset_pack else None,
                 )
                 self.file_list.append(file_item)
             except Exception as e:
@@ -478,36 +505,41 @@ class AiToolkitDataset(LatentCachingMixin, CLIPCachingMixin, BucketsMixin, Capti
                 print(e)
                 bad_count += 1
 
-        # save the size database
-        with open(dataset_size_file, 'w') as f:
-            json.dump(self.size_database, f)
+        # only write the sizes we did not already have
+        if self.metadata_db is not None:
+            new_sizes = {
+                k: v for k, v in self.size_database.items() if k not in known_size_keys and k in file_stats
+            }
+            self.metadata_db.set_sizes(new_sizes, file_stats)
 
         print(f"  -  Found {len(self.file_list)} images")
         # print(f"  -  Found {bad_count} images that are too small")
         assert len(self.file_list) > 0, f"no images found in {self.dataset_path}"
 
-        # handle x axis flips
+        # (flip_x, flip_y) for each pass over file_list. Index i is file_list[i % len(file_list)] with the flips of
+        # flip_variants[i // len(file_list)], so flips do not duplicate file items
+        self.flip_variants: List[Tuple[bool, bool]] = [(False, False)]
         if self.dataset_config.flip_x:
             print("  -  adding x axis flips")
-            current_file_list = [x for x in self.file_list]
-            for file_item in current_file_list:
-                # create a copy that is flipped on the x axis
-                new_file_item = copy.deepcopy(file_item)
-                new_file_item.flip_x = True
-                self.file_list.append(new_file_item)
-
-        # handle y axis flips
+            self.flip_variants += [(True, flip_y) for _, flip_y in self.flip_variants]
         if self.dataset_config.flip_y:
             print("  -  adding y axis flips")
-            current_file_list = [x for x in self.file_list]
-            for file_item in current_file_list:
-                # create a copy that is flipped on the y axis
-                new_file_item = copy.deepcopy(file_item)
-                new_file_item.flip_y = True
-                self.file_list.append(new_file_item)
+            self.flip_variants += [(flip_x, True) for flip_x, _ in self.flip_variants]
+
+        if len(self.flip_variants) > 1 and (self.is_caching_latents or self.is_caching_clip_vision_to_disk):
+            # flipped images have their own cached latents and clip vision embeds, so they need their own file items
+            base_file_list = self.file_list
+            self.file_list = list(base_file_list)
+            for flip_x, flip_y in self.flip_variants[1:]:
+                for file_item in base_file_list:
+                    new_file_item = file_item.get_fetch_copy()
+                    new_file_item.flip_x = flip_x
+                    new_file_item.flip_y = flip_y
+                    self.file_list.append(new_file_item)
+            self.flip_variants = [(False, False)]
 
         if self.dataset_config.flip_x or self.dataset_config.flip_y:
-            print(f"  -  Found {len(self.file_list)} images after adding flips")
+            print(f"  -  Found {self.get_num_items()} images after adding flips")
 
 
         self.setup_epoch()
@@ -523,6 +555,8 @@ class AiToolkitDataset(LatentCachingMixin, CLIPCachingMixin, BucketsMixin, Capti
                 self.cache_latents_all_latents()
             if self.is_caching_clip_vision_to_disk:
                 self.cache_clip_vision_to_disk()
+            if self.is_caching_text_embeddings:
+                self.cache_text_embeddings()
         else:
             if self.dataset_config.poi is not None:
                 # handle cropping to a specific point of interest
@@ -530,15 +564,66 @@ class AiToolkitDataset(LatentCachingMixin, CLIPCachingMixin, BucketsMixin, Capti
                 self.setup_buckets(quiet=True)
         self.epoch_num += 1
 
+    def update_cache_status(self, column: str, is_cached_fn):
+        # record what is cached on disk in the metadata database. Flipped copies share a path,
+        # so a path only counts as cached when all of its items are
+        if self.metadata_db is None:
+            return
+        status = {}
+        for file_item in self.file_list:
+            file_key = self.metadata_db.get_file_key(file_item.path)
+            status[file_key] = status.get(file_key, True) and bool(is_cached_fn(file_item))
+        try:
+            self.metadata_db.set_cache_status(column, [k for k, v in status.items() if v])
+        except sqlite3.Error as e:
+            print(f"Warning: could not update dataset metadata database: {e}")
+
+    def probe_image_sizes(self, file_list: List[str], dataset_folder: str):
+        # read the sizes of images missing from the size database from their headers in a process pool.
+        # File items then find them in the database instead of opening images one at a time
+        to_probe = []
+        for file in set(file_list):
+            file_key = file.replace(dataset_folder, '')
+            if file_key not in self.size_database:
+                to_probe.append(file)
+        if len(to_probe) == 0:
+            return
+
+        num_workers = os.cpu_count() or 1
+        if is_native_windows() or num_workers < 2 or len(to_probe) < 1000:
+            # not worth starting processes
+            sizes = [image_utils.probe_oriented_image_size(file) for file in tqdm(to_probe)]
+        else:
+            chunksize = max(1, min(256, len(to_probe) // (num_workers * 4)))
+            with ProcessPoolExecutor(max_workers=num_workers) as executor:
+                sizes = list(tqdm(
+                    executor.map(image_utils.probe_oriented_image_size, to_probe, chunksize=chunksize),
+                    total=len(to_probe)
+                ))
+
+        for file, size in zip(to_probe, sizes):
+            # failures are left out, the file item will decode the image to get its size
+            if size is not None:
+                self.size_database[file.replace(dataset_folder, '')] = size
+
+    def get_num_items(self) -> int:
+        # file items times flip variants
+        return len(self.file_list) * len(self.flip_variants)
+
     def __len__(self):
         if self.dataset_config.buckets:
             return len(self.batch_indices)
-        return len(self.file_list)
+        return self.get_num_items()
 
     def _get_single_item(self, index) -> 'FileItemDTO':
-        file_item = copy.deepcopy(self.file_list[index])
+        file_item = self.file_list[index % len(self.file_list)].get_fetch_copy()
+        flip_variant = index // len(self.file_list)
+        if flip_variant > 0:
+            file_item.flip_x, file_item.flip_y = self.flip_variants[flip_variant]
         file_item.load_and_process_image(self.transform)
         file_item.load_caption(self.caption_dict)
+        if file_item.is_text_embedding_cached:
+            file_item.load_text_embedding()
         return file_item
 
     def __getitem__(self, item):
@@ -556,10 +641,264 @@ class AiToolkitDataset(LatentCachingMixin, CLIPCachingMixin, BucketsMixin, Capti
             return self._get_single_item(item)
 
 
+# items are bucketed this many at a time while streaming
+STREAMING_CHUNK_SIZE = 256
+
+
+class AiToolkitStreamingDataset(BucketsMixin, IterableDataset):
+    """
+    Streams file items from a dataset folder or pack instead of building all of them up front.
+
+    Shards of a pack, or folders of a plain dataset, are read in a random order each epoch and file items are
+    created as they are read. They are bucketed a chunk at a time into per bucket reservoirs that hold at most
+    streaming_reservoir_size items, and once a reservoir is full a random batch is drawn from it. Memory is
+    bounded by the number of buckets, not the size of the dataset. Dataloader workers each take every
+    num_workers-th item of the stream, so every item is still seen once per epoch.
+
+    Yields whole batches. Latent, clip vision and text embedding caching need every item up front and are
+    not supported.
+    """
+
+    def __init__(
+            self,
+            dataset_config: 'DatasetConfig',
+            batch_size=1,
+            sd: 'StableDiffusion' = None,
+            trigger_word: str = None,
+    ):
+        super().__init__()
+        self.dataset_config = dataset_config
+        self.dataset_path = dataset_config.dataset_path
+        if self.dataset_path is None:
+            self.dataset_path = dataset_config.folder_path
+        self.batch_size = batch_size
+        self.sd = sd
+        self.trigger_word = trigger_word
+        self.epoch_num = 0
+
+        if not os.path.isdir(self.dataset_path):
+            raise ValueError(f"streaming datasets need a folder or dataset pack, got {self.dataset_path}")
+        if dataset_config.cache_latents or dataset_config.cache_latents_to_disk or \
+                dataset_config.cache_clip_vision_to_disk or dataset_config.cache_text_embeddings:
+            raise ValueError(f"caching is not supported with streaming datasets: {self.dataset_path}")
+
+        self.transform = get_dataset_transform(dataset_config, sd)
+        self.is_dataset_pack = is_dataset_pack(self.dataset_path)
+
+        # only the shards or folders are listed up front, their files are read as they are streamed
+        print(f"Dataset: {self.dataset_path}")
+        if self.is_dataset_pack:
+            self.sources = get_dataset_pack_shard_ranges(self.dataset_path)
+            print(f"  -  Streaming {len(self.sources)} shards")
+        else:
+            self.sources = [root for root, _, _ in os.walk(self.dataset_path)]
+            print(f"  -  Streaming {len(self.sources)} folders")
+
+    def setup_epoch(self):
+        # the stream is reshuffled every time it is iterated
+        self.epoch_num += 1
+
+    def iter_source_files(self, rng: random.Random):
+        # (path, pack entry) for every image, shards or folders in a random order
+        sources = list(self.sources)
+        rng.shuffle(sources)
+        for source in sources:
+            if self.is_dataset_pack:
+                shard, start, end = source
+                for entry in iter_dataset_pack_entries(self.dataset_path, start, end):
+                    yield get_dataset_pack_path(self.dataset_path, entry), entry
+            else:
+                with os.scandir(source) as it:
+                    files = sorted([
+                        x.name for x in it if x.is_file() and x.name.lower().endswith(('.jpg', '.jpeg', '.png', '.webp'))
+                    ])
+                rng.shuffle(files)
+                for file in files:
+                    yield os.path.join(source, file), None
+
+    def iter_file_items(self):
+        worker_info = get_worker_info()
+        if worker_info is None:
+            worker_id, num_workers = 0, 1
+            seed = random.randint(0, 2 ** 32 - 1)
+        else:
+            # workers get seed + id from a seed drawn for every new iterator, so they agree on the order
+            worker_id, num_workers = worker_info.id, worker_info.num_workers
+            seed = worker_info.seed - worker_info.id
+        rng = random.Random(seed)
+
+        idx = 0
+        for _ in range(self.dataset_config.num_repeats):
+            for path, entry in self.iter_source_files(rng):
+                idx += 1
+                if (idx - 1) % num_workers != worker_id:
+                    continue
+                size_database = {}
+                if entry is not None:
+                    size_database[os.path.basename(path)] = (entry['width'], entry['height'])
+                try:
+                    file_item = FileItemDTO(
+                        sd=self.sd,
+                        path=path,
+                        dataset_config=self.dataset_config,
+                        dataloader_transforms=self.transform,
+                        size_database=size_database,
+                        dataset_pack_root=self.dataset_path if entry is not None else None,
+                        dataset_pack_entry=entry,
+                    )
+                except Exception as e:
+                    print(traceback.format_exc())
+                    print(f"Error processing image: {path}")
+                    print(e)
+                    continue
+
+                # flipped copies, same as AiToolkitDataset adds them
+                file_items = [file_item]
+                if self.dataset_config.flip_x:
+                    flipped = file_item.get_fetch_copy()
+                    flipped.flip_x = True
+                    file_items.append(flipped)
+                if self.dataset_config.flip_y:
+                    for x in list(file_items):
+                        flipped = x.get_fetch_copy()
+                        flipped.flip_y = True
+                        file_items.append(flipped)
+                for x in file_items:
+                    yield x
+
+    def load_batch(self, file_items: List['FileItemDTO']) -> List['FileItemDTO']:
+        # streamed items are not shared, so they are loaded in place
+        for file_item in file_items:
+            file_item.load_and_process_image(self.transform)
+            file_item.load_caption(None)
+        return file_items
+
+    def add_to_reservoirs(self, file_items: List['FileItemDTO'], reservoirs: dict, reservoir_size: int):
+        if self.dataset_config.buckets:
+            bucket_keys = self.assign_buckets(file_items)
+        else:
+            # the dataloader would batch these as they come
+            bucket_keys = [''] * len(file_items)
+        for file_item, bucket_key in zip(file_items, bucket_keys):
+            reservoir = reservoirs.setdefault(bucket_key, [])
+            reservoir.append(file_item)
+            if len(reservoir) >= reservoir_size:
+                # draw a random batch out of the full reservoir
+                random.shuffle(reservoir)
+                batch = reservoir[-self.batch_size:]
+                del reservoir[-self.batch_size:]
+                yield self.load_batch(batch)
+
+    def __iter__(self):
+        reservoir_size = max(self.dataset_config.streaming_reservoir_size, self.batch_size)
+        reservoirs = {}
+        chunk = []
+        for file_item in self.iter_file_items():
+            chunk.append(file_item)
+            if len(chunk) >= STREAMING_CHUNK_SIZE:
+                yield from self.add_to_reservoirs(chunk, reservoirs, reservoir_size)
+                chunk = []
+        yield from self.add_to_reservoirs(chunk, reservoirs, reservoir_size)
+
+        # end of the stream, empty what is left in the reservoirs
+        batches = []
+        for reservoir in reservoirs.values():
+            random.shuffle(reservoir)
+            for start in range(0, len(reservoir), self.batch_size):
+                batches.append(reservoir[start:start + self.batch_size])
+        random.shuffle(batches)
+        for batch in batches:
+            yield self.load_batch(batch)
+
+
+class StreamingDatasetMixer(IterableDataset):
+    """
+    Interleaves the batches of several streaming datasets. The next batch comes from a random dataset weighted
+    by its sampling_weight, until every dataset has run out.
+    """
+
+    def __init__(self, datasets: List[AiToolkitStreamingDataset]):
+        super().__init__()
+        self.datasets = datasets
+
+    def __iter__(self):
+        datasets = [dataset for dataset in self.datasets if dataset.dataset_config.sampling_weight > 0]
+        iterators = [iter(dataset) for dataset in datasets]
+        weights = [dataset.dataset_config.sampling_weight for dataset in datasets]
+        while len(iterators) > 0:
+            idx = random.choices(range(len(iterators)), weights=weights)[0]
+            try:
+                yield next(iterators[idx])
+            except StopIteration:
+                del iterators[idx]
+                del weights[idx]
+
+
+class ConcatDatasetBatchSampler(Sampler):
+    """
+    Builds the batches for every dataset in a ConcatDataset and shuffles them together, so datasets
+    and buckets are interleaved instead of only shuffled within their own dataset. Each dataset is
+    sampled len(dataset) * sampling_weight times per epoch.
+
+    With buckets, datasets return a whole bucket batch per index, so every batch here is a single index.
+    Without them, item indices from all datasets are shuffled and chunked into batches.
+
+    The batches for an epoch are built when the iterator is created, before workers copy the datasets, so
+    they always match the dataset state the workers see.
+    """
+
+    def __init__(self, concat_dataset: ConcatDataset, batch_size: int = 1, has_buckets: bool = False):
+        super().__init__(None)
+        self.concat_dataset = concat_dataset
+        self.batch_size = batch_size
+        self.has_buckets = has_buckets
+
+    def get_sample_counts(self) -> List[int]:
+        return [
+            int(round(len(dataset) * dataset.dataset_config.sampling_weight))
+            for dataset in self.concat_dataset.datasets
+        ]
+
+    def sample_indices(self, size: int, count: int) -> List[int]:
+        # whole shuffled passes over the dataset, then a random part of one for the remainder
+        indices = []
+        for _ in range(count // size):
+            indices += torch.randperm(size).tolist()
+        indices += torch.randperm(size)[:count % size].tolist()
+        return indices
+
+    def build_batches(self) -> List[List[int]]:
+        # dataset lengths change when buckets are rebuilt, keep the offsets current
+        self.concat_dataset.cumulative_sizes = self.concat_dataset.cumsum(self.concat_dataset.datasets)
+        indices = []
+        offset = 0
+        for dataset, count in zip(self.concat_dataset.datasets, self.get_sample_counts()):
+            size = len(dataset)
+            if size > 0 and count > 0:
+                indices += [offset + idx for idx in self.sample_indices(size, count)]
+            offset += size
+        indices = [indices[i] for i in torch.randperm(len(indices)).tolist()]
+
+        if self.has_buckets:
+            return [[idx] for idx in indices]
+        return [indices[i:i + self.batch_size] for i in range(0, len(indices), self.batch_size)]
+
+    def __iter__(self):
+        return iter(self.build_batches())
+
+    def __len__(self):
+        num_samples = sum(self.get_sample_counts())
+        if self.has_buckets:
+            return num_samples
+        return int(math.ceil(num_samples / self.batch_size))
+
+
 def get_dataloader_from_datasets(
         dataset_options,
         batch_size=1,
         sd: 'StableDiffusion' = None,
+        trigger_word: str = None,
+        pin_memory: bool = False,
 ) -> DataLoader:
     if dataset_options is None or len(dataset_options) == 0:
         return None
@@ -567,6 +906,7 @@ def get_dataloader_from_datasets(
     datasets = []
     has_buckets = False
     is_caching_latents = False
+    is_streaming = False
 
     dataset_config_list = []
     # preprocess them all
@@ -582,7 +922,11 @@ def get_dataloader_from_datasets(
     for config in dataset_config_list:
 
         if config.type == 'image':
-            dataset = AiToolkitDataset(config, batch_size=batch_size, sd=sd)
+            if config.streaming:
+                dataset = AiToolkitStreamingDataset(config, batch_size=batch_size, sd=sd, trigger_word=trigger_word)
+                is_streaming = True
+            else:
+                dataset = AiToolkitDataset(config, batch_size=batch_size, sd=sd, trigger_word=trigger_word)
             datasets.append(dataset)
             if config.buckets:
                 has_buckets = True
@@ -591,52 +935,109 @@ def get_dataloader_from_datasets(
         else:
             raise ValueError(f"invalid dataset type: {config.type}")
 
-    concatenated_dataset = ConcatDataset(datasets)
+    if is_streaming:
+        for dataset in datasets:
+            assert dataset.dataset_config.streaming, f"streaming not set on dataset {dataset.dataset_config.folder_path}, you either need all streaming or none"
 
-    # todo build scheduler that can get buckets from all datasets that match
-    # todo and evenly distribute reg images
+    # todo evenly distribute reg images
 
     def dto_collation(batch: List['FileItemDTO']):
+        if has_buckets:
+            # datasets return whole bucket batches
+            batch = [file_item for bucket_batch in batch for file_item in bucket_batch]
         # create DTO batch
         batch = DataLoaderBatchDTO(
             file_items=batch
         )
         return batch
 
-    # check if is caching latents
-
-    dataloader_kwargs = {}
-    
-    if is_native_windows():
-        dataloader_kwargs['num_workers'] = 0
-    else:
-        dataloader_kwargs['num_workers'] = dataset_config_list[0].num_workers
-        dataloader_kwargs['prefetch_factor'] = dataset_config_list[0].prefetch_factor
-
     if has_buckets:
         # make sure they all have buckets
         for dataset in datasets:
             assert dataset.dataset_config.buckets, f"buckets not found on dataset {dataset.dataset_config.folder_path}, you either need all buckets or none"
 
-        data_loader = DataLoader(
-            concatenated_dataset,
-            batch_size=None,  # we batch in the datasets for now
-            drop_last=False,
-            shuffle=True,
-            collate_fn=dto_collation,  # Use the custom collate function
-            **dataloader_kwargs
-        )
+    # one loader serves every dataset, so use the most workers any of them asked for
+    dataloader_kwargs = {}
+    if is_native_windows():
+        dataloader_kwargs['num_workers'] = 0
     else:
-        data_loader = DataLoader(
-            concatenated_dataset,
-            batch_size=batch_size,
-            shuffle=True,
-            collate_fn=dto_collation,
+        dataloader_kwargs['num_workers'] = max([config.num_workers for config in dataset_config_list])
+        if dataloader_kwargs['num_workers'] > 0:
+            dataloader_kwargs['prefetch_factor'] = max([config.prefetch_factor for config in dataset_config_list])
+    # the DataLoader pins batches with DataLoaderBatchDTO.pin_memory. With workers that runs in its pin memory
+    # thread, off the training thread
+    if pin_memory and torch.cuda.is_available():
+        dataloader_kwargs['pin_memory'] = True
+
+    if is_streaming:
+        def stream_collation(batch: List['FileItemDTO']):
+            # streaming datasets yield whole batches
+            return DataLoaderBatchDTO(
+                file_items=batch
+            )
+
+        return DataLoader(
+            StreamingDatasetMixer(datasets),
+            batch_size=None,
+            collate_fn=stream_collation,
             **dataloader_kwargs
         )
+
+    concatenated_dataset = ConcatDataset(datasets)
+    data_loader = DataLoader(
+        concatenated_dataset,
+        batch_sampler=ConcatDatasetBatchSampler(concatenated_dataset, batch_size=batch_size, has_buckets=has_buckets),
+        collate_fn=dto_collation,
+        **dataloader_kwargs
+    )
     return data_loader
 
 
+class DevicePrefetcher:
+    """
+    Wraps a dataloader iterator and moves the next batch to the device while the current one is used.
+    On cuda, batches are copied with non blocking transfers on a side stream. Pinning is left to the dataloader
+    (get_dataloader_from_datasets with pin_memory), only pinned batches are copied asynchronously. On other
+    devices it is a plain pass through with the same interface.
+    """
+
+    def __init__(self, iterator, device):
+        self.iterator = iterator
+        self.device = torch.device(device)
+        self.use_cuda = self.device.type == 'cuda' and torch.cuda.is_available()
+        self.stream = torch.cuda.Stream(device=self.device) if self.use_cuda else None
+        self.next_batch = None
+        self.is_exhausted = False
+        self.preload()
+
+    def preload(self):
+        try:
+            batch = next(self.iterator)
+        except StopIteration:
+            self.next_batch = None
+            self.is_exhausted = True
+            return
+        if self.use_cuda and isinstance(batch, DataLoaderBatchDTO):
+            with torch.cuda.stream(self.stream):
+                batch.to_device(self.device, non_blocking=True)
+        self.next_batch = batch
+
+    def __iter__(self):
+        return self
+
+    def __next__(self) -> 'DataLoaderBatchDTO':
+        if self.is_exhausted:
+            raise StopIteration
+        batch = self.next_batch
+        if self.use_cuda and isinstance(batch, DataLoaderBatchDTO):
+            current_stream = torch.cuda.current_stream(self.device)
+            current_stream.wait_stream(self.stream)
+            batch.record_stream(current_stream)
+        # start on the next one before handing this one back
+        self.preload()
+        return batch
+
+
 def trigger_dataloader_setup_epoch(dataloader: DataLoader):
     # hacky but needed because of different types of datasets and dataloaders
     dataloader.len = None
@@ -1,3 +1,4 @@
+import copy
 import os
 import weakref
 from _weakref import ReferenceType
@@ -11,7 +12,8 @@ from PIL.ImageOps import exif_transpose
 from toolkit import image_utils
 from toolkit.dataloader_mixins import CaptionProcessingDTOMixin, ImageProcessingDTOMixin, LatentCachingFileItemDTOMixin, \
     ControlFileItemDTOMixin, ArgBreakMixin, PoiFileItemDTOMixin, MaskFileItemDTOMixin, AugmentationFileItemDTOMixin, \
-    UnconditionalFileItemDTOMixin, ClipImageFileItemDTOMixin
+    UnconditionalFileItemDTOMixin, ClipImageFileItemDTOMixin, TextEmbeddingFileItemDTOMixin
+from toolkit.prompt_utils import PromptEmbeds, concat_prompt_embeds
 
 
 if TYPE_CHECKING:
@@ -38,11 +40,15 @@ class FileItemDTO(
     AugmentationFileItemDTOMixin,
     UnconditionalFileItemDTOMixin,
     PoiFileItemDTOMixin,
+    TextEmbeddingFileItemDTOMixin,
     ArgBreakMixin,
 ):
     def __init__(self, *args, **kwargs):
         self.path = kwargs.get('path', '')
         self.dataset_config: 'DatasetConfig' = kwargs.get('dataset_config', None)
+        # set when the image lives in a packed dataset instead of on disk
+        self.dataset_pack_root: Union[str, None] = kwargs.get('dataset_pack_root', None)
+        self.dataset_pack_entry: Union[dict, None] = kwargs.get('dataset_pack_entry', None)
         size_database = kwargs.get('size_database', {})
         dataset_root =  kwargs.get('dataset_root', None)
         if dataset_root is not None:
@@ -53,15 +59,15 @@ class FileItemDTO(
         if file_key in size_database:
             w, h = size_database[file_key]
         else:
-            # original method is significantly faster, but some images are read sideways. Not sure why. Do slow method for now.
-            # process width and height
-            # try:
-            #     w, h = image_utils.get_image_size(self.path)
-            # except image_utils.UnknownImageFormat:
-            #     print_once(f'Warning: Some images in the dataset cannot be fast read. ' + \
-            #                f'This process is faster for png, jpeg')
-            img = exif_transpose(Image.open(self.path))
-            w, h = img.size
+            # read the size from the header, accounting for exif rotation
+            size = image_utils.probe_oriented_image_size(self.path)
+            if size is not None:
+                w, h = size
+            else:
+                print_once(f'Warning: Some images in the dataset cannot be read from the header. ' + \
+                           f'Decoding them to get their size')
+                img = exif_transpose(Image.open(self.path))
+                w, h = img.size
             size_database[file_key] = (w, h)
         self.width: int = w
         self.height: int = h
@@ -87,6 +93,12 @@ class FileItemDTO(
         self.is_reg = self.dataset_config.is_reg
         self.tensor: Union[torch.Tensor, None] = None
 
+    def get_fetch_copy(self) -> 'FileItemDTO':
+        # everything a fetch loads (tensors, latents, captions, embeds) is assigned, never mutated in place,
+        # so a shallow copy is enough. Configs, processors and transforms stay shared with the dataset
+        # instead of being deep copied on every fetch
+        return copy.copy(self)
+
     def cleanup(self):
         self.tensor = None
         self.cleanup_latent()
@@ -94,6 +106,7 @@ class FileItemDTO(
         self.cleanup_clip_image()
         self.cleanup_mask()
         self.cleanup_unconditional()
+        self.cleanup_text_embedding()
 
 
 class DataLoaderBatchDTO:
@@ -112,6 +125,7 @@ class DataLoaderBatchDTO:
             self.clip_image_embeds: Union[List[dict], None] = None
             self.clip_image_embeds_unconditional: Union[List[dict], None] = None
             self.sigmas: Union[torch.Tensor, None] = None  # can be added elseware and passed along training code
+            self.prompt_embeds: Union[PromptEmbeds, None] = None
             self.extra_values: Union[torch.Tensor, None] = torch.tensor([x.extra_values for x in self.file_items]) if len(self.file_items[0].extra_values) > 0 else None
             if not is_latents_cached:
                 # only return a tensor if latents are not cached
@@ -218,10 +232,50 @@ class DataLoaderBatchDTO:
                     else:
                         raise Exception("clip_image_embeds_unconditional is None for some file items")
 
+            # cached text embeddings are only usable if every item in the batch has one
+            if all([x.prompt_embeds is not None for x in self.file_items]):
+                text_embeds_shapes = set([tuple(x.prompt_embeds.text_embeds.shape) for x in self.file_items])
+                if len(text_embeds_shapes) == 1:
+                    self.prompt_embeds = concat_prompt_embeds([x.prompt_embeds for x in self.file_items])
+
         except Exception as e:
             print(e)
             raise e
 
+    # batch tensors that can be pinned and moved to the device ahead of time
+    device_tensor_names = [
+        'tensor',
+        'latents',
+        'control_tensor',
+        'clip_image_tensor',
+        'mask_tensor',
+        'unaugmented_tensor',
+        'unconditional_tensor',
+        'unconditional_latents',
+    ]
+
+    def pin_memory(self):
+        # also called by the DataLoader when pin_memory is set
+        for name in self.device_tensor_names:
+            tensor = getattr(self, name)
+            if tensor is not None and tensor.device.type == 'cpu':
+                setattr(self, name, tensor.pin_memory())
+        return self
+
+    def to_device(self, device, non_blocking=False):
+        for name in self.device_tensor_names:
+            tensor = getattr(self, name)
+            if tensor is not None:
+                setattr(self, name, tensor.to(device, non_blocking=non_blocking))
+        return self
+
+    def record_stream(self, stream):
+        # tensors copied on a side stream must be marked as used by the stream that consumes them
+        for name in self.device_tensor_names:
+            tensor = getattr(self, name)
+            if tensor is not None and tensor.is_cuda:
+                tensor.record_stream(stream)
+
     def get_is_reg_list(self):
         return [x.is_reg for x in self.file_items]
 
@@ -244,6 +298,9 @@ class DataLoaderBatchDTO:
     ):
         return [x.caption_short for x in self.file_items]
 
+    def get_text_embedding_caption_list(self):
+        return [x.text_embedding_caption for x in self.file_items]
+
     def cleanup(self):
         del self.latents
         del self.tensor
@@ -1,6 +1,7 @@
 import base64
 import glob
 import hashlib
+import io
 import json
 import math
 import os
@@ -11,15 +12,19 @@ from typing import TYPE_CHECKING, List, Dict, Union
 import cv2
 import numpy as np
 import torch
+from safetensors import safe_open
 from safetensors.torch import load_file, save_file
 from tqdm import tqdm
 from transformers import CLIPImageProcessor, CLIPVisionModelWithProjection, SiglipImageProcessor
 
 from toolkit.basic import flush, value_map
-from toolkit.buckets import get_bucket_for_image_size, get_resolution
+from toolkit.buckets import get_bucket_for_image_size, get_resolution, get_buckets_for_image_sizes, BucketResolution
+from toolkit.dataset_pack import get_dataset_pack, get_dataset_pack_reader
 from toolkit.metadata import get_meta_for_safetensors
 from toolkit.models.pixtral_vision import PixtralVisionImagePreprocessorCompatible
-from toolkit.prompt_utils import inject_trigger_into_prompt
+from toolkit.prompt_utils import inject_trigger_into_prompt, PromptEmbeds
+from toolkit.sharded_store import get_sharded_store
+from torch.utils.data import Dataset, DataLoader
 from torchvision import transforms
 from PIL import Image, ImageFilter, ImageOps
 from PIL.ImageOps import exif_transpose
@@ -197,21 +202,81 @@ class BucketsMixin:
             return
         self.buckets = {}  # clear it
 
+        # flipped variants share their file item's crop, so they go in the same bucket
+        num_file_items = len(self.file_list)
+        num_flip_variants = len(getattr(self, 'flip_variants', [(False, False)]))
+        for idx, bucket_key in enumerate(self.assign_buckets(self.file_list)):
+            # check if bucket exists, if not, create it
+            if bucket_key not in self.buckets:
+                file_item = self.file_list[idx]
+                self.buckets[bucket_key] = Bucket(file_item.crop_width, file_item.crop_height)
+            for flip_variant in range(num_flip_variants):
+                self.buckets[bucket_key].file_list_idx.append(idx + flip_variant * num_file_items)
+
+        # print the buckets
+        self.shuffle_buckets()
+        self.build_batch_indices()
+        if not quiet:
+            print(f'Bucket sizes for {self.dataset_path}:')
+            for key, bucket in self.buckets.items():
+                print(f'{key}: {len(bucket.file_list_idx)} files')
+            print(f'{len(self.buckets)} buckets made')
+
+    def assign_buckets(self: 'AiToolkitDataset', file_list: List['FileItemDTO']) -> List[str]:
+        # sets the scale and crop of each file item for its bucket and returns their bucket keys
         config: 'DatasetConfig' = self.dataset_config
         resolution = config.resolution
         bucket_tolerance = config.bucket_tolerance
-        file_list: List['FileItemDTO'] = self.file_list
+        bucket_keys = []
+
+        # poi crops are random, so they are picked first and bucketed along with everything else
+        poi_crops = {}
+        for idx, file_item in enumerate(file_list):
+            if file_item.has_point_of_interest and not self.dataset_config.square_crop:
+                # It wont pick a crop if the image is smaller than the resolution, normal bucketing happens then
+                poi_crop = file_item.get_poi_crop()
+                if poi_crop is not None:
+                    poi_crops[idx] = poi_crop
+
+        # sizes to bucket, all at once
+        widths = np.zeros(len(file_list), dtype=np.int64)
+        heights = np.zeros(len(file_list), dtype=np.int64)
+        for idx, file_item in enumerate(file_list):
+            if idx in poi_crops:
+                widths[idx] = poi_crops[idx][2]
+                heights[idx] = poi_crops[idx][3]
+            else:
+                widths[idx] = int(file_item.width * file_item.dataset_config.scale)
+                heights[idx] = int(file_item.height * file_item.dataset_config.scale)
+
+        if not self.dataset_config.square_crop and len(file_list) > 0:
+            bucket_resolutions = get_buckets_for_image_sizes(
+                widths, heights,
+                resolution=resolution,
+                divisibility=bucket_tolerance
+            )
+            bucket_widths = bucket_resolutions[:, 0]
+            bucket_heights = bucket_resolutions[:, 1]
+            # Use the maximum of the scale factors to ensure both dimensions are scaled above the bucket resolution
+            max_scale_factors = np.maximum(bucket_widths / widths, bucket_heights / heights)
+            # round up
+            scale_to_widths = np.ceil(widths * max_scale_factors).astype(np.int64)
+            scale_to_heights = np.ceil(heights * max_scale_factors).astype(np.int64)
+
+            bucket_widths = bucket_widths.tolist()
+            bucket_heights = bucket_heights.tolist()
+            max_scale_factors = max_scale_factors.tolist()
+            scale_to_widths = scale_to_widths.tolist()
+            scale_to_heights = scale_to_heights.tolist()
+
+        widths = widths.tolist()
+        heights = heights.tolist()
 
-        # for file_item in enumerate(file_list):
         for idx, file_item in enumerate(file_list):
             file_item: 'FileItemDTO' = file_item
-            width = int(file_item.width * file_item.dataset_config.scale)
-            height = int(file_item.height * file_item.dataset_config.scale)
+            width = widths[idx]
+            height = heights[idx]
 
-            did_process_poi = False
-            if file_item.has_point_of_interest:
-                # Attempt to process the poi if we can. It wont process if the image is smaller than the resolution
-                did_process_poi = file_item.setup_poi_bucket()
             if self.dataset_config.square_crop:
                 # we scale first so smallest size matches resolution
                 scale_factor_x = resolution / width
@@ -227,29 +292,20 @@ class BucketsMixin:
                 else:
                     file_item.crop_x = 0
                     file_item.crop_y = int(file_item.scale_to_height / 2 - resolution / 2)
-            elif not did_process_poi:
-                bucket_resolution = get_bucket_for_image_size(
-                    width, height,
-                    resolution=resolution,
-                    divisibility=bucket_tolerance
+            elif idx in poi_crops:
+                file_item.apply_poi_bucket(
+                    poi_crops[idx],
+                    {"width": bucket_widths[idx], "height": bucket_heights[idx]}
                 )
+            else:
+                new_width = bucket_widths[idx]
+                new_height = bucket_heights[idx]
 
-                # Calculate scale factors for width and height
-                width_scale_factor = bucket_resolution["width"] / width
-                height_scale_factor = bucket_resolution["height"] / height
-
-                # Use the maximum of the scale factors to ensure both dimensions are scaled above the bucket resolution
-                max_scale_factor = max(width_scale_factor, height_scale_factor)
-
-                # round up
-                file_item.scale_to_width = int(math.ceil(width * max_scale_factor))
-                file_item.scale_to_height = int(math.ceil(height * max_scale_factor))
-
-                file_item.crop_height = bucket_resolution["height"]
-                file_item.crop_width = bucket_resolution["width"]
+                file_item.scale_to_width = scale_to_widths[idx]
+                file_item.scale_to_height = scale_to_heights[idx]
 
-                new_width = bucket_resolution["width"]
-                new_height = bucket_resolution["height"]
+                file_item.crop_height = new_height
+                file_item.crop_width = new_width
 
                 if self.dataset_config.random_crop:
                     # random crop
@@ -265,20 +321,9 @@ class BucketsMixin:
                 if file_item.crop_y < 0 or file_item.crop_x < 0:
                     print('debug')
 
-            # check if bucket exists, if not, create it
-            bucket_key = f'{file_item.crop_width}x{file_item.crop_height}'
-            if bucket_key not in self.buckets:
-                self.buckets[bucket_key] = Bucket(file_item.crop_width, file_item.crop_height)
-            self.buckets[bucket_key].file_list_idx.append(idx)
+            bucket_keys.append(f'{file_item.crop_width}x{file_item.crop_height}')
 
-        # print the buckets
-        self.shuffle_buckets()
-        self.build_batch_indices()
-        if not quiet:
-            print(f'Bucket sizes for {self.dataset_path}:')
-            for key, bucket in self.buckets.items():
-                print(f'{key}: {len(bucket.file_list_idx)} files')
-            print(f'{len(self.buckets)} buckets made')
+        return bucket_keys
 
 
 class CaptionProcessingDTOMixin:
@@ -293,6 +338,15 @@ class CaptionProcessingDTOMixin:
             dataset_config: DatasetConfig = kwargs.get('dataset_config', None)
             self.extra_values: List[float] = dataset_config.extra_values
 
+    def read_sidecar_text(self: 'FileItemDTO', sidecar_path: str) -> Union[str, None]:
+        # caption and json files next to the image. Packed datasets keep their text in the pack index
+        if self.dataset_pack_entry is not None:
+            return self.dataset_pack_entry['sidecars'].get(os.path.splitext(sidecar_path)[1].lstrip('.'), None)
+        if not os.path.exists(sidecar_path):
+            return None
+        with open(sidecar_path, 'r', encoding='utf-8') as f:
+            return f.read()
+
     # todo allow for loading from sd-scripts style dict
     def load_caption(self: 'FileItemDTO', caption_dict: Union[dict, None]):
         if self.raw_caption is not None:
@@ -309,28 +363,26 @@ class CaptionProcessingDTOMixin:
             prompt_path = f"{path_no_ext}.{prompt_ext}"
             short_caption = None
 
-            if os.path.exists(prompt_path):
-                with open(prompt_path, 'r', encoding='utf-8') as f:
-                    prompt = f.read()
-                    short_caption = None
-                    if prompt_path.endswith('.json'):
-                        # replace any line endings with commas for \n \r \r\n
-                        prompt = prompt.replace('\r\n', ' ')
-                        prompt = prompt.replace('\n', ' ')
-                        prompt = prompt.replace('\r', ' ')
-
-                        prompt_json = json.loads(prompt)
-                        if 'caption' in prompt_json:
-                            prompt = prompt_json['caption']
-                        if 'caption_short' in prompt_json:
-                            short_caption = prompt_json['caption_short']
-
-                        if 'extra_values' in prompt_json:
-                            self.extra_values = prompt_json['extra_values']
-
-                    prompt = clean_caption(prompt)
-                    if short_caption is not None:
-                        short_caption = clean_caption(short_caption)
+            prompt = self.read_sidecar_text(prompt_path)
+            if prompt is not None:
+                if prompt_path.endswith('.json'):
+                    # replace any line endings with commas for \n \r \r\n
+                    prompt = prompt.replace('\r\n', ' ')
+                    prompt = prompt.replace('\n', ' ')
+                    prompt = prompt.replace('\r', ' ')
+
+                    prompt_json = json.loads(prompt)
+                    if 'caption' in prompt_json:
+                        prompt = prompt_json['caption']
+                    if 'caption_short' in prompt_json:
+                        short_caption = prompt_json['caption_short']
+
+                    if 'extra_values' in prompt_json:
+                        self.extra_values = prompt_json['extra_values']
+
+                prompt = clean_caption(prompt)
+                if short_caption is not None:
+                    short_caption = clean_caption(short_caption)
             else:
                 prompt = ''
                 if self.dataset_config.default_caption is not None:
@@ -426,25 +478,17 @@ class CaptionProcessingDTOMixin:
 
 
 class ImageProcessingDTOMixin:
-    def load_and_process_image(
-            self: 'FileItemDTO',
-            transform: Union[None, transforms.Compose],
-            only_load_latents=False
-    ):
-        # if we are caching latents, just do that
-        if self.is_latent_cached:
-            self.get_latent()
-            if self.has_control_image:
-                self.load_control_image()
-            if self.has_clip_image:
-                self.load_clip_image()
-            if self.has_mask_image:
-                self.load_mask_image()
-            if self.has_unconditional:
-                self.load_unconditional_image()
-            return
+    def get_image_source(self: 'FileItemDTO', path: str):
+        # something Image.open can read. Images in a packed dataset are read out of their shard
+        if self.dataset_pack_entry is not None:
+            if path == self.path:
+                return io.BytesIO(get_dataset_pack_reader(self.dataset_pack_root).read(self.dataset_pack_entry))
+            return get_dataset_pack(self.dataset_pack_root).open_file(path)
+        return path
+
+    def open_image_for_processing(self: 'FileItemDTO', apply_flip: bool = True) -> Image.Image:
         try:
-            img = Image.open(self.path)
+            img = Image.open(self.get_image_source(self.path))
             img = exif_transpose(img)
         except Exception as e:
             print(f"Error: {e}")
@@ -454,6 +498,8 @@ class ImageProcessingDTOMixin:
             # we do this to make sure it does not replace the alpha with another color
             # we want the image just without the alpha channel
             np_img = np.array(img)
+            # keep the alpha so the mask does not have to decode the image again
+            self.alpha_mask_image = Image.fromarray(np_img[:, :, 3])
             # strip off alpha
             np_img = np_img[:, :, :3]
             img = Image.fromarray(np_img)
@@ -469,29 +515,120 @@ class ImageProcessingDTOMixin:
             print(
                 f"unexpected values: w={w}, h={h}, file_item.scale_to_width={self.scale_to_width}, file_item.scale_to_height={self.scale_to_height}, file_item.path={self.path}")
 
+        if not apply_flip:
+            return img
+        return self.apply_flip(img)
+
+    # The main image and its control, mask and unconditional images all share one flip, scale and crop.
+    # These apply it so every image in the item stays aligned
+
+    def apply_flip(self: 'FileItemDTO', img: Image.Image) -> Image.Image:
         if self.flip_x:
             # do a flip
             img = img.transpose(Image.FLIP_LEFT_RIGHT)
         if self.flip_y:
             # do a flip
             img = img.transpose(Image.FLIP_TOP_BOTTOM)
+        return img
+
+    def get_crop_box(self: 'FileItemDTO'):
+        return (
+            self.crop_x,
+            self.crop_y,
+            self.crop_x + self.crop_width,
+            self.crop_y + self.crop_height
+        )
 
+    def apply_bucket_scale_and_crop(self: 'FileItemDTO', img: Image.Image) -> Image.Image:
+        # scale and crop based on file item
+        img = img.resize((self.scale_to_width, self.scale_to_height), Image.BICUBIC)
+        return img.crop(self.get_crop_box())
+
+    def get_source_stat(self: 'FileItemDTO') -> list:
+        # changes when the source image is edited or replaced
+        if self.dataset_pack_entry is not None:
+            stat = os.stat(os.path.join(self.dataset_pack_root, self.dataset_pack_entry['shard']))
+            return [stat.st_mtime_ns, self.dataset_pack_entry['offset'], self.dataset_pack_entry['size']]
+        stat = os.stat(self.path)
+        return [stat.st_mtime_ns, stat.st_size]
+
+    def can_cache_resized_image(self: 'FileItemDTO') -> bool:
+        # poi crops and random scales pick a new scale every epoch, so those sizes would only ever be used once
+        if not self.dataset_config.cache_resized_images:
+            return False
+        return not self.has_point_of_interest and not self.dataset_config.random_scale
+
+    def get_resized_image_cache_key(self: 'FileItemDTO') -> str:
+        # flips are applied after the cache, so flipped and unflipped items share an entry
+        hash_dict = OrderedDict([
+            ("filename", os.path.basename(self.path)),
+            ("source_stat", self.get_source_stat()),
+            ("scale_to_width", self.scale_to_width),
+            ("scale_to_height", self.scale_to_height),
+            ("use_alpha_as_mask", self.use_alpha_as_mask),
+        ])
+        filename_no_ext = os.path.splitext(os.path.basename(self.path))[0]
+        hash_input = json.dumps(hash_dict, sort_keys=True).encode('utf-8')
+        hash_str = base64.urlsafe_b64encode(hashlib.md5(hash_input).digest()).decode('ascii')
+        hash_str = hash_str.replace('=', '')
+        return f'{filename_no_ext}_{hash_str}'
+
+    def get_resized_image_cache_dir(self: 'FileItemDTO') -> str:
+        if self.dataset_pack_entry is None:
+            return os.path.join(os.path.dirname(self.path), '_resized_image_cache')
+        # self.path is inside the pack, where the image would be if it was extracted. The cache goes outside the
+        # pack instead, in the folder the entry has in the pack
+        pack_root = os.path.normpath(self.dataset_pack_root)
+        if self.dataset_config.resized_image_cache_path is not None:
+            cache_root = os.path.join(self.dataset_config.resized_image_cache_path, os.path.basename(pack_root))
+        else:
+            cache_root = f"{pack_root}_resized_image_cache"
+        return os.path.join(cache_root, *self.dataset_pack_entry['path'].split('/')[:-1])
+
+    def get_resized_image(self: 'FileItemDTO') -> Image.Image:
+        # the image scaled to scale_to size, before cropping. Optionally cached as uint8 pixels in a
+        # memory mapped store so it is only decoded and resized once per size
+        if not self.can_cache_resized_image():
+            img = self.open_image_for_processing()
+            return img.resize((self.scale_to_width, self.scale_to_height), Image.BICUBIC)
+
+        store = get_sharded_store(self.get_resized_image_cache_dir())
+        cache_key = self.get_resized_image_cache_key()
+        if cache_key in store:
+            return self.apply_flip(Image.fromarray(store.get(cache_key)['image'].numpy()))
+
+        img = self.open_image_for_processing(apply_flip=False)
+        img = img.resize((self.scale_to_width, self.scale_to_height), Image.BICUBIC)
+        store.put(cache_key, OrderedDict([('image', torch.from_numpy(np.array(img)))]))
+        return self.apply_flip(img)
+
+    def load_and_process_image(
+            self: 'FileItemDTO',
+            transform: Union[None, transforms.Compose],
+            only_load_latents=False
+    ):
+        # if we are caching latents, just do that
+        if self.is_latent_cached:
+            self.get_latent()
+            if self.has_control_image:
+                self.load_control_image()
+            if self.has_clip_image:
+                self.load_clip_image()
+            if self.has_mask_image:
+                self.load_mask_image()
+            if self.has_unconditional:
+                self.load_unconditional_image()
+            return
         if self.dataset_config.buckets:
             # scale and crop based on file item
-            img = img.resize((self.scale_to_width, self.scale_to_height), Image.BICUBIC)
+            img = self.get_resized_image()
             # crop to x_crop, y_crop, x_crop + crop_width, y_crop + crop_height
             if img.width < self.crop_x + self.crop_width or img.height < self.crop_y + self.crop_height:
                 # todo look into this. This still happens sometimes
                 print('size mismatch')
-            img = img.crop((
-                self.crop_x,
-                self.crop_y,
-                self.crop_x + self.crop_width,
-                self.crop_y + self.crop_height
-            ))
-
-            # img = transforms.CenterCrop((self.crop_height, self.crop_width))(img)
+            img = img.crop(self.get_crop_box())
         else:
+            img = self.open_image_for_processing()
             # Downscale the source image first
             # TODO this is nto right
             img = img.resize(
@@ -564,7 +701,7 @@ class ControlFileItemDTOMixin:
 
     def load_control_image(self: 'FileItemDTO'):
         try:
-            img = Image.open(self.control_path).convert('RGB')
+            img = Image.open(self.get_image_source(self.control_path)).convert('RGB')
             img = exif_transpose(img)
         except Exception as e:
             print(f"Error: {e}")
@@ -586,24 +723,10 @@ class ControlFileItemDTOMixin:
                 raise ValueError(
                     f"unexpected values: w={w}, h={h}, file_item.scale_to_width={self.scale_to_width}, file_item.scale_to_height={self.scale_to_height}, file_item.path={self.path}")
 
-            if self.flip_x:
-                # do a flip
-                img = img.transpose(Image.FLIP_LEFT_RIGHT)
-            if self.flip_y:
-                # do a flip
-                img = img.transpose(Image.FLIP_TOP_BOTTOM)
+            img = self.apply_flip(img)
 
             if self.dataset_config.buckets:
-                # scale and crop based on file item
-                img = img.resize((self.scale_to_width, self.scale_to_height), Image.BICUBIC)
-                # img = transforms.CenterCrop((self.crop_height, self.crop_width))(img)
-                # crop
-                img = img.crop((
-                    self.crop_x,
-                    self.crop_y,
-                    self.crop_x + self.crop_width,
-                    self.crop_y + self.crop_height
-                ))
+                img = self.apply_bucket_scale_and_crop(img)
             else:
                 raise Exception("Control images not supported for non-bucket datasets")
         transform = transforms.Compose([
@@ -637,6 +760,10 @@ class ClipImageFileItemDTOMixin:
         self.clip_vision_load_device = 'cpu'
         self.clip_vision_unconditional_paths: Union[List[str], None] = None
         self._clip_vision_embeddings_path: Union[str, None] = None
+        # the only clip layer kept in the cache, None if all of them are
+        self.clip_vision_cache_layer: Union[str, None] = None
+        # root of the sharded store holding the embeddings when caching with cache_clip_vision_sharded
+        self.clip_vision_store_root: Union[str, None] = None
         dataset_config: 'DatasetConfig' = kwargs.get('dataset_config', None)
         if dataset_config.clip_image_path is not None or dataset_config.clip_image_from_same_folder:
             # copy the clip image processor so the dataloader can do it
@@ -728,7 +855,13 @@ class ClipImageFileItemDTOMixin:
             item["flip_x"] = True
         if self.flip_y:
             item["flip_y"] = True
+        if self.clip_vision_cache_layer is not None:
+            item["clip_layer"] = self.clip_vision_cache_layer
         return item
+
+    def get_clip_vision_store_key(self: 'FileItemDTO'):
+        return os.path.splitext(os.path.basename(self.get_clip_vision_embeddings_path()))[0]
+
     def get_clip_vision_embeddings_path(self: 'FileItemDTO', recalculate=False):
         if self._clip_vision_embeddings_path is not None and not recalculate:
             return self._clip_vision_embeddings_path
@@ -767,7 +900,11 @@ class ClipImageFileItemDTOMixin:
         is_dynamic_size_and_aspect = isinstance(self.clip_image_processor, PixtralVisionImagePreprocessorCompatible) or \
                                     isinstance(self.clip_image_processor, SiglipImageProcessor)
         if self.is_vision_clip_cached:
-            self.clip_image_embeds = load_file(self.get_clip_vision_embeddings_path())
+            if self.clip_vision_store_root is not None:
+                store = get_sharded_store(self.clip_vision_store_root)
+                self.clip_image_embeds = store.get(self.get_clip_vision_store_key())
+            else:
+                self.clip_image_embeds = load_file(self.get_clip_vision_embeddings_path())
 
             # get a random unconditional image
             if self.clip_vision_unconditional_paths is not None:
@@ -777,7 +914,7 @@ class ClipImageFileItemDTOMixin:
             return
         clip_image_path = self.get_new_clip_image_path()
         try:
-            img = Image.open(clip_image_path).convert('RGB')
+            img = Image.open(self.get_image_source(clip_image_path)).convert('RGB')
             img = exif_transpose(img)
         except Exception as e:
             # make a random noise image
@@ -787,13 +924,8 @@ class ClipImageFileItemDTOMixin:
 
         img = img.convert('RGB')
 
-        if self.flip_x:
-            # do a flip
-            img = img.transpose(Image.FLIP_LEFT_RIGHT)
-        if self.flip_y:
-            # do a flip
-            img = img.transpose(Image.FLIP_TOP_BOTTOM)
-            
+        img = self.apply_flip(img)
+
         if is_dynamic_size_and_aspect:
             pass  # let the image processor handle it
         elif img.width != img.height:
@@ -957,6 +1089,8 @@ class MaskFileItemDTOMixin:
         self.mask_path: Union[str, None] = None
         self.mask_tensor: Union[torch.Tensor, None] = None
         self.use_alpha_as_mask: bool = False
+        # alpha channel kept from decoding the main image when using it as the mask
+        self.alpha_mask_image: Union[Image.Image, None] = None
         dataset_config: 'DatasetConfig' = kwargs.get('dataset_config', None)
         self.mask_min_value = dataset_config.mask_min_value
         if dataset_config.alpha_mask:
@@ -977,20 +1111,26 @@ class MaskFileItemDTOMixin:
                     break
 
     def load_mask_image(self: 'FileItemDTO'):
-        try:
-            img = Image.open(self.mask_path)
-            img = exif_transpose(img)
-        except Exception as e:
-            print(f"Error: {e}")
-            print(f"Error loading image: {self.mask_path}")
-
-        if self.use_alpha_as_mask:
+        if self.use_alpha_as_mask and self.alpha_mask_image is not None:
+            # the alpha was kept when the main image was decoded
             # pipeline expectws an rgb image so we need to put alpha in all channels
-            np_img = np.array(img)
-            np_img[:, :, :3] = np_img[:, :, 3:]
+            img = self.alpha_mask_image.convert('RGB')
+            self.alpha_mask_image = None
+        else:
+            try:
+                img = Image.open(self.get_image_source(self.mask_path))
+                img = exif_transpose(img)
+            except Exception as e:
+                print(f"Error: {e}")
+                print(f"Error loading image: {self.mask_path}")
 
-            np_img = np_img[:, :, :3]
-            img = Image.fromarray(np_img)
+            if self.use_alpha_as_mask:
+                # pipeline expectws an rgb image so we need to put alpha in all channels
+                np_img = np.array(img)
+                np_img[:, :, :3] = np_img[:, :, 3:]
+
+                np_img = np_img[:, :, :3]
+                img = Image.fromarray(np_img)
 
         img = img.convert('RGB')
         if self.dataset_config.invert_mask:
@@ -1012,15 +1152,7 @@ class MaskFileItemDTOMixin:
             self.crop_width, self.crop_height = self.crop_height, self.crop_width
             self.crop_x, self.crop_y = self.crop_y, self.crop_x
 
-
-
-
-        if self.flip_x:
-            # do a flip
-            img = img.transpose(Image.FLIP_LEFT_RIGHT)
-        if self.flip_y:
-            # do a flip
-            img = img.transpose(Image.FLIP_TOP_BOTTOM)
+        img = self.apply_flip(img)
 
         # randomly apply a blur up to 0.5% of the size of the min (width, height)
         min_size = min(img.width, img.height)
@@ -1031,16 +1163,7 @@ class MaskFileItemDTOMixin:
         img = img.convert('L')
 
         if self.dataset_config.buckets:
-            # scale and crop based on file item
-            img = img.resize((self.scale_to_width, self.scale_to_height), Image.BICUBIC)
-            # img = transforms.CenterCrop((self.crop_height, self.crop_width))(img)
-            # crop
-            img = img.crop((
-                self.crop_x,
-                self.crop_y,
-                self.crop_x + self.crop_width,
-                self.crop_y + self.crop_height
-            ))
+            img = self.apply_bucket_scale_and_crop(img)
         else:
             raise Exception("Mask images not supported for non-bucket datasets")
 
@@ -1056,6 +1179,7 @@ class MaskFileItemDTOMixin:
 
     def cleanup_mask(self: 'FileItemDTO'):
         self.mask_tensor = None
+        self.alpha_mask_image = None
 
 
 class UnconditionalFileItemDTOMixin:
@@ -1082,7 +1206,7 @@ class UnconditionalFileItemDTOMixin:
 
     def load_unconditional_image(self: 'FileItemDTO'):
         try:
-            img = Image.open(self.unconditional_path)
+            img = Image.open(self.get_image_source(self.unconditional_path))
             img = exif_transpose(img)
         except Exception as e:
             print(f"Error: {e}")
@@ -1099,24 +1223,10 @@ class UnconditionalFileItemDTOMixin:
             raise ValueError(
                 f"unexpected values: w={w}, h={h}, file_item.scale_to_width={self.scale_to_width}, file_item.scale_to_height={self.scale_to_height}, file_item.path={self.path}")
 
-        if self.flip_x:
-            # do a flip
-            img = img.transpose(Image.FLIP_LEFT_RIGHT)
-        if self.flip_y:
-            # do a flip
-            img = img.transpose(Image.FLIP_TOP_BOTTOM)
+        img = self.apply_flip(img)
 
         if self.dataset_config.buckets:
-            # scale and crop based on file item
-            img = img.resize((self.scale_to_width, self.scale_to_height), Image.BICUBIC)
-            # img = transforms.CenterCrop((self.crop_height, self.crop_width))(img)
-            # crop
-            img = img.crop((
-                self.crop_x,
-                self.crop_y,
-                self.crop_x + self.crop_width,
-                self.crop_y + self.crop_height
-            ))
+            img = self.apply_bucket_scale_and_crop(img)
         else:
             raise Exception("Unconditional images are not supported for non-bucket datasets")
 
@@ -1161,10 +1271,10 @@ class PoiFileItemDTOMixin:
             # get the caption path
             file_path_no_ext = os.path.splitext(path)[0]
             caption_path = file_path_no_ext + '.json'
-            if not os.path.exists(caption_path):
+            caption_text = self.read_sidecar_text(caption_path)
+            if caption_text is None:
                 raise Exception(f"Error: caption file not found for poi: {caption_path}")
-            with open(caption_path, 'r', encoding='utf-8') as f:
-                json_data = json.load(f)
+            json_data = json.loads(caption_text)
             if 'poi' not in json_data:
                 print(f"Warning: poi not found in caption file: {caption_path}")
             if self.poi not in json_data['poi']:
@@ -1193,7 +1303,9 @@ class PoiFileItemDTOMixin:
                 # flip the poi
                 self.poi_y = self.height - self.poi_y - self.poi_height
 
-    def setup_poi_bucket(self: 'FileItemDTO'):
+    def get_poi_crop(self: 'FileItemDTO'):
+        # picks a random crop around the poi. Returns (x, y, width, height) in scaled image space or None
+        # if the image is too small and should be bucketed normally
         initial_width = int(self.width * self.dataset_config.scale)
         initial_height = int(self.height * self.dataset_config.scale)
         # we are using poi, so we need to calculate the bucket based on the poi
@@ -1201,9 +1313,8 @@ class PoiFileItemDTOMixin:
         # if img resolution is less than dataset resolution, just return and let the normal bucketing happen
         img_resolution = get_resolution(initial_width, initial_height)
         if img_resolution <= self.dataset_config.resolution:
-            return False  # will trigger normal bucketing
+            return None  # will trigger normal bucketing
 
-        bucket_tolerance = self.dataset_config.bucket_tolerance
         poi_x = int(self.poi_x * self.dataset_config.scale)
         poi_y = int(self.poi_y * self.dataset_config.scale)
         poi_width = int(self.poi_width * self.dataset_config.scale)
@@ -1245,7 +1356,6 @@ class PoiFileItemDTOMixin:
                 print(f"Error: {e}")
                 print(f"Error getting resolution: {self.path}")
                 raise e
-                return False
             if current_resolution >= self.dataset_config.resolution:
                 # We can break now
                 break
@@ -1254,16 +1364,14 @@ class PoiFileItemDTOMixin:
                 if num_loops > 100:
                     print(
                         f"Warning: poi bucketing looped too many times. This should not happen. Please report this issue.")
-                    return False
+                    return None
 
-        new_width = poi_width
-        new_height = poi_height
+        return poi_x, poi_y, poi_width, poi_height
 
-        bucket_resolution = get_bucket_for_image_size(
-            new_width, new_height,
-            resolution=self.dataset_config.resolution,
-            divisibility=bucket_tolerance
-        )
+    def apply_poi_bucket(self: 'FileItemDTO', poi_crop, bucket_resolution: 'BucketResolution'):
+        initial_width = int(self.width * self.dataset_config.scale)
+        initial_height = int(self.height * self.dataset_config.scale)
+        poi_x, poi_y, new_width, new_height = poi_crop
 
         width_scale_factor = bucket_resolution["width"] / new_width
         height_scale_factor = bucket_resolution["height"] / new_height
@@ -1281,6 +1389,16 @@ class PoiFileItemDTOMixin:
             # todo look into this. This still happens sometimes
             print('size mismatch')
 
+    def setup_poi_bucket(self: 'FileItemDTO'):
+        poi_crop = self.get_poi_crop()
+        if poi_crop is None:
+            return False
+        bucket_resolution = get_bucket_for_image_size(
+            poi_crop[2], poi_crop[3],
+            resolution=self.dataset_config.resolution,
+            divisibility=self.dataset_config.bucket_tolerance
+        )
+        self.apply_poi_bucket(poi_crop, bucket_resolution)
         return True
 
 
@@ -1301,6 +1419,8 @@ class LatentCachingFileItemDTOMixin:
         self.is_caching_to_disk = False
         self.is_caching_to_memory = False
         self.latent_load_device = 'cpu'
+        # root of the sharded store holding this latent when caching with cache_latents_sharded
+        self.latent_store_root: Union[str, None] = None
         # sd1 or sdxl or others
         self.latent_space_version = 'sd1'
         # todo, increment this if we change the latent format to invalidate cache
@@ -1342,6 +1462,10 @@ class LatentCachingFileItemDTOMixin:
 
         return self._latent_path
 
+    def get_latent_store_key(self: 'FileItemDTO'):
+        # same name the per file cache would have, so migrated caches keep their keys
+        return os.path.splitext(os.path.basename(self.get_latent_path()))[0]
+
     def cleanup_latent(self):
         if self._encoded_latent is not None:
             if not self.is_caching_to_memory:
@@ -1354,7 +1478,11 @@ class LatentCachingFileItemDTOMixin:
     def get_latent(self, device=None):
         if not self.is_latent_cached:
             return None
-        if self._encoded_latent is None:
+        if self._encoded_latent is None and self.latent_store_root is not None:
+            # view it straight out of the memory mapped shard
+            store = get_sharded_store(self.latent_store_root)
+            self._encoded_latent = store.get(self.get_latent_store_key())['latent']
+        elif self._encoded_latent is None:
             # load it from disk
             state_dict = load_file(
                 self.get_latent_path(),
@@ -1365,6 +1493,65 @@ class LatentCachingFileItemDTOMixin:
         return self._encoded_latent
 
 
+class LatentCachingImageDataset(Dataset):
+    # loads and processes the images that still need latents so they can be decoded in dataloader workers
+    def __init__(self, file_list: List['FileItemDTO'], transform: Union[None, transforms.Compose]):
+        self.file_list = file_list
+        self.transform = transform
+
+    def __len__(self):
+        return len(self.file_list)
+
+    def __getitem__(self, index):
+        file_item = self.file_list[index]
+        file_item.load_and_process_image(self.transform, only_load_latents=True)
+        tensor = file_item.tensor
+        file_item.tensor = None
+        file_item.alpha_mask_image = None
+        return index, tensor
+
+
+def latent_caching_collate(batch):
+    indices = [item[0] for item in batch]
+    tensors = torch.stack([item[1] for item in batch])
+    return indices, tensors
+
+
+class ClipVisionCachingImageDataset(Dataset):
+    # loads and preprocesses clip images in dataloader workers while the vision encoder runs
+    def __init__(self, file_list: List['FileItemDTO']):
+        self.file_list = file_list
+
+    def __len__(self):
+        return len(self.file_list)
+
+    def __getitem__(self, index):
+        file_item = self.file_list[index]
+        file_item.load_clip_image()
+        tensor = file_item.clip_image_tensor
+        file_item.clip_image_tensor = None
+        return index, tensor
+
+
+def clip_vision_caching_collate(batch):
+    # dynamic size processors can return different sizes, they are grouped by shape before encoding
+    indices = [item[0] for item in batch]
+    tensors = [item[1] for item in batch]
+    return indices, tensors
+
+
+def get_clip_vision_state_dict(clip_output, clip_layer: Union[str, None] = None) -> OrderedDict:
+    # make state_dict ['last_hidden_state', 'image_embeds', 'penultimate_hidden_states']
+    state_dict = OrderedDict([
+        ('image_embeds', clip_output.image_embeds),
+        ('last_hidden_state', clip_output.hidden_states[-1]),
+        ('penultimate_hidden_states', clip_output.hidden_states[-2]),
+    ])
+    if clip_layer is not None:
+        state_dict = OrderedDict([(clip_layer, state_dict[clip_layer])])
+    return state_dict
+
+
 class LatentCachingMixin:
     def __init__(self: 'AiToolkitDataset', **kwargs):
         # if we have super, call it
@@ -1372,6 +1559,25 @@ class LatentCachingMixin:
             super().__init__(**kwargs)
         self.latent_cache = {}
 
+    def get_latent_caching_batches(self: 'AiToolkitDataset', file_list: List['FileItemDTO']) -> List[List[int]]:
+        # images can only be batched through the vae if they are the same size, so group them by bucket
+        batch_size = max(1, self.dataset_config.cache_latents_batch_size)
+        groups: Dict[str, List[int]] = OrderedDict()
+        for idx, file_item in enumerate(file_list):
+            if self.dataset_config.buckets:
+                group_key = f'{file_item.crop_width}x{file_item.crop_height}'
+            else:
+                group_key = f'{self.dataset_config.resolution}x{self.dataset_config.resolution}'
+            if group_key not in groups:
+                groups[group_key] = []
+            groups[group_key].append(idx)
+
+        batches = []
+        for key, idx_list in groups.items():
+            for start_idx in range(0, len(idx_list), batch_size):
+                batches.append(idx_list[start_idx:start_idx + batch_size])
+        return batches
+
     def cache_latents_all_latents(self: 'AiToolkitDataset'):
         print(f"Caching latents for {self.dataset_path}")
         # cache all latents to disk
@@ -1385,73 +1591,129 @@ class LatentCachingMixin:
         # move sd items to cpu except for vae
         self.sd.set_device_state_preset('cache_latents')
 
-        # use tqdm to show progress
-        i = 0
-        for file_item in tqdm(self.file_list, desc=f'Caching latents{" to disk" if to_disk else ""}'):
-            # set latent space version
-            if self.sd.model_config.latent_space_version is not None:
-                file_item.latent_space_version = self.sd.model_config.latent_space_version
-            elif self.sd.is_xl:
-                file_item.latent_space_version = 'sdxl'
-            elif self.sd.is_v3:
-                file_item.latent_space_version = 'sd3'
-            elif self.sd.is_auraflow:
-                file_item.latent_space_version = 'sdxl'
-            elif self.sd.is_flux:
-                file_item.latent_space_version = 'flux1'
-            elif self.sd.model_config.is_pixart_sigma:
-                file_item.latent_space_version = 'sdxl'
-            else:
-                file_item.latent_space_version = 'sd1'
+        # set latent space version
+        if self.sd.model_config.latent_space_version is not None:
+            latent_space_version = self.sd.model_config.latent_space_version
+        elif self.sd.is_xl:
+            latent_space_version = 'sdxl'
+        elif self.sd.is_v3:
+            latent_space_version = 'sd3'
+        elif self.sd.is_auraflow:
+            latent_space_version = 'sdxl'
+        elif self.sd.is_flux:
+            latent_space_version = 'flux1'
+        elif self.sd.model_config.is_pixart_sigma:
+            latent_space_version = 'sdxl'
+        else:
+            latent_space_version = 'sd1'
+
+        sharded = to_disk and self.dataset_config.cache_latents_sharded
+        if sharded:
+            print(" - Using sharded latent store")
+
+        # find the ones we already have
+        to_encode: List['FileItemDTO'] = []
+        for file_item in tqdm(self.file_list, desc=f'Checking latent cache'):
+            file_item.latent_space_version = latent_space_version
             file_item.is_caching_to_disk = to_disk
             file_item.is_caching_to_memory = to_memory
             file_item.latent_load_device = self.sd.device
 
             latent_path = file_item.get_latent_path(recalculate=True)
+            if sharded:
+                # the store lives in the same _latent_cache folder the per file caches use
+                file_item.latent_store_root = os.path.dirname(latent_path)
+                store = get_sharded_store(file_item.latent_store_root)
+                store_key = file_item.get_latent_store_key()
+                if store_key not in store and os.path.exists(latent_path):
+                    # ingest the old per file cache so we do not need to encode it again
+                    with safe_open(latent_path, framework='pt', device='cpu') as f:
+                        meta = f.metadata()
+                        state_dict = OrderedDict([(k, f.get_tensor(k)) for k in f.keys()])
+                    store.put(store_key, state_dict, metadata=meta)
+                if store_key in store:
+                    if to_memory:
+                        file_item._encoded_latent = store.get(store_key)['latent'].to(
+                            'cpu', dtype=self.sd.torch_dtype
+                        )
+                    file_item.is_latent_cached = True
+                else:
+                    to_encode.append(file_item)
             # check if it is saved to disk already
-            if os.path.exists(latent_path):
+            elif os.path.exists(latent_path):
                 if to_memory:
                     # load it into memory
                     state_dict = load_file(latent_path, device='cpu')
                     file_item._encoded_latent = state_dict['latent'].to('cpu', dtype=self.sd.torch_dtype)
+                file_item.is_latent_cached = True
+            else:
+                to_encode.append(file_item)
+
+        if len(to_encode) > 0:
+            # decode and resize images in dataloader workers while the vae encodes batches of them
+            from toolkit.data_loader import is_native_windows
+            dataloader_kwargs = {}
+            if is_native_windows():
+                dataloader_kwargs['num_workers'] = 0
             else:
-                # not saved to disk, calculate
-                # load the image first
-                file_item.load_and_process_image(self.transform, only_load_latents=True)
-                dtype = self.sd.torch_dtype
-                device = self.sd.device_torch
-                # add batch dimension
+                dataloader_kwargs['num_workers'] = self.dataset_config.num_workers
+                if self.dataset_config.num_workers > 0:
+                    dataloader_kwargs['prefetch_factor'] = self.dataset_config.prefetch_factor
+
+            data_loader = DataLoader(
+                LatentCachingImageDataset(to_encode, self.transform),
+                batch_sampler=self.get_latent_caching_batches(to_encode),
+                collate_fn=latent_caching_collate,
+                **dataloader_kwargs
+            )
+
+            dtype = self.sd.torch_dtype
+            device = self.sd.device_torch
+            progress_bar = tqdm(total=len(to_encode), desc=f'Caching latents{" to disk" if to_disk else ""}')
+            for indices, imgs in data_loader:
                 try:
-                    imgs = file_item.tensor.unsqueeze(0).to(device, dtype=dtype)
-                    latent = self.sd.encode_images(imgs).squeeze(0)
+                    imgs = imgs.to(device, dtype=dtype)
+                    latents = self.sd.encode_images(imgs)
                 except Exception as e:
-                    print(f"Error processing image: {file_item.path}")
+                    print(f"Error processing images: {', '.join([to_encode[idx].path for idx in indices])}")
                     print(f"Error: {str(e)}")
                     raise e
-                # save_latent
-                if to_disk:
-                    state_dict = OrderedDict([
-                        ('latent', latent.clone().detach().cpu()),
-                    ])
-                    # metadata
-                    meta = get_meta_for_safetensors(file_item.get_latent_info_dict())
-                    os.makedirs(os.path.dirname(latent_path), exist_ok=True)
-                    save_file(state_dict, latent_path, metadata=meta)
 
-                if to_memory:
-                    # keep it in memory
-                    file_item._encoded_latent = latent.to('cpu', dtype=self.sd.torch_dtype)
+                for latent, idx in zip(latents, indices):
+                    file_item = to_encode[idx]
+                    # save_latent
+                    if to_disk:
+                        latent_path = file_item.get_latent_path()
+                        state_dict = OrderedDict([
+                            ('latent', latent.clone().detach().cpu()),
+                        ])
+                        # metadata
+                        meta = get_meta_for_safetensors(file_item.get_latent_info_dict())
+                        if sharded:
+                            store = get_sharded_store(file_item.latent_store_root)
+                            store.put(file_item.get_latent_store_key(), state_dict, metadata=meta)
+                        else:
+                            os.makedirs(os.path.dirname(latent_path), exist_ok=True)
+                            save_file(state_dict, latent_path, metadata=meta)
+
+                    if to_memory:
+                        # keep it in memory
+                        file_item._encoded_latent = latent.to('cpu', dtype=self.sd.torch_dtype)
+
+                    file_item.is_latent_cached = True
 
                 del imgs
-                del latent
-                del file_item.tensor
+                del latents
+                progress_bar.update(len(indices))
+            progress_bar.close()
+
+        if sharded:
+            # done writing, release the shard file handles
+            for latent_store_root in set([file_item.latent_store_root for file_item in self.file_list]):
+                get_sharded_store(latent_store_root).close_writer()
 
-                # flush(garbage_collect=False)
-            file_item.is_latent_cached = True
-            i += 1
-            # flush every 100
-            # if i % 100 == 0:
-            #     flush()
+        if to_disk:
+            self.update_cache_status('latent_cached', lambda f: f.is_latent_cached)
 
         # restore device state
         self.sd.restore_device_state()
@@ -1501,6 +1763,15 @@ class CLIPCachingMixin:
             is_quad = self.sd.adapter.config.quad_image
             image_encoder_path = self.sd.adapter.config.image_encoder_path
 
+            # the adapters only ever read one of the hidden state variants from the cache
+            clip_layer = None
+            if self.dataset_config.cache_clip_vision_used_layer_only:
+                clip_layer = getattr(getattr(self.sd.adapter, 'config', None), 'clip_layer', None)
+                if clip_layer is None:
+                    print(" - Adapter has no clip_layer set, caching all clip vision layers")
+                else:
+                    print(f" - Only caching clip vision {clip_layer}")
+
             dtype = self.sd.torch_dtype
             device = self.sd.device_torch
             if hasattr(self.sd.adapter, 'clip_noise_zero') and self.sd.adapter.clip_noise_zero:
@@ -1525,6 +1796,8 @@ class CLIPCachingMixin:
                     ("is_quad", is_quad),
                     ("is_noise_zero", is_noise_zero),
                 ])
+                if clip_layer is not None:
+                    hash_dict["clip_layer"] = clip_layer
                 # get base64 hash of md5 checksum of hash_dict
                 hash_input = json.dumps(hash_dict, sort_keys=True).encode('utf-8')
                 hash_str = base64.urlsafe_b64encode(hashlib.md5(hash_input).digest()).decode('ascii')
@@ -1560,11 +1833,8 @@ class CLIPCachingMixin:
                     clip_image.to(device, dtype=dtype),
                     output_hidden_states=True
                 )
-                # make state_dict ['last_hidden_state', 'image_embeds', 'penultimate_hidden_states']
                 state_dict = OrderedDict([
-                    ('image_embeds', clip_output.image_embeds.clone().detach().cpu()),
-                    ('last_hidden_state', clip_output.hidden_states[-1].clone().detach().cpu()),
-                    ('penultimate_hidden_states', clip_output.hidden_states[-2].clone().detach().cpu()),
+                    (k, v.clone().detach().cpu()) for k, v in get_clip_vision_state_dict(clip_output, clip_layer).items()
                 ])
 
                 os.makedirs(os.path.dirname(uncond_path), exist_ok=True)
@@ -1573,58 +1843,241 @@ class CLIPCachingMixin:
 
             self.clip_vision_unconditional_cache = unconditional_paths
 
-            # use tqdm to show progress
-            i = 0
-            for file_item in tqdm(self.file_list, desc=f'Caching clip vision to disk'):
+            sharded = self.dataset_config.cache_clip_vision_sharded
+            if sharded:
+                print(" - Using sharded clip vision store")
+
+            # find the ones we already have
+            to_encode: List['FileItemDTO'] = []
+            for file_item in tqdm(self.file_list, desc=f'Checking clip vision cache'):
                 file_item.is_caching_clip_vision_to_disk = True
                 file_item.clip_vision_load_device = self.sd.device
                 file_item.clip_vision_is_quad = is_quad
                 file_item.clip_image_encoder_path = image_encoder_path
                 file_item.clip_vision_unconditional_paths = unconditional_paths
+                file_item.clip_vision_cache_layer = clip_layer
                 if file_item.has_clip_augmentations:
                     raise Exception("Error: clip vision caching is not supported with clip augmentations")
 
                 embedding_path = file_item.get_clip_vision_embeddings_path(recalculate=True)
-                # check if it is saved to disk already
-                if not os.path.exists(embedding_path):
-                    # load the image first
-                    file_item.load_clip_image()
-                    # add batch dimension
-                    clip_image = file_item.clip_image_tensor.unsqueeze(0).to(device, dtype=dtype)
-
-                    if is_quad:
-                        # split the 4x4 grid and stack on batch
-                        ci1, ci2 = clip_image.chunk(2, dim=2)
-                        ci1, ci3 = ci1.chunk(2, dim=3)
-                        ci2, ci4 = ci2.chunk(2, dim=3)
-                        clip_image = torch.cat([ci1, ci2, ci3, ci4], dim=0).detach()
-
-                    clip_output = vision_encoder(
-                        clip_image.to(device, dtype=dtype),
-                        output_hidden_states=True
-                    )
-
-                    # make state_dict ['last_hidden_state', 'image_embeds', 'penultimate_hidden_states']
-                    state_dict = OrderedDict([
-                        ('image_embeds', clip_output.image_embeds.clone().detach().cpu()),
-                        ('last_hidden_state', clip_output.hidden_states[-1].clone().detach().cpu()),
-                        ('penultimate_hidden_states', clip_output.hidden_states[-2].clone().detach().cpu()),
-                    ])
-                    # metadata
-                    meta = get_meta_for_safetensors(file_item.get_clip_vision_info_dict())
-                    os.makedirs(os.path.dirname(embedding_path), exist_ok=True)
-                    save_file(state_dict, embedding_path, metadata=meta)
-
-                    del clip_image
-                    del clip_output
-                    del file_item.clip_image_tensor
-
-                    # flush(garbage_collect=False)
-                file_item.is_vision_clip_cached = True
-                i += 1
-            # flush every 100
-            # if i % 100 == 0:
-            #     flush()
+                if sharded:
+                    file_item.clip_vision_store_root = os.path.dirname(embedding_path)
+                    store = get_sharded_store(file_item.clip_vision_store_root)
+                    store_key = file_item.get_clip_vision_store_key()
+                    if store_key not in store and os.path.exists(embedding_path):
+                        # ingest the old per file cache
+                        with safe_open(embedding_path, framework='pt', device='cpu') as f:
+                            meta = f.metadata()
+                            state_dict = OrderedDict([(k, f.get_tensor(k)) for k in f.keys()])
+                        store.put(store_key, state_dict, metadata=meta)
+                    is_cached = store_key in store
+                else:
+                    # check if it is saved to disk already
+                    is_cached = os.path.exists(embedding_path)
+
+                if is_cached:
+                    file_item.is_vision_clip_cached = True
+                else:
+                    to_encode.append(file_item)
+
+            if len(to_encode) > 0:
+                from toolkit.data_loader import is_native_windows
+                dataloader_kwargs = {}
+                if is_native_windows():
+                    dataloader_kwargs['num_workers'] = 0
+                else:
+                    dataloader_kwargs['num_workers'] = self.dataset_config.num_workers
+                    if self.dataset_config.num_workers > 0:
+                        dataloader_kwargs['prefetch_factor'] = self.dataset_config.prefetch_factor
+
+                data_loader = DataLoader(
+                    ClipVisionCachingImageDataset(to_encode),
+                    batch_size=max(1, self.dataset_config.cache_clip_vision_batch_size),
+                    shuffle=False,
+                    collate_fn=clip_vision_caching_collate,
+                    **dataloader_kwargs
+                )
+
+                progress_bar = tqdm(total=len(to_encode), desc=f'Caching clip vision to disk')
+                for indices, tensors in data_loader:
+                    # group by shape so each group can be stacked
+                    shape_groups: Dict[tuple, List[int]] = OrderedDict()
+                    for i in range(len(indices)):
+                        shape = tuple(tensors[i].shape)
+                        if shape not in shape_groups:
+                            shape_groups[shape] = []
+                        shape_groups[shape].append(i)
+
+                    for group in shape_groups.values():
+                        clip_image = torch.stack([tensors[i] for i in group]).to(device, dtype=dtype)
+                        num_per_image = 1
+                        if is_quad:
+                            # split the 4x4 grid and put the quarters of each image next to each other on batch
+                            ci1, ci2 = clip_image.chunk(2, dim=2)
+                            ci1, ci3 = ci1.chunk(2, dim=3)
+                            ci2, ci4 = ci2.chunk(2, dim=3)
+                            clip_image = torch.stack([ci1, ci2, ci3, ci4], dim=1).flatten(0, 1).detach()
+                            num_per_image = 4
+
+                        try:
+                            clip_output = vision_encoder(
+                                clip_image,
+                                output_hidden_states=True
+                            )
+                        except Exception as e:
+                            print(f"Error processing images: {', '.join([to_encode[indices[i]].path for i in group])}")
+                            print(f"Error: {str(e)}")
+                            raise e
+
+                        batch_state_dict = OrderedDict([
+                            (k, v.detach().cpu()) for k, v in get_clip_vision_state_dict(clip_output, clip_layer).items()
+                        ])
+
+                        for group_idx, i in enumerate(group):
+                            file_item = to_encode[indices[i]]
+                            start = group_idx * num_per_image
+                            # keep the batch dimension, the cache always had it
+                            state_dict = OrderedDict([
+                                (k, v[start:start + num_per_image].clone()) for k, v in batch_state_dict.items()
+                            ])
+                            # metadata
+                            meta = get_meta_for_safetensors(file_item.get_clip_vision_info_dict())
+                            if sharded:
+                                store = get_sharded_store(file_item.clip_vision_store_root)
+                                store.put(file_item.get_clip_vision_store_key(), state_dict, metadata=meta)
+                            else:
+                                embedding_path = file_item.get_clip_vision_embeddings_path()
+                                os.makedirs(os.path.dirname(embedding_path), exist_ok=True)
+                                save_file(state_dict, embedding_path, metadata=meta)
+                            file_item.is_vision_clip_cached = True
+
+                        del clip_image
+                        del clip_output
+                        del batch_state_dict
+                    progress_bar.update(len(indices))
+                progress_bar.close()
+
+            if sharded:
+                # done writing, release the shard file handles
+                for store_root in set([file_item.clip_vision_store_root for file_item in self.file_list]):
+                    get_sharded_store(store_root).close_writer()
+
+            self.update_cache_status('clip_vision_cached', lambda f: f.is_vision_clip_cached)
+
+        # restore device state
+        self.sd.restore_device_state()
+
+
+class TextEmbeddingFileItemDTOMixin:
+    def __init__(self: 'FileItemDTO', *args, **kwargs):
+        if hasattr(super(), '__init__'):
+            super().__init__(*args, **kwargs)
+        self.is_text_embedding_cached = False
+        # the fully processed caption (trigger injected) the cached embedding was encoded from
+        self.text_embedding_caption: Union[str, None] = None
+        self.text_embedding_path: Union[str, None] = None
+        self.prompt_embeds: Union[PromptEmbeds, None] = None
+
+    def load_text_embedding(self: 'FileItemDTO'):
+        if not self.is_text_embedding_cached:
+            return None
+        if self.prompt_embeds is None:
+            self.prompt_embeds = PromptEmbeds.load(self.text_embedding_path, device='cpu')
+        return self.prompt_embeds
+
+    def cleanup_text_embedding(self: 'FileItemDTO'):
+        self.prompt_embeds = None
+
+
+def get_text_encoder_arch(sd: 'StableDiffusion') -> str:
+    if sd.is_flux:
+        return 'flux1'
+    elif sd.is_v3:
+        return 'sd3'
+    elif sd.is_auraflow:
+        return 'auraflow'
+    elif sd.is_pixart:
+        return 'pixart'
+    elif sd.is_xl:
+        return 'sdxl'
+    elif sd.is_v2:
+        return 'sd2'
+    return 'sd1'
+
+
+class TextEmbeddingCachingMixin:
+    def __init__(self: 'AiToolkitDataset', **kwargs):
+        # if we have super, call it
+        if hasattr(super(), '__init__'):
+            super().__init__(**kwargs)
+        # todo, increment this if we change the embedding format to invalidate cache
+        self.text_embedding_version = 1
+
+    def get_text_embedding_info_dict(self: 'AiToolkitDataset', caption: str):
+        return OrderedDict([
+            ("caption", caption),
+            ("text_encoder_path", self.sd.model_config.name_or_path_original),
+            ("text_encoder_arch", get_text_encoder_arch(self.sd)),
+            ("text_encoder_bits", self.sd.model_config.text_encoder_bits),
+            ("te_dtype", str(self.sd.te_torch_dtype)),
+            ("text_embedding_version", self.text_embedding_version),
+        ])
+
+    def get_text_embedding_path(self: 'AiToolkitDataset', caption: str):
+        # embeddings are shared by every image with the same caption, so they live at the dataset root
+        cache_dir = os.path.join(self.dataset_folder, '_text_embedding_cache')
+        hash_input = json.dumps(self.get_text_embedding_info_dict(caption), sort_keys=True).encode('utf-8')
+        hash_str = base64.urlsafe_b64encode(hashlib.md5(hash_input).digest()).decode('ascii')
+        hash_str = hash_str.replace('=', '')
+        return os.path.join(cache_dir, f'{hash_str}.safetensors')
+
+    def get_processed_caption(self: 'AiToolkitDataset', file_item: 'FileItemDTO'):
+        # must match the prompt conditioning done in BaseSDTrainProcess.process_general_training_batch
+        file_item.load_caption(self.caption_dict)
+        caption = file_item.caption
+        if self.trigger_word is not None:
+            caption = self.sd.inject_trigger_into_prompt(
+                caption,
+                trigger=self.trigger_word,
+                add_if_not_present=not file_item.is_reg,
+            )
+        return caption
+
+    def cache_text_embeddings(self: 'AiToolkitDataset'):
+        with torch.no_grad():
+            print(f"Caching text embeddings for {self.dataset_path}")
+            # move sd items to cpu except for the text encoder
+            self.sd.set_device_state_preset('cache_text_embeddings')
+
+            # many images can share a caption, only encode each one once
+            caption_paths = {}
+            caption_hashes = {}
+            num_encoded = 0
+            for file_item in tqdm(self.file_list, desc='Caching text embeddings to disk'):
+                caption = self.get_processed_caption(file_item)
+                if self.metadata_db is not None:
+                    file_key = self.metadata_db.get_file_key(file_item.path)
+                    caption_hashes[file_key] = hashlib.md5((file_item.raw_caption or '').encode('utf-8')).hexdigest()
+                if caption not in caption_paths:
+                    embedding_path = self.get_text_embedding_path(caption)
+                    if not os.path.exists(embedding_path):
+                        prompt_embeds = self.sd.encode_prompt(caption)
+                        meta = get_meta_for_safetensors(self.get_text_embedding_info_dict(caption))
+                        os.makedirs(os.path.dirname(embedding_path), exist_ok=True)
+                        prompt_embeds.save(embedding_path, metadata=meta)
+                        del prompt_embeds
+                        num_encoded += 1
+                    caption_paths[caption] = embedding_path
+
+                file_item.text_embedding_caption = caption
+                file_item.text_embedding_path = caption_paths[caption]
+                file_item.is_text_embedding_cached = True
+
+            print(f" - {len(caption_paths)} unique captions, {num_encoded} newly encoded")
+
+            if self.metadata_db is not None:
+                self.metadata_db.set_caption_hashes(caption_hashes)
+            self.update_cache_status('text_embedding_cached', lambda f: f.is_text_embedding_cached)
 
         # restore device state
         self.sd.restore_device_state()
@@ -0,0 +1,182 @@
+import json
+import os
+import sqlite3
+from contextlib import contextmanager
+from typing import Dict, Iterable, List, Tuple, Union
+
+DATABASE_FILENAME = '.aitk_dataset.db'
+LEGACY_SIZE_FILENAME = '.aitk_size.json'
+LEGACY_SIZE_VERSION = "0.1.1"
+# bump to rebuild the table if the schema changes
+SCHEMA_VERSION = 1
+
+CACHE_STATUS_COLUMNS = ['latent_cached', 'clip_vision_cached', 'text_embedding_cached']
+
+
+class DatasetMetadataDB:
+    """
+    Per dataset folder metadata kept in a sqlite database.
+
+    Rows are keyed by the file path relative to the dataset folder and are only trusted while the file's
+    mtime and size match, so a new launch only has to probe files that were added or changed. Updates are
+    small transactions and the database runs in WAL mode, so several jobs can read and update it at once.
+    No connection is held between calls, which keeps datasets picklable for dataloader workers.
+    """
+
+    def __init__(self, dataset_folder: str):
+        self.dataset_folder = dataset_folder
+        self.path = os.path.join(dataset_folder, DATABASE_FILENAME)
+        self.create()
+
+    @contextmanager
+    def connect(self):
+        conn = sqlite3.connect(self.path, timeout=60)
+        try:
+            with conn:
+                yield conn
+        finally:
+            conn.close()
+
+    def create(self):
+        with self.connect() as conn:
+            conn.execute('PRAGMA journal_mode=WAL')
+            version = conn.execute('PRAGMA user_version').fetchone()[0]
+            if version != SCHEMA_VERSION:
+                conn.execute('DROP TABLE IF EXISTS files')
+            conn.execute(
+                'CREATE TABLE IF NOT EXISTS files ('
+                'path TEXT PRIMARY KEY, '
+                'mtime REAL NOT NULL, '
+                'file_size INTEGER NOT NULL, '
+                'width INTEGER, '
+                'height INTEGER, '
+                'caption_hash TEXT, '
+                'latent_cached INTEGER NOT NULL DEFAULT 0, '
+                'clip_vision_cached INTEGER NOT NULL DEFAULT 0, '
+                'text_embedding_cached INTEGER NOT NULL DEFAULT 0'
+                ')'
+            )
+            # one off flags, like whether the legacy size file was imported
+            conn.execute('CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT)')
+            conn.execute(f'PRAGMA user_version={SCHEMA_VERSION}')
+
+    def get_meta(self, key: str) -> Union[str, None]:
+        with self.connect() as conn:
+            row = conn.execute('SELECT value FROM meta WHERE key=?', (key,)).fetchone()
+        return row[0] if row is not None else None
+
+    def set_meta(self, key: str, value: str):
+        with self.connect() as conn:
+            conn.execute(
+                'INSERT INTO meta (key, value) VALUES (?, ?) ON CONFLICT(key) DO UPDATE SET value=excluded.value',
+                (key, value)
+            )
+
+    def get_file_key(self, file_path: str) -> str:
+        return file_path.replace(self.dataset_folder, '')
+
+    def get_sizes(self, file_stats: Dict[str, Tuple[float, int]]) -> Dict[str, Tuple[int, int]]:
+        """
+        Returns {file_key: (width, height)} for the files whose stored mtime and size still match.
+        file_stats is {file_key: (mtime, file_size)}
+        """
+        sizes = {}
+        with self.connect() as conn:
+            rows = conn.execute('SELECT path, mtime, file_size, width, height FROM files WHERE width IS NOT NULL')
+            for path, mtime, file_size, width, height in rows:
+                if file_stats.get(path, None) == (mtime, file_size):
+                    sizes[path] = (width, height)
+        return sizes
+
+    def set_sizes(self, sizes: Dict[str, Tuple[int, int]], file_stats: Dict[str, Tuple[float, int]]):
+        # a changed file invalidates everything else we knew about it, so the cache status is reset
+        rows = []
+        for file_key, (width, height) in sizes.items():
+            mtime, file_size = file_stats[file_key]
+            rows.append((file_key, mtime, file_size, width, height))
+        if len(rows) == 0:
+            return
+        with self.connect() as conn:
+            conn.executemany(
+                'INSERT INTO files (path, mtime, file_size, width, height) VALUES (?, ?, ?, ?, ?) '
+                'ON CONFLICT(path) DO UPDATE SET '
+                'mtime=excluded.mtime, file_size=excluded.file_size, width=excluded.width, height=excluded.height, '
+                'caption_hash=NULL, latent_cached=0, clip_vision_cached=0, text_embedding_cached=0',
+                rows
+            )
+
+    def set_caption_hashes(self, caption_hashes: Dict[str, str]):
+        if len(caption_hashes) == 0:
+            return
+        with self.connect() as conn:
+            conn.executemany(
+                'UPDATE files SET caption_hash=? WHERE path=?',
+                [(caption_hash, file_key) for file_key, caption_hash in caption_hashes.items()]
+            )
+
+    def set_cache_status(self, column: str, file_keys: Iterable[str], is_cached: bool = True):
+        if column not in CACHE_STATUS_COLUMNS:
+            raise ValueError(f"Unknown cache status column: {column}")
+        file_keys = list(set(file_keys))
+        if len(file_keys) == 0:
+            return
+        with self.connect() as conn:
+            conn.executemany(
+                f'UPDATE files SET {column}=? WHERE path=?',
+                [(1 if is_cached else 0, file_key) for file_key in file_keys]
+            )
+
+    def get_cache_status(self, column: str) -> Dict[str, bool]:
+        if column not in CACHE_STATUS_COLUMNS:
+            raise ValueError(f"Unknown cache status column: {column}")
+        with self.connect() as conn:
+            rows = conn.execute(f'SELECT path, {column} FROM files')
+            return {path: bool(value) for path, value in rows}
+
+    def import_legacy_size_file(self, file_stats: Dict[str, Tuple[float, int]]) -> int:
+        # sizes from the old json database are adopted for files we do not know yet.
+        # It has no mtimes, so the current stat is trusted. That is only safe once, files edited after the
+        # import must be probed, so it is never read again
+        legacy_path = os.path.join(self.dataset_folder, LEGACY_SIZE_FILENAME)
+        if not os.path.exists(legacy_path) or self.get_meta('legacy_size_imported') is not None:
+            return 0
+        try:
+            with open(legacy_path, 'r') as f:
+                legacy = json.load(f)
+        except Exception as e:
+            print(f"Error loading size database: {legacy_path}")
+            print(e)
+            return 0
+        if legacy.get("__version__", None) != LEGACY_SIZE_VERSION:
+            return 0
+        # any row, matching stat or not, is newer than the legacy file
+        with self.connect() as conn:
+            known = set([row[0] for row in conn.execute('SELECT path FROM files')])
+        sizes = {}
+        for file_key, size in legacy.items():
+            if file_key == "__version__" or file_key in known or file_key not in file_stats:
+                continue
+            sizes[file_key] = (size[0], size[1])
+        self.set_sizes(sizes, file_stats)
+        self.set_meta('legacy_size_imported', LEGACY_SIZE_VERSION)
+        return len(sizes)
+
+
+def get_file_stats(file_list: List[str], dataset_folder: str) -> Dict[str, Tuple[float, int]]:
+    file_stats = {}
+    for file in set(file_list):
+        try:
+            stat = os.stat(file)
+        except OSError:
+            continue
+        file_stats[file.replace(dataset_folder, '')] = (stat.st_mtime, stat.st_size)
+    return file_stats
+
+
+def get_dataset_metadata_db(dataset_folder: str) -> Union[DatasetMetadataDB, None]:
+    try:
+        return DatasetMetadataDB(dataset_folder)
+    except sqlite3.Error as e:
+        # read only or network folders that do not support locking
+        print(f"Warning: could not open dataset metadata database in {dataset_folder}: {e}")
+        return None
@@ -0,0 +1,212 @@
+import io
+import json
+import os
+import tarfile
+from collections import OrderedDict
+from typing import Dict, List, Union
+
+# a folder holding this file is read as a packed dataset instead of being walked
+PACK_INDEX_FILENAME = 'aitk_pack_index.jsonl'
+# shards roll over once they reach this size
+DEFAULT_MAX_SHARD_SIZE = 1024 * 1024 * 1024
+IMAGE_EXTENSIONS = ('.jpg', '.jpeg', '.png', '.webp')
+# sidecar files stored next to each image, their text also goes in the index
+SIDECAR_EXTENSIONS = ['txt', 'json', 'caption']
+
+
+def is_dataset_pack(folder: str) -> bool:
+    return os.path.isfile(os.path.join(folder, PACK_INDEX_FILENAME))
+
+
+def iter_dataset_pack_entries(root: str, start: int = 0, end: Union[int, None] = None):
+    # streams index entries between two byte offsets of the index without loading the rest of it
+    with open(os.path.join(root, PACK_INDEX_FILENAME), 'rb') as f:
+        f.seek(start)
+        while end is None or f.tell() < end:
+            line = f.readline()
+            if len(line) == 0:
+                break
+            line = line.strip()
+            if len(line) > 0:
+                yield json.loads(line.decode('utf-8'))
+
+
+def get_dataset_pack_shard_ranges(root: str) -> List[tuple]:
+    """
+    Returns [(shard, start, end)] byte ranges of the index for each shard. The packer writes entries shard by
+    shard, so a shard's entries can be streamed on their own with iter_dataset_pack_entries.
+    """
+    ranges = []
+    offset = 0
+    with open(os.path.join(root, PACK_INDEX_FILENAME), 'rb') as f:
+        for line in f:
+            stripped = line.strip()
+            if len(stripped) > 0:
+                # only the shard name is needed, not the captions
+                shard = json.loads(stripped.decode('utf-8'))['shard']
+                if len(ranges) > 0 and ranges[-1][0] == shard:
+                    ranges[-1][2] = offset + len(line)
+                else:
+                    ranges.append([shard, offset, offset + len(line)])
+            offset += len(line)
+    return [tuple(r) for r in ranges]
+
+
+def get_dataset_pack_path(root: str, entry: dict) -> str:
+    # the path the image would have if the pack was extracted in place
+    return os.path.join(root, *entry['path'].split('/'))
+
+
+class DatasetPackReader:
+    # reads file data out of the shards of a pack, keeping the shards open
+
+    def __init__(self, root: str):
+        self.root = root
+        self._files = {}
+
+    def read(self, entry: dict) -> bytes:
+        f = self._files.get(entry['shard'], None)
+        if f is None:
+            f = open(os.path.join(self.root, entry['shard']), 'rb')
+            self._files[entry['shard']] = f
+        f.seek(entry['offset'])
+        return f.read(entry['size'])
+
+    def close(self):
+        for f in self._files.values():
+            f.close()
+        self._files = {}
+
+
+class DatasetPack:
+    """
+    Read side of a packed dataset.
+
+    A pack is a few large uncompressed tar shards plus an index. Every image is stored in a shard next to its
+    sidecar captions, so the shards can still be extracted with regular tar tools. The index has one json line
+    per image with where its bytes live in the shard, its size after exif rotation and the text of its sidecars,
+    so a dataset can be set up from the index alone and images are read with one seek and one read.
+
+    Layout:
+        {root}/aitk_pack_index.jsonl    one json line per image
+        {root}/shard_00000.tar          image and sidecar files
+
+    Images are addressed by their path inside the pack joined onto the pack folder, the same path they would
+    have if the pack was extracted in place, so caches and sizes are keyed the same way as an unpacked folder.
+    """
+
+    def __init__(self, root: str):
+        self.root = root
+        self.entries: Dict[str, dict] = OrderedDict()
+        for entry in iter_dataset_pack_entries(root):
+            self.entries[entry['path']] = entry
+
+    def get_rel_path(self, path: str) -> str:
+        return os.path.relpath(path, self.root).replace(os.sep, '/')
+
+    def get_entry(self, path: str) -> Union[dict, None]:
+        return self.entries.get(self.get_rel_path(path), None)
+
+    def get_image_paths(self) -> List[str]:
+        return [get_dataset_pack_path(self.root, entry) for entry in self.entries.values()]
+
+    def __contains__(self, path: str):
+        return self.get_rel_path(path) in self.entries
+
+    def open_file(self, path: str) -> Union[io.BytesIO, str]:
+        """
+        Returns a file object for an image in the pack. Paths that are not in the pack are returned as is so
+        callers can pass the result straight to Image.open.
+        """
+        entry = self.get_entry(path)
+        if entry is None:
+            return path
+        return io.BytesIO(get_dataset_pack_reader(self.root).read(entry))
+
+
+_open_readers: Dict[tuple, DatasetPackReader] = {}
+_open_packs: Dict[tuple, DatasetPack] = {}
+
+
+def get_dataset_pack_reader(root: str) -> DatasetPackReader:
+    # readers hold open shard handles, so they are kept per process instead of on file items,
+    # which get copied and sent to dataloader workers
+    reader_key = (os.getpid(), os.path.abspath(root))
+    if reader_key not in _open_readers:
+        _open_readers[reader_key] = DatasetPackReader(root)
+    return _open_readers[reader_key]
+
+
+def get_dataset_pack(root: str) -> DatasetPack:
+    # the whole index, loaded once per process
+    pack_key = (os.getpid(), os.path.abspath(root))
+    if pack_key not in _open_packs:
+        _open_packs[pack_key] = DatasetPack(root)
+    return _open_packs[pack_key]
+
+
+class DatasetPackWriter:
+    def __init__(self, root: str, max_shard_size: int = DEFAULT_MAX_SHARD_SIZE):
+        self.root = root
+        self.max_shard_size = max_shard_size
+        self.shard_idx = -1
+        self.shard: Union[str, None] = None
+        self.tar: Union[tarfile.TarFile, None] = None
+        os.makedirs(root, exist_ok=True)
+        self.index_file = open(os.path.join(root, PACK_INDEX_FILENAME), 'w', encoding='utf-8')
+
+    def _open_new_shard(self):
+        if self.tar is not None:
+            self.tar.close()
+        self.shard_idx += 1
+        self.shard = f'shard_{self.shard_idx:05d}.tar'
+        self.tar = tarfile.open(os.path.join(self.root, self.shard), 'w', format=tarfile.PAX_FORMAT)
+
+    def _add_file(self, rel_path: str, data: bytes, mtime: float) -> int:
+        tarinfo = tarfile.TarInfo(rel_path)
+        tarinfo.size = len(data)
+        tarinfo.mtime = mtime
+        # the data starts right after the header, which can span several blocks for long names
+        data_offset = self.tar.offset + len(tarinfo.tobuf(self.tar.format, self.tar.encoding, self.tar.errors))
+        self.tar.addfile(tarinfo, io.BytesIO(data))
+        return data_offset
+
+    def add(self, rel_path: str, image_path: str, width: int, height: int, sidecar_paths: Dict[str, str]):
+        if self.tar is None or self.tar.offset >= self.max_shard_size:
+            self._open_new_shard()
+        with open(image_path, 'rb') as f:
+            data = f.read()
+        offset = self._add_file(rel_path, data, os.path.getmtime(image_path))
+
+        sidecars = OrderedDict()
+        rel_path_no_ext = os.path.splitext(rel_path)[0]
+        for ext, sidecar_path in sidecar_paths.items():
+            with open(sidecar_path, 'rb') as f:
+                sidecar_data = f.read()
+            self._add_file(f"{rel_path_no_ext}.{ext}", sidecar_data, os.path.getmtime(sidecar_path))
+            sidecars[ext] = sidecar_data.decode('utf-8')
+
+        entry = OrderedDict([
+            ('path', rel_path),
+            ('shard', self.shard),
+            ('offset', offset),
+            ('size', len(data)),
+            ('width', width),
+            ('height', height),
+            ('sidecars', sidecars),
+        ])
+        self.index_file.write(json.dumps(entry) + '\n')
+
+    def close(self):
+        if self.tar is not None:
+            self.tar.close()
+            self.tar = None
+        self.index_file.close()
+
+
+def get_dataset_files(input_folder: str) -> List[str]:
+    # same images AiToolkitDataset picks up when walking a folder
+    return sorted([
+        os.path.join(root, file) for root, _, files in os.walk(input_folder) for file in files
+        if file.lower().endswith(IMAGE_EXTENSIONS)
+    ])
@@ -1,14 +1,20 @@
 from __future__ import division
 from __future__ import unicode_literals
 
+from collections import OrderedDict
 from typing import Iterable, Optional
 import weakref
 import copy
 import contextlib
-from toolkit.optimizers.optimizer_utils import copy_stochastic
+from toolkit.optimizers.optimizer_utils import copy_stochastic, copy_stochastic_foreach
 
 import torch
 
+# parameter dtypes updated in groups. Others (int8, float8, quantized) are updated one at a time
+EMA_GROUP_DTYPES = (torch.float32, torch.bfloat16, torch.float16)
+# most elements updated at once in a group, bounds the float32 buffers lower precision groups need
+EMA_GROUP_CHUNK_NUMEL = 64 * 1024 * 1024
+
 
 # Partially based on:
 # https://github.com/tensorflow/tensorflow/blob/r1.13/tensorflow/python/training/moving_averages.py
@@ -123,33 +129,93 @@ class ExponentialMovingAverage:
             )
         one_minus_decay = 1.0 - decay
         with torch.no_grad():
+            # plain float tensors are updated in groups with a few kernels each, anything else one at a time
+            groups = OrderedDict()
             for s_param, param in zip(self.shadow_params, parameters):
-                s_param_float = s_param.float()
-                if s_param.dtype != torch.float32:
-                    s_param_float = s_param_float.to(torch.float32)
-                param_float = param
-                if param.dtype != torch.float32:
-                    param_float = param_float.to(torch.float32)
-                tmp = (s_param_float - param_float)
-                # tmp will be a new tensor so we can do in-place
-                tmp.mul_(one_minus_decay)
-                s_param_float.sub_(tmp)
-                
-                update_param = False
-                if self.use_feedback:
-                    param_float.add_(tmp)
-                    update_param = True
-                
-                if self.param_multiplier != 1.0:
-                    param_float.mul_(self.param_multiplier)
-                    update_param = True
-                
-                if s_param.dtype !=  torch.float32:
-                    copy_stochastic(s_param, s_param_float)
-                
-                if update_param and param.dtype != torch.float32:
-                    copy_stochastic(param, param_float)
-                
+                if self._can_group_update(s_param, param):
+                    group_key = (s_param.device, s_param.dtype, param.dtype)
+                    groups.setdefault(group_key, []).append((s_param, param))
+                else:
+                    self._update_param(s_param, param, one_minus_decay)
+
+            for pairs in groups.values():
+                chunk = []
+                chunk_numel = 0
+                for s_param, param in pairs:
+                    chunk.append((s_param, param))
+                    chunk_numel += s_param.numel()
+                    if chunk_numel >= EMA_GROUP_CHUNK_NUMEL:
+                        self._update_group(chunk, one_minus_decay)
+                        chunk = []
+                        chunk_numel = 0
+                if len(chunk) > 0:
+                    self._update_group(chunk, one_minus_decay)
+
+    def _can_group_update(self, s_param: torch.Tensor, param: torch.Tensor) -> bool:
+        # quantized and other tensor subclasses go through copy_stochastic one at a time
+        return type(s_param) is torch.Tensor and type(param.data) is torch.Tensor and \
+            s_param.dtype in EMA_GROUP_DTYPES and param.dtype in EMA_GROUP_DTYPES and \
+            s_param.device == param.device and s_param.shape == param.shape
+
+    def _update_param(self, s_param, param, one_minus_decay):
+        s_param_float = s_param.float()
+        if s_param.dtype != torch.float32:
+            s_param_float = s_param_float.to(torch.float32)
+        param_float = param
+        if param.dtype != torch.float32:
+            param_float = param_float.to(torch.float32)
+        tmp = (s_param_float - param_float)
+        # tmp will be a new tensor so we can do in-place
+        tmp.mul_(one_minus_decay)
+        s_param_float.sub_(tmp)
+
+        update_param = False
+        if self.use_feedback:
+            param_float.add_(tmp)
+            update_param = True
+
+        if self.param_multiplier != 1.0:
+            param_float.mul_(self.param_multiplier)
+            update_param = True
+
+        if s_param.dtype != torch.float32:
+            copy_stochastic(s_param, s_param_float)
+
+        if update_param and param.dtype != torch.float32:
+            copy_stochastic(param, param_float)
+
+    def _update_group(self, pairs, one_minus_decay):
+        # same math as _update_param, in float32, for a group of tensors with the same dtypes and device
+        s_params = [s_param for s_param, _ in pairs]
+        params = [param.data for _, param in pairs]
+        update_param = self.use_feedback or self.param_multiplier != 1.0
+
+        if s_params[0].dtype == torch.float32 and params[0].dtype == torch.float32:
+            # everything can be done in place
+            tmp = torch._foreach_sub(s_params, params)
+            torch._foreach_mul_(tmp, one_minus_decay)
+            torch._foreach_sub_(s_params, tmp)
+            if self.use_feedback:
+                torch._foreach_add_(params, tmp)
+            if self.param_multiplier != 1.0:
+                torch._foreach_mul_(params, self.param_multiplier)
+            return
+
+        # lower precision tensors are gathered into one flat float32 buffer, updated, then rounded back
+        # in a single stochastic rounding pass
+        s_param_float = torch.cat([s_param.reshape(-1) for s_param in s_params]).to(torch.float32)
+        param_float = torch.cat([param.reshape(-1) for param in params]).to(torch.float32)
+        tmp = s_param_float - param_float
+        tmp.mul_(one_minus_decay)
+        s_param_float.sub_(tmp)
+        if self.use_feedback:
+            param_float.add_(tmp)
+        if self.param_multiplier != 1.0:
+            param_float.mul_(self.param_multiplier)
+
+        copy_stochastic_foreach(s_params, s_param_float)
+        if update_param:
+            copy_stochastic_foreach(params, param_float)
 
     def copy_to(
             self,
@@ -265,6 +265,74 @@ def get_image_metadata_from_bytesio(input, size, file_path=None):
                  height=height)
 
 
+# exif orientations that rotate the image by 90 or 270 degrees
+EXIF_ORIENTATION_TAG = 0x0112
+TRANSPOSED_EXIF_ORIENTATIONS = (5, 6, 7, 8)
+
+
+def read_png_exif_chunk(fp):
+    """
+    Return the data of the eXIf chunk of a png, or None if it has none. Only reads chunk headers and seeks past
+    their data, so a chunk after the image data is found without decoding it
+    """
+    position = fp.tell()
+    try:
+        fp.seek(8)
+        while True:
+            header = fp.read(8)
+            if len(header) < 8:
+                return None
+            length, chunk_type = struct.unpack(">L4s", header)
+            if chunk_type == b'eXIf':
+                return fp.read(length)
+            if chunk_type == b'IEND':
+                return None
+            # skip the data and the crc
+            fp.seek(length + 4, io.SEEK_CUR)
+    finally:
+        fp.seek(position)
+
+
+def get_exif_orientation(pil_img) -> int:
+    exif_bytes = pil_img.info.get('exif', None)
+    if exif_bytes is None and pil_img.format == 'PNG':
+        # png getexif would decode the whole image looking for an exif chunk after the image data
+        try:
+            exif_bytes = read_png_exif_chunk(pil_img.fp)
+            if exif_bytes is None:
+                return 1
+        except Exception:
+            exif_bytes = None
+    if exif_bytes is not None:
+        from PIL import Image as PILImage
+        exif = PILImage.Exif()
+        exif.load(exif_bytes)
+        return exif.get(EXIF_ORIENTATION_TAG, 1)
+    return pil_img.getexif().get(EXIF_ORIENTATION_TAG, 1)
+
+
+def get_oriented_image_size(file_path):
+    """
+    Return (width, height) for an image the way it looks after exif_transpose, reading only the header.
+    This is the size the dataloader sees, the raw header size of rotated images is sideways
+    """
+    from PIL import Image as PILImage
+    # opening is lazy, pixel data is not decoded until it is accessed
+    with PILImage.open(file_path) as pil_img:
+        width, height = pil_img.size
+        if get_exif_orientation(pil_img) in TRANSPOSED_EXIF_ORIENTATIONS:
+            width, height = height, width
+    return width, height
+
+
+def probe_oriented_image_size(file_path):
+    # process pool worker. Errors return None so the caller can fall back to a full decode
+    try:
+        return get_oriented_image_size(file_path)
+    except Exception:
+        return None
+
+
 import unittest
 
 
@@ -1,13 +1,10 @@
 import json
 from collections import OrderedDict
-from io import BytesIO
 
-import safetensors
 from safetensors import safe_open
 
 from info import software_meta
-from toolkit.train_tools import addnet_hash_legacy
-from toolkit.train_tools import addnet_hash_safetensors
+from toolkit.train_tools import addnet_hashes_for_state_dict
 
 
 def get_meta_for_safetensors(meta: OrderedDict, name=None, add_software_info=True) -> OrderedDict:
@@ -37,11 +34,8 @@ def add_model_hash_to_meta(state_dict, meta: OrderedDict) -> OrderedDict:
     # calculating the hash, as they are meant to be immutable
     metadata = {k: v for k, v in meta.items() if k.startswith("ss_")}
 
-    bytes = safetensors.torch.save(state_dict, metadata)
-    b = BytesIO(bytes)
-
-    model_hash = addnet_hash_safetensors(b)
-    legacy_hash = addnet_hash_legacy(b)
+    # hashed tensor by tensor instead of serializing the state dict in memory, the hashes are the same
+    model_hash, legacy_hash = addnet_hashes_for_state_dict(state_dict, metadata)
     meta["sshs_model_hash"] = model_hash
     meta["sshs_legacy_hash"] = legacy_hash
     return meta
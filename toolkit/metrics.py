@@ -0,0 +1,53 @@
+from collections import OrderedDict
+from typing import Dict, Union
+
+import torch
+
+
+class MetricsAccumulator:
+    """
+    Collects per step metrics (losses, grad norms, learning rates) without reading them back from the device.
+
+    Tensor values are kept where they are until reduce is called. reduce then concatenates everything collected
+    since the last call and copies it to the host in one transfer per device. That is one sync every few steps
+    instead of one per metric per step. Python numbers are accepted too, so trainers that already return floats
+    keep working.
+    """
+
+    def __init__(self):
+        self.values: Dict[str, list] = OrderedDict()
+
+    def __len__(self):
+        return sum(len(values) for values in self.values.values())
+
+    def add(self, name: str, value: Union[torch.Tensor, float, int]):
+        if isinstance(value, torch.Tensor):
+            value = value.detach()
+        self.values.setdefault(name, []).append(value)
+
+    def add_dict(self, values: Dict[str, Union[torch.Tensor, float, int]], prefix: str = ''):
+        for name, value in values.items():
+            self.add(f"{prefix}{name}", value)
+
+    def reduce(self) -> OrderedDict:
+        """Returns the mean of every metric since the last reduce, as python floats, and clears them."""
+        # (name, tensor) per device, in the order they were added
+        device_values = OrderedDict()
+        sums = OrderedDict()
+        counts = OrderedDict()
+        for name, values in self.values.items():
+            sums[name] = 0.0
+            counts[name] = len(values)
+            for value in values:
+                if isinstance(value, torch.Tensor):
+                    device_values.setdefault(value.device, []).append((name, value.float().mean().reshape(1)))
+                else:
+                    sums[name] += float(value)
+
+        for device, named_values in device_values.items():
+            host_values = torch.cat([value for _, value in named_values]).tolist()
+            for (name, _), host_value in zip(named_values, host_values):
+                sums[name] += host_value
+
+        self.values = OrderedDict()
+        return OrderedDict([(name, sums[name] / counts[name]) for name in sums.keys() if counts[name] > 0])
@@ -22,6 +22,7 @@ if TYPE_CHECKING:
     from toolkit.lora_special import LoRASpecialNetwork, LoRAModule
     from toolkit.stable_diffusion_model import StableDiffusion
     from toolkit.models.DoRA import DoRAModule
+    from toolkit.async_checkpoint import AsyncCheckpointWriter
 
 Network = Union['LycorisSpecialNetwork', 'LoRASpecialNetwork']
 Module = Union['LoConSpecialModule', 'LoRAModule', 'DoRAModule']
@@ -493,7 +494,8 @@ class ToolkitNetworkMixin:
             self: Network,
             file, dtype=torch.float16,
             metadata=None,
-            extra_state_dict: Optional[OrderedDict] = None
+            extra_state_dict: Optional[OrderedDict] = None,
+            checkpoint_writer: Optional['AsyncCheckpointWriter'] = None
     ):
         keymap = self.get_keymap()
 
@@ -511,7 +513,11 @@ class ToolkitNetworkMixin:
 
         for key in list(state_dict.keys()):
             v = state_dict[key]
-            v = v.detach().clone().to("cpu").to(dtype)
+            if checkpoint_writer is not None:
+                # copied to a reused pinned buffer and written in the background
+                v = checkpoint_writer.snapshot_tensor(f"network.{key}", v, dtype)
+            else:
+                v = v.detach().clone().to("cpu").to(dtype)
             save_key = save_keymap[key] if key in save_keymap else key
             save_dict[save_key] = v
             del state_dict[key]
@@ -520,7 +526,10 @@ class ToolkitNetworkMixin:
             # add extra items to state dict
             for key in list(extra_state_dict.keys()):
                 v = extra_state_dict[key]
-                v = v.detach().clone().to("cpu").to(dtype)
+                if checkpoint_writer is not None:
+                    v = checkpoint_writer.snapshot_tensor(f"network_extra.{key}", v, dtype)
+                else:
+                    v = v.detach().clone().to("cpu").to(dtype)
                 save_dict[key] = v
 
         if self.peft_format:
@@ -543,9 +552,15 @@ class ToolkitNetworkMixin:
 
         if metadata is None:
             metadata = OrderedDict()
-        metadata = add_model_hash_to_meta(state_dict, metadata)
-        if os.path.splitext(file)[1] == ".safetensors":
+        if checkpoint_writer is not None:
+            if os.path.splitext(file)[1] == ".safetensors":
+                # hashed on the writer thread, from the snapshot that is written
+                checkpoint_writer.save_file(save_dict, file, metadata, add_model_hash=True)
+            else:
+                checkpoint_writer.save_torch(save_dict, file)
+        elif os.path.splitext(file)[1] == ".safetensors":
             from safetensors.torch import save_file
+            metadata = add_model_hash_to_meta(save_dict, metadata)
             save_file(save_dict, file, metadata)
         else:
             torch.save(save_dict, file)
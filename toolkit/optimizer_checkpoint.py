@@ -0,0 +1,258 @@
+import json
+import os
+import shutil
+from collections import OrderedDict
+from typing import Dict, List, Tuple, Union
+
+import torch
+from safetensors import safe_open
+from safetensors.torch import save_file
+
+from toolkit.async_checkpoint import atomic_torch_save
+from toolkit.optimizers.optimizer_utils import Auto8bitTensor
+
+# folder in the save root holding the sharded optimizer state
+OPTIMIZER_CHECKPOINT_DIRNAME = 'optimizer'
+OPTIMIZER_CHECKPOINT_INDEX_FILENAME = 'optimizer.safetensors.index.json'
+OPTIMIZER_CHECKPOINT_FORMAT_VERSION = 1
+# shards roll over once they reach this size
+DEFAULT_OPTIMIZER_SHARD_SIZE = 2 * 1024 * 1024 * 1024
+
+
+def get_optimizer_checkpoint_path(save_root: str) -> str:
+    return os.path.join(save_root, OPTIMIZER_CHECKPOINT_DIRNAME)
+
+
+def is_optimizer_checkpoint(folder: str) -> bool:
+    return os.path.isfile(os.path.join(folder, OPTIMIZER_CHECKPOINT_INDEX_FILENAME))
+
+
+def get_optimizer_checkpoint_mtime(folder: str) -> float:
+    # the index is written last, so it dates the whole checkpoint
+    return os.path.getmtime(os.path.join(folder, OPTIMIZER_CHECKPOINT_INDEX_FILENAME))
+
+
+def remove_optimizer_checkpoint(path: str):
+    # removes an optimizer checkpoint folder or optimizer.pt, so a resume can not load a stale one
+    if os.path.isdir(path):
+        shutil.rmtree(path)
+    elif os.path.isfile(path):
+        os.remove(path)
+
+
+def save_optimizer_state_dict(state_dict: dict, path: str, replaces: Union[str, None] = None):
+    # optimizer.pt format. replaces is the checkpoint folder, removed once the file is written
+    atomic_torch_save(state_dict, path)
+    if replaces is not None:
+        remove_optimizer_checkpoint(replaces)
+
+
+def _get_json_value(value):
+    # group options and scalar state as json, tuples come back as lists and are restored on load
+    if isinstance(value, torch.Tensor) and value.numel() == 1:
+        return value.item()
+    if isinstance(value, (list, tuple)):
+        return [_get_json_value(v) for v in value]
+    if value is None or isinstance(value, (bool, int, float, str)):
+        return value
+    raise ValueError(f"Unsupported optimizer value of type {type(value)}")
+
+
+def get_optimizer_checkpoint(
+        optimizer: torch.optim.Optimizer,
+        param_names: Union[Dict[int, str], None] = None,
+) -> Tuple[dict, Dict[str, torch.Tensor]]:
+    """
+    Collects the live optimizer state into an index and a flat dict of tensors to store in safetensors shards.
+
+    State is keyed by parameter name instead of position so it can still be matched after the set of trained
+    parameters changes. param_names maps id(param) to a stable name, parameters without one are named by their
+    position. Auto8bitTensor state is stored as its int8 data plus its scale, so 8 bit state stays 8 bit on disk.
+    Tensors are not copied, snapshot them first if the optimizer keeps stepping while they are written.
+    """
+    param_names = param_names if param_names is not None else {}
+    index = OrderedDict([
+        ('format_version', OPTIMIZER_CHECKPOINT_FORMAT_VERSION),
+        ('optimizer', optimizer.__class__.__name__),
+        ('param_groups', []),
+        ('state', OrderedDict()),
+        ('weight_map', OrderedDict()),
+    ])
+    tensors = OrderedDict()
+
+    for group_idx, group in enumerate(optimizer.param_groups):
+        names = []
+        for param_idx, param in enumerate(group['params']):
+            name = param_names.get(id(param), f"param_groups.{group_idx}.{param_idx}")
+            names.append(name)
+            state = optimizer.state.get(param, None)
+            if state is None or len(state) == 0:
+                continue
+            entry = OrderedDict([
+                ('shape', list(param.shape)),
+                ('values', OrderedDict()),
+                ('tensors', []),
+                ('auto8bit', OrderedDict()),
+            ])
+            for key, value in state.items():
+                tensor_name = f"{name}/{key}"
+                if isinstance(value, Auto8bitTensor):
+                    tensors[tensor_name] = value.quantized
+                    entry['auto8bit'][key] = {
+                        'scale': float(value.scale),
+                        'orig_dtype': str(value.orig_dtype).replace('torch.', ''),
+                    }
+                elif isinstance(value, torch.Tensor):
+                    tensors[tensor_name] = value
+                    entry['tensors'].append(key)
+                else:
+                    entry['values'][key] = _get_json_value(value)
+            index['state'][name] = entry
+
+        options = OrderedDict([(k, _get_json_value(v)) for k, v in group.items() if k != 'params'])
+        index['param_groups'].append(OrderedDict([('options', options), ('params', names)]))
+
+    return index, tensors
+
+
+def _get_saveable_tensor(tensor: torch.Tensor) -> torch.Tensor:
+    # safetensors refuses views into a larger or shared storage
+    tensor = tensor.detach().contiguous()
+    if tensor.untyped_storage().nbytes() != tensor.nbytes:
+        tensor = tensor.clone()
+    return tensor
+
+
+def save_optimizer_checkpoint(
+        folder: str,
+        index: dict,
+        tensors: Dict[str, torch.Tensor],
+        max_shard_size: int = DEFAULT_OPTIMIZER_SHARD_SIZE,
+        replaces: Union[str, None] = None,
+):
+    """
+    Writes an optimizer checkpoint from get_optimizer_checkpoint. The new checkpoint is written next to the
+    old one and swapped in once complete, so an interrupted save leaves the previous checkpoint intact.
+    replaces is an optimizer.pt from the other format, removed once the checkpoint is in place.
+    """
+    folder = os.path.normpath(folder)
+    temp_folder = os.path.join(os.path.dirname(folder), f".{os.path.basename(folder)}.tmp")
+    old_folder = os.path.join(os.path.dirname(folder), f".{os.path.basename(folder)}.old")
+    for path in [temp_folder, old_folder]:
+        if os.path.exists(path):
+            shutil.rmtree(path)
+    os.makedirs(temp_folder)
+
+    shards: List[OrderedDict] = [OrderedDict()]
+    shard_size = 0
+    for name, tensor in tensors.items():
+        tensor_size = tensor.numel() * tensor.element_size()
+        if shard_size > 0 and shard_size + tensor_size > max_shard_size:
+            shards.append(OrderedDict())
+            shard_size = 0
+        shards[-1][name] = tensor
+        shard_size += tensor_size
+
+    weight_map = OrderedDict()
+    for shard_idx, shard in enumerate(shards):
+        shard_filename = f"optimizer_{shard_idx:05d}.safetensors"
+        save_file(
+            {name: _get_saveable_tensor(tensor) for name, tensor in shard.items()},
+            os.path.join(temp_folder, shard_filename),
+            metadata={'format': 'pt'}
+        )
+        for name in shard.keys():
+            weight_map[name] = shard_filename
+    index['weight_map'] = weight_map
+
+    with open(os.path.join(temp_folder, OPTIMIZER_CHECKPOINT_INDEX_FILENAME), 'w') as f:
+        json.dump(index, f)
+
+    if os.path.exists(folder):
+        os.replace(folder, old_folder)
+    os.replace(temp_folder, folder)
+    if os.path.exists(old_folder):
+        shutil.rmtree(old_folder)
+    if replaces is not None:
+        remove_optimizer_checkpoint(replaces)
+
+
+def load_optimizer_checkpoint(
+        optimizer: torch.optim.Optimizer,
+        folder: str,
+        param_names: Union[Dict[int, str], None] = None,
+):
+    """
+    Loads a checkpoint from save_optimizer_checkpoint into the optimizer. Tensors are read from the shards one
+    parameter group at a time and moved straight to their parameter's device, so the whole state is never held
+    in memory at once.
+
+    Parameters are matched by name. Parameters without saved state, or whose shape changed, start with fresh
+    state and saved state for parameters that are no longer trained is skipped. Group options are restored when
+    the number of groups still matches.
+    """
+    param_names = param_names if param_names is not None else {}
+    with open(os.path.join(folder, OPTIMIZER_CHECKPOINT_INDEX_FILENAME), 'r') as f:
+        index = json.load(f)
+
+    if index.get('optimizer', None) != optimizer.__class__.__name__:
+        raise ValueError(
+            f"Optimizer checkpoint is for {index.get('optimizer', None)}, not {optimizer.__class__.__name__}"
+        )
+
+    saved_groups = index['param_groups']
+    if len(saved_groups) == len(optimizer.param_groups):
+        for group, saved_group in zip(optimizer.param_groups, saved_groups):
+            for key, value in saved_group['options'].items():
+                if isinstance(group.get(key, None), tuple) and isinstance(value, list):
+                    value = tuple(value)
+                group[key] = value
+    else:
+        print(f"Optimizer has {len(optimizer.param_groups)} param groups, checkpoint has {len(saved_groups)}. "
+              f"Keeping the current group options")
+
+    weight_map = index['weight_map']
+    saved_state = index['state']
+    num_loaded = 0
+    num_new = 0
+    matched_names = set()
+    for group_idx, group in enumerate(optimizer.param_groups):
+        # shards opened for this group only
+        shard_files = {}
+        # like torch, step counters stay on the cpu unless the step runs on the device
+        step_on_device = group.get('capturable', False) or group.get('fused', False)
+        for param_idx, param in enumerate(group['params']):
+            name = param_names.get(id(param), f"param_groups.{group_idx}.{param_idx}")
+            entry = saved_state.get(name, None)
+            if entry is None or entry['shape'] != list(param.shape):
+                num_new += 1
+                continue
+
+            state = OrderedDict()
+            for key, value in entry['values'].items():
+                state[key] = value
+            for key in entry['tensors'] + list(entry['auto8bit'].keys()):
+                tensor_name = f"{name}/{key}"
+                shard_filename = weight_map[tensor_name]
+                if shard_filename not in shard_files:
+                    shard_files[shard_filename] = safe_open(
+                        os.path.join(folder, shard_filename), framework='pt', device='cpu'
+                    )
+                tensor = shard_files[shard_filename].get_tensor(tensor_name)
+                if key != 'step' or step_on_device:
+                    tensor = tensor.to(param.device)
+                if key in entry['auto8bit']:
+                    auto8bit = entry['auto8bit'][key]
+                    tensor = Auto8bitTensor({
+                        'quantized': tensor,
+                        'scale': auto8bit['scale'],
+                        'orig_dtype': getattr(torch, auto8bit['orig_dtype']),
+                    })
+                state[key] = tensor
+            optimizer.state[param] = state
+            matched_names.add(name)
+            num_loaded += 1
+
+    num_skipped = len([name for name in saved_state.keys() if name not in matched_names])
+    print(f"Loaded optimizer state for {num_loaded} params, {num_new} params start fresh, "
+          f"{num_skipped} saved params skipped")
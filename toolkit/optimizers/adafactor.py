@@ -1,7 +1,8 @@
 import math
 from typing import List
 import torch
-from toolkit.optimizers.optimizer_utils import copy_stochastic, stochastic_grad_accummulation
+from toolkit.optimizers.optimizer_utils import copy_stochastic, stochastic_grad_accummulation, can_step_foreach, \
+    get_foreach_param_groups, get_batch_view_shape, foreach_copy, copy_stochastic_foreach
 from optimum.quanto import QBytesTensor
 import random
 
@@ -40,6 +41,8 @@ class Adafactor(torch.optim.Optimizer):
             If True, time-dependent learning rate is computed instead of external learning rate
         warmup_init (`bool`, *optional*, defaults to `False`):
             Time-dependent learning rate computation depends on whether warm-up initialization is being used
+        foreach (`bool`, *optional*, defaults to `True`):
+            Step parameters with the same shape together as stacked batches instead of one at a time
 
     This implementation handles low-precision (FP16, bfloat) values, but we have not thoroughly tested.
 
@@ -108,6 +111,7 @@ class Adafactor(torch.optim.Optimizer):
         warmup_init=False,
         do_paramiter_swapping=False,
         paramiter_swapping_factor=0.1,
+        foreach=True,
     ):
         if lr is not None and relative_step:
             raise ValueError(
@@ -133,6 +137,7 @@ class Adafactor(torch.optim.Optimizer):
             lr for group in self.param_groups
         ]
 
+        self.foreach = foreach
         self.is_stochastic_rounding_accumulation = False
 
         # setup stochastic grad accum hooks
@@ -209,6 +214,11 @@ class Adafactor(torch.optim.Optimizer):
     def _rms(tensor):
         return tensor.norm(2) / (tensor.numel() ** 0.5)
 
+    @staticmethod
+    def _rms_batch(batch):
+        # _rms of every tensor in a stacked batch
+        return batch.flatten(1).norm(2, dim=1) / (batch[0].numel() ** 0.5)
+
     @staticmethod
     def _approx_sq_grad(exp_avg_sq_row, exp_avg_sq_col):
         # copy from fairseq's adafactor implementation:
@@ -254,106 +264,200 @@ class Adafactor(torch.optim.Optimizer):
             loss = closure()
 
         for group in self.param_groups:
+            foreach_params = []
             for p in group["params"]:
                 if p.grad is None or not p.requires_grad:
                     continue
-
-                grad = p.grad
-                if grad.dtype != torch.float32:
-                    grad = grad.to(torch.float32)
-                if grad.is_sparse:
-                    raise RuntimeError(
-                        "Adafactor does not support sparse gradients.")
-                
-                # if p has atts _scale then it is quantized. We need to divide the grad by the scale
-                # if hasattr(p, "_scale"):
-                #     grad = grad / p._scale
-
-                state = self.state[p]
-                grad_shape = grad.shape
-
-                factored, use_first_moment = self._get_options(
-                    group, grad_shape)
-                # State Initialization
-                if len(state) == 0:
-                    state["step"] = 0
-
-                    if use_first_moment:
-                        # Exponential moving average of gradient values
-                        state["exp_avg"] = torch.zeros_like(grad)
-                    if factored:
-                        state["exp_avg_sq_row"] = torch.zeros(
-                            grad_shape[:-1]).to(grad)
-                        state["exp_avg_sq_col"] = torch.zeros(
-                            grad_shape[:-2] + grad_shape[-1:]).to(grad)
-                    else:
-                        state["exp_avg_sq"] = torch.zeros_like(grad)
-
-                    state["RMS"] = 0
+                if self.foreach and can_step_foreach(p):
+                    if len(self.state[p]) == 0:
+                        self.initialize_state(group, p)
+                    foreach_params.append(p)
                 else:
-                    if use_first_moment:
-                        state["exp_avg"] = state["exp_avg"].to(grad)
-                    if factored:
-                        state["exp_avg_sq_row"] = state["exp_avg_sq_row"].to(
-                            grad)
-                        state["exp_avg_sq_col"] = state["exp_avg_sq_col"].to(
-                            grad)
-                    else:
-                        state["exp_avg_sq"] = state["exp_avg_sq"].to(grad)
-
-                p_data_fp32 = p
-                
-                if isinstance(p_data_fp32, QBytesTensor):
-                    p_data_fp32 = p_data_fp32.dequantize()
-                if p.dtype != torch.float32:
-                    p_data_fp32 = p_data_fp32.clone().float()
-
-                state["step"] += 1
-                state["RMS"] = self._rms(p_data_fp32)
-                lr = self._get_lr(group, state)
-
-                beta2t = 1.0 - math.pow(state["step"], group["decay_rate"])
-                eps = group["eps"]
-                if isinstance(eps, tuple) or isinstance(eps, list):
-                    eps = eps[0]
-                update = (grad**2) + eps
-                if factored:
-                    exp_avg_sq_row = state["exp_avg_sq_row"]
-                    exp_avg_sq_col = state["exp_avg_sq_col"]
-
-                    exp_avg_sq_row.mul_(beta2t).add_(
-                        update.mean(dim=-1), alpha=(1.0 - beta2t))
-                    exp_avg_sq_col.mul_(beta2t).add_(
-                        update.mean(dim=-2), alpha=(1.0 - beta2t))
-
-                    # Approximation of exponential moving average of square of gradient
-                    update = self._approx_sq_grad(
-                        exp_avg_sq_row, exp_avg_sq_col)
-                    update.mul_(grad)
-                else:
-                    exp_avg_sq = state["exp_avg_sq"]
-
-                    exp_avg_sq.mul_(beta2t).add_(update, alpha=(1.0 - beta2t))
-                    update = exp_avg_sq.rsqrt().mul_(grad)
-
-                update.div_(
-                    (self._rms(update) / group["clip_threshold"]).clamp_(min=1.0))
-                update.mul_(lr)
+                    self.step_param(group, p)
 
-                if use_first_moment:
-                    exp_avg = state["exp_avg"]
-                    exp_avg.mul_(group["beta1"]).add_(
-                        update, alpha=(1 - group["beta1"]))
-                    update = exp_avg
-
-                if group["weight_decay"] != 0:
-                    p_data_fp32.add_(
-                        p_data_fp32, alpha=(-group["weight_decay"] * lr))
-
-                p_data_fp32.add_(-update)
-
-                if p.dtype != torch.float32:
-                    # apply stochastic rounding
-                    copy_stochastic(p, p_data_fp32)
+            for group_params in get_foreach_param_groups(foreach_params, self.state):
+                self.step_foreach(group, group_params)
 
         return loss
+
+    def initialize_state(self, group, p):
+        state = self.state[p]
+        grad_shape = p.grad.shape
+        factored, use_first_moment = self._get_options(group, grad_shape)
+        state["step"] = 0
+
+        if use_first_moment:
+            # Exponential moving average of gradient values
+            state["exp_avg"] = torch.zeros(
+                grad_shape, dtype=torch.float32, device=p.grad.device)
+        if factored:
+            state["exp_avg_sq_row"] = torch.zeros(
+                grad_shape[:-1], dtype=torch.float32, device=p.grad.device)
+            state["exp_avg_sq_col"] = torch.zeros(
+                grad_shape[:-2] + grad_shape[-1:], dtype=torch.float32, device=p.grad.device)
+        else:
+            state["exp_avg_sq"] = torch.zeros(
+                grad_shape, dtype=torch.float32, device=p.grad.device)
+
+        state["RMS"] = 0
+
+    def step_param(self, group, p):
+        grad = p.grad
+        if grad.dtype != torch.float32:
+            grad = grad.to(torch.float32)
+        if grad.is_sparse:
+            raise RuntimeError(
+                "Adafactor does not support sparse gradients.")
+
+        # if p has atts _scale then it is quantized. We need to divide the grad by the scale
+        # if hasattr(p, "_scale"):
+        #     grad = grad / p._scale
+
+        state = self.state[p]
+        grad_shape = grad.shape
+
+        factored, use_first_moment = self._get_options(
+            group, grad_shape)
+        # State Initialization
+        if len(state) == 0:
+            self.initialize_state(group, p)
+        else:
+            if use_first_moment:
+                state["exp_avg"] = state["exp_avg"].to(grad)
+            if factored:
+                state["exp_avg_sq_row"] = state["exp_avg_sq_row"].to(
+                    grad)
+                state["exp_avg_sq_col"] = state["exp_avg_sq_col"].to(
+                    grad)
+            else:
+                state["exp_avg_sq"] = state["exp_avg_sq"].to(grad)
+
+        p_data_fp32 = p
+
+        if isinstance(p_data_fp32, QBytesTensor):
+            p_data_fp32 = p_data_fp32.dequantize()
+        if p.dtype != torch.float32:
+            p_data_fp32 = p_data_fp32.clone().float()
+
+        state["step"] += 1
+        state["RMS"] = self._rms(p_data_fp32)
+        lr = self._get_lr(group, state)
+
+        beta2t = 1.0 - math.pow(state["step"], group["decay_rate"])
+        eps = group["eps"]
+        if isinstance(eps, tuple) or isinstance(eps, list):
+            eps = eps[0]
+        update = (grad**2) + eps
+        if factored:
+            exp_avg_sq_row = state["exp_avg_sq_row"]
+            exp_avg_sq_col = state["exp_avg_sq_col"]
+
+            exp_avg_sq_row.mul_(beta2t).add_(
+                update.mean(dim=-1), alpha=(1.0 - beta2t))
+            exp_avg_sq_col.mul_(beta2t).add_(
+                update.mean(dim=-2), alpha=(1.0 - beta2t))
+
+            # Approximation of exponential moving average of square of gradient
+            update = self._approx_sq_grad(
+                exp_avg_sq_row, exp_avg_sq_col)
+            update.mul_(grad)
+        else:
+            exp_avg_sq = state["exp_avg_sq"]
+
+            exp_avg_sq.mul_(beta2t).add_(update, alpha=(1.0 - beta2t))
+            update = exp_avg_sq.rsqrt().mul_(grad)
+
+        update.div_(
+            (self._rms(update) / group["clip_threshold"]).clamp_(min=1.0))
+        update.mul_(lr)
+
+        if use_first_moment:
+            exp_avg = state["exp_avg"]
+            exp_avg.mul_(group["beta1"]).add_(
+                update, alpha=(1 - group["beta1"]))
+            update = exp_avg
+
+        if group["weight_decay"] != 0:
+            p_data_fp32.add_(
+                p_data_fp32, alpha=(-group["weight_decay"] * lr))
+
+        p_data_fp32.add_(-update)
+
+        if p.dtype != torch.float32:
+            # apply stochastic rounding
+            copy_stochastic(p, p_data_fp32)
+
+    def step_foreach(self, group, params):
+        # same as step_param for a group of same shaped parameters stacked into one batch,
+        # per tensor reductions are done over every dim but the first
+        grad = torch.stack([p.grad for p in params]).to(torch.float32)
+        p_data_fp32 = torch.stack([p.data for p in params]).to(torch.float32)
+        view_shape = get_batch_view_shape(grad)
+
+        states = [self.state[p] for p in params]
+        factored, use_first_moment = self._get_options(group, grad.shape[1:])
+        state_keys = ["exp_avg"] if use_first_moment else []
+        state_keys += ["exp_avg_sq_row", "exp_avg_sq_col"] if factored else ["exp_avg_sq"]
+        for state in states:
+            for key in state_keys:
+                state[key] = state[key].to(grad)
+        batch_state = {key: torch.stack([state[key] for state in states]) for key in state_keys}
+
+        for state in states:
+            state["step"] += 1
+        rms = self._rms_batch(p_data_fp32)
+        for state, param_rms in zip(states, rms.unbind(0)):
+            state["RMS"] = param_rms
+
+        # everything but RMS is shared by the group
+        lr = group["lr"]
+        if group["relative_step"]:
+            min_step = 1e-6 * \
+                states[0]["step"] if group["warmup_init"] else 1e-2
+            lr = min(min_step, 1.0 / math.sqrt(states[0]["step"]))
+        if group["scale_parameter"]:
+            lr = rms.clamp(min=group["eps"][1]).mul_(lr).view(view_shape)
+
+        beta2t = 1.0 - math.pow(states[0]["step"], group["decay_rate"])
+        eps = group["eps"]
+        if isinstance(eps, tuple) or isinstance(eps, list):
+            eps = eps[0]
+        update = (grad**2) + eps
+        if factored:
+            exp_avg_sq_row = batch_state["exp_avg_sq_row"]
+            exp_avg_sq_col = batch_state["exp_avg_sq_col"]
+
+            exp_avg_sq_row.mul_(beta2t).add_(
+                update.mean(dim=-1), alpha=(1.0 - beta2t))
+            exp_avg_sq_col.mul_(beta2t).add_(
+                update.mean(dim=-2), alpha=(1.0 - beta2t))
+
+            # Approximation of exponential moving average of square of gradient
+            update = self._approx_sq_grad(
+                exp_avg_sq_row, exp_avg_sq_col)
+            update.mul_(grad)
+        else:
+            exp_avg_sq = batch_state["exp_avg_sq"]
+
+            exp_avg_sq.mul_(beta2t).add_(update, alpha=(1.0 - beta2t))
+            update = exp_avg_sq.rsqrt().mul_(grad)
+
+        update.div_(
+            (self._rms_batch(update) / group["clip_threshold"]).clamp_(min=1.0).view(view_shape))
+        update.mul_(lr)
+
+        if use_first_moment:
+            exp_avg = batch_state["exp_avg"]
+            exp_avg.mul_(group["beta1"]).add_(
+                update, alpha=(1 - group["beta1"]))
+            update = exp_avg
+
+        if group["weight_decay"] != 0:
+            p_data_fp32.add_(p_data_fp32 * (-group["weight_decay"] * lr))
+
+        p_data_fp32.add_(-update)
+
+        for key in state_keys:
+            foreach_copy([state[key] for state in states], list(batch_state[key].unbind(0)))
+        # apply stochastic rounding
+        copy_stochastic_foreach([p.data for p in params], p_data_fp32)
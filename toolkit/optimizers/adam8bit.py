@@ -1,7 +1,8 @@
 import math
 import torch
 from torch.optim import Optimizer
-from toolkit.optimizers.optimizer_utils import copy_stochastic, Auto8bitTensor, stochastic_grad_accummulation
+from toolkit.optimizers.optimizer_utils import copy_stochastic, Auto8bitTensor, stochastic_grad_accummulation, \
+    can_step_foreach, get_foreach_param_groups, stack_auto8bit_tensors, update_auto8bit_tensors, copy_stochastic_foreach
 
 class Adam8bit(Optimizer):
     """
@@ -14,9 +15,10 @@ class Adam8bit(Optimizer):
         eps (float): Term added to denominator to improve numerical stability (default: 1e-8)
         weight_decay (float): Weight decay coefficient (default: 0)
         decouple (bool): Use AdamW style decoupled weight decay (default: True)
+        foreach (bool): Step parameters with the same shape together as stacked batches (default: True)
     """
     def __init__(self, params, lr=1e-3, betas=(0.9, 0.999), eps=1e-8, 
-                 weight_decay=0, decouple=True):
+                 weight_decay=0, decouple=True, foreach=True):
         if not 0.0 <= lr:
             raise ValueError(f"Invalid learning rate: {lr}")
         if not 0.0 <= eps:
@@ -29,7 +31,8 @@ class Adam8bit(Optimizer):
         defaults = dict(lr=lr, betas=betas, eps=eps, weight_decay=weight_decay,
                        decouple=decouple)
         super(Adam8bit, self).__init__(params, defaults)
-        
+
+        self.foreach = foreach
         self.is_stochastic_rounding_accumulation = False
         
         # Setup stochastic grad accumulation hooks
@@ -74,66 +77,125 @@ class Adam8bit(Optimizer):
             loss = closure()
 
         for group in self.param_groups:
-            beta1, beta2 = group['betas']
-            eps = group['eps']
-            lr = group['lr']
-            decay = group['weight_decay']
-            decouple = group['decouple']
-
+            foreach_params = []
             for p in group['params']:
                 if p.grad is None:
                     continue
+                if self.foreach and can_step_foreach(p):
+                    if len(self.state[p]) == 0:
+                        self.initialize_state(p)
+                    foreach_params.append(p)
+                else:
+                    self.step_param(group, p)
 
-                grad = p.grad.data.to(torch.float32)
-                p_fp32 = p.clone().to(torch.float32)
-
-                # Apply weight decay (coupled variant)
-                if decay != 0 and not decouple:
-                    grad.add_(p_fp32.data, alpha=decay)
-
-                state = self.state[p]
-
-                # State initialization
-                if len(state) == 0:
-                    state['step'] = 0
-                    # Exponential moving average of gradient values
-                    state['exp_avg'] = Auto8bitTensor(
-                        torch.zeros_like(p_fp32.data).detach())
-                    # Exponential moving average of squared gradient values
-                    state['exp_avg_sq'] = Auto8bitTensor(
-                        torch.zeros_like(p_fp32.data).detach())
-
-                exp_avg = state['exp_avg'].to(torch.float32)
-                exp_avg_sq = state['exp_avg_sq'].to(torch.float32)
-
-                state['step'] += 1
-                bias_correction1 = 1 - beta1 ** state['step']
-                bias_correction2 = 1 - beta2 ** state['step']
-
-                # Adam EMA updates
-                exp_avg.mul_(beta1).add_(grad, alpha=1-beta1)
-                exp_avg_sq.mul_(beta2).addcmul_(grad, grad, value=1-beta2)
-
-                # Apply weight decay (decoupled variant)
-                if decay != 0 and decouple:
-                    p_fp32.data.mul_(1 - lr * decay)
-
-                # Bias correction
-                step_size = lr / bias_correction1
-                denom = (exp_avg_sq.sqrt() / math.sqrt(bias_correction2)).add_(eps)
-
-                # Take step
-                p_fp32.data.addcdiv_(exp_avg, denom, value=-step_size)
-                
-                # Update state with stochastic rounding
-                state['exp_avg'] = Auto8bitTensor(exp_avg)
-                state['exp_avg_sq'] = Auto8bitTensor(exp_avg_sq)
-                
-                # Apply stochastic rounding to parameters
-                copy_stochastic(p.data, p_fp32.data)
+            for group_params in get_foreach_param_groups(foreach_params, self.state):
+                self.step_foreach(group, group_params)
 
         return loss
-    
+
+    def initialize_state(self, p):
+        state = self.state[p]
+        state['step'] = 0
+        # Exponential moving average of gradient values
+        state['exp_avg'] = Auto8bitTensor(
+            torch.zeros_like(p.data, dtype=torch.float32).detach())
+        # Exponential moving average of squared gradient values
+        state['exp_avg_sq'] = Auto8bitTensor(
+            torch.zeros_like(p.data, dtype=torch.float32).detach())
+
+    def step_param(self, group, p):
+        beta1, beta2 = group['betas']
+        eps = group['eps']
+        lr = group['lr']
+        decay = group['weight_decay']
+        decouple = group['decouple']
+
+        grad = p.grad.data.to(torch.float32)
+        p_fp32 = p.clone().to(torch.float32)
+
+        # Apply weight decay (coupled variant)
+        if decay != 0 and not decouple:
+            grad.add_(p_fp32.data, alpha=decay)
+
+        state = self.state[p]
+
+        # State initialization
+        if len(state) == 0:
+            self.initialize_state(p)
+
+        exp_avg = state['exp_avg'].to(torch.float32)
+        exp_avg_sq = state['exp_avg_sq'].to(torch.float32)
+
+        state['step'] += 1
+        bias_correction1 = 1 - beta1 ** state['step']
+        bias_correction2 = 1 - beta2 ** state['step']
+
+        # Adam EMA updates
+        exp_avg.mul_(beta1).add_(grad, alpha=1-beta1)
+        exp_avg_sq.mul_(beta2).addcmul_(grad, grad, value=1-beta2)
+
+        # Apply weight decay (decoupled variant)
+        if decay != 0 and decouple:
+            p_fp32.data.mul_(1 - lr * decay)
+
+        # Bias correction
+        step_size = lr / bias_correction1
+        denom = (exp_avg_sq.sqrt() / math.sqrt(bias_correction2)).add_(eps)
+
+        # Take step
+        p_fp32.data.addcdiv_(exp_avg, denom, value=-step_size)
+
+        # Update state with stochastic rounding
+        state['exp_avg'] = Auto8bitTensor(exp_avg)
+        state['exp_avg_sq'] = Auto8bitTensor(exp_avg_sq)
+
+        # Apply stochastic rounding to parameters
+        copy_stochastic(p.data, p_fp32.data)
+
+    def step_foreach(self, group, params):
+        # same as step_param for a group of same shaped parameters stacked into one batch
+        beta1, beta2 = group['betas']
+        eps = group['eps']
+        lr = group['lr']
+        decay = group['weight_decay']
+        decouple = group['decouple']
+
+        grad = torch.stack([p.grad.data for p in params]).to(torch.float32)
+        p_fp32 = torch.stack([p.data for p in params]).to(torch.float32)
+
+        # Apply weight decay (coupled variant)
+        if decay != 0 and not decouple:
+            grad.add_(p_fp32, alpha=decay)
+
+        states = [self.state[p] for p in params]
+        exp_avg = stack_auto8bit_tensors([state['exp_avg'] for state in states])
+        exp_avg_sq = stack_auto8bit_tensors([state['exp_avg_sq'] for state in states])
+
+        for state in states:
+            state['step'] += 1
+        bias_correction1 = 1 - beta1 ** states[0]['step']
+        bias_correction2 = 1 - beta2 ** states[0]['step']
+
+        # Adam EMA updates
+        exp_avg.mul_(beta1).add_(grad, alpha=1-beta1)
+        exp_avg_sq.mul_(beta2).addcmul_(grad, grad, value=1-beta2)
+
+        # Apply weight decay (decoupled variant)
+        if decay != 0 and decouple:
+            p_fp32.mul_(1 - lr * decay)
+
+        # Bias correction
+        step_size = lr / bias_correction1
+        denom = (exp_avg_sq.sqrt() / math.sqrt(bias_correction2)).add_(eps)
+
+        # Take step
+        p_fp32.addcdiv_(exp_avg, denom, value=-step_size)
+
+        # Update state and parameters with stochastic rounding
+        update_auto8bit_tensors([state['exp_avg'] for state in states], exp_avg)
+        update_auto8bit_tensors([state['exp_avg_sq'] for state in states], exp_avg_sq)
+        copy_stochastic_foreach([p.data for p in params], p_fp32)
+
     def state_dict(self):
         """Returns the state of the optimizer as a dict."""
         state_dict = super().state_dict()
@@ -2,7 +2,9 @@ from collections import OrderedDict
 import math
 from typing import List
 import torch
-from toolkit.optimizers.optimizer_utils import Auto8bitTensor, copy_stochastic, stochastic_grad_accummulation
+from toolkit.optimizers.optimizer_utils import Auto8bitTensor, copy_stochastic, stochastic_grad_accummulation, \
+    can_step_foreach, get_foreach_param_groups, get_batch_view_shape, foreach_copy, copy_stochastic_foreach, \
+    stack_auto8bit_tensors, update_auto8bit_tensors
 from optimum.quanto import QBytesTensor
 import random
 
@@ -22,6 +24,8 @@ class Automagic(torch.optim.Optimizer):
         weight_decay=0.0,
         do_paramiter_swapping=False,
         paramiter_swapping_factor=0.1,
+        # step parameters with the same shape together as stacked batches instead of one at a time
+        foreach=True,
     ):
         self.lr = lr
         self.min_lr = min_lr
@@ -42,6 +46,7 @@ class Automagic(torch.optim.Optimizer):
             lr for group in self.param_groups
         ]
 
+        self.foreach = foreach
         self.is_stochastic_rounding_accumulation = False
 
         # setup stochastic grad accum hooks
@@ -117,6 +122,11 @@ class Automagic(torch.optim.Optimizer):
     def _rms(tensor):
         return tensor.norm(2) / (tensor.numel() ** 0.5)
 
+    @staticmethod
+    def _rms_batch(batch):
+        # _rms of every tensor in a stacked batch
+        return batch.flatten(1).norm(2, dim=1) / (batch[0].numel() ** 0.5)
+
     @staticmethod
     def _approx_sq_grad(exp_avg_sq_row, exp_avg_sq_col):
         # copy from fairseq's adafactor implementation:
@@ -166,120 +176,218 @@ class Automagic(torch.optim.Optimizer):
             loss = closure()
 
         for group in self.param_groups:
+            foreach_params = []
             for p in group["params"]:
                 if p.grad is None or not p.requires_grad:
                     continue
+                if self.foreach and can_step_foreach(p):
+                    if len(self.state[p]) == 0:
+                        self.initialize_state(p)
+                    foreach_params.append(p)
+                else:
+                    self.step_param(group, p)
 
-                grad = p.grad
-                if grad.dtype != torch.float32:
-                    grad = grad.to(torch.float32)
-                if grad.is_sparse:
-                    raise RuntimeError(
-                        "Automagic does not support sparse gradients.")
+            for group_params in get_foreach_param_groups(foreach_params, self.state):
+                self.step_foreach(group, group_params)
 
-                state = self.state[p]
-                grad_shape = grad.shape
+        return loss
 
-                factored = len(grad_shape) >= 2
-                # State Initialization
-                if len(state) == 0:
-                    self.initialize_state(p)
-                else:
-                    if factored:
-                        state["exp_avg_sq_row"] = state["exp_avg_sq_row"].to(
-                            grad)
-                        state["exp_avg_sq_col"] = state["exp_avg_sq_col"].to(
-                            grad)
-                    else:
-                        state["exp_avg_sq"] = state["exp_avg_sq"].to(grad)
-
-                p_data_fp32 = p
-
-                if isinstance(p_data_fp32, QBytesTensor):
-                    p_data_fp32 = p_data_fp32.dequantize()
-                if p.dtype != torch.float32:
-                    p_data_fp32 = p_data_fp32.clone().float()
-
-                state["step"] += 1
-                state["RMS"] = self._rms(p_data_fp32)
-                # lr = self._get_lr(group, state)
-
-                beta2t = 1.0 - math.pow(state["step"], group["decay_rate"])
-                eps = group["eps"]
-                if isinstance(eps, tuple) or isinstance(eps, list):
-                    eps = eps[0]
-                update = (grad**2) + eps
-                if factored:
-                    exp_avg_sq_row = state["exp_avg_sq_row"]
-                    exp_avg_sq_col = state["exp_avg_sq_col"]
-
-                    exp_avg_sq_row.mul_(beta2t).add_(
-                        update.mean(dim=-1), alpha=(1.0 - beta2t))
-                    exp_avg_sq_col.mul_(beta2t).add_(
-                        update.mean(dim=-2), alpha=(1.0 - beta2t))
-
-                    # Approximation of exponential moving average of square of gradient
-                    update = self._approx_sq_grad(
-                        exp_avg_sq_row, exp_avg_sq_col)
-                    update.mul_(grad)
-                else:
-                    exp_avg_sq = state["exp_avg_sq"]
+    def step_param(self, group, p):
+        grad = p.grad
+        if grad.dtype != torch.float32:
+            grad = grad.to(torch.float32)
+        if grad.is_sparse:
+            raise RuntimeError(
+                "Automagic does not support sparse gradients.")
+
+        state = self.state[p]
+        grad_shape = grad.shape
+
+        factored = len(grad_shape) >= 2
+        # State Initialization
+        if len(state) == 0:
+            self.initialize_state(p)
+        else:
+            if factored:
+                state["exp_avg_sq_row"] = state["exp_avg_sq_row"].to(
+                    grad)
+                state["exp_avg_sq_col"] = state["exp_avg_sq_col"].to(
+                    grad)
+            else:
+                state["exp_avg_sq"] = state["exp_avg_sq"].to(grad)
+
+        p_data_fp32 = p
 
-                    exp_avg_sq.mul_(beta2t).add_(update, alpha=(1.0 - beta2t))
-                    update = exp_avg_sq.rsqrt().mul_(grad)
+        if isinstance(p_data_fp32, QBytesTensor):
+            p_data_fp32 = p_data_fp32.dequantize()
+        if p.dtype != torch.float32:
+            p_data_fp32 = p_data_fp32.clone().float()
 
-                update.div_(
-                    (self._rms(update) / group["clip_threshold"]).clamp_(min=1.0))
+        state["step"] += 1
+        state["RMS"] = self._rms(p_data_fp32)
+        # lr = self._get_lr(group, state)
+
+        beta2t = 1.0 - math.pow(state["step"], group["decay_rate"])
+        eps = group["eps"]
+        if isinstance(eps, tuple) or isinstance(eps, list):
+            eps = eps[0]
+        update = (grad**2) + eps
+        if factored:
+            exp_avg_sq_row = state["exp_avg_sq_row"]
+            exp_avg_sq_col = state["exp_avg_sq_col"]
+
+            exp_avg_sq_row.mul_(beta2t).add_(
+                update.mean(dim=-1), alpha=(1.0 - beta2t))
+            exp_avg_sq_col.mul_(beta2t).add_(
+                update.mean(dim=-2), alpha=(1.0 - beta2t))
+
+            # Approximation of exponential moving average of square of gradient
+            update = self._approx_sq_grad(
+                exp_avg_sq_row, exp_avg_sq_col)
+            update.mul_(grad)
+        else:
+            exp_avg_sq = state["exp_avg_sq"]
+
+            exp_avg_sq.mul_(beta2t).add_(update, alpha=(1.0 - beta2t))
+            update = exp_avg_sq.rsqrt().mul_(grad)
+
+        update.div_(
+            (self._rms(update) / group["clip_threshold"]).clamp_(min=1.0))
+
+        # calculate new lr mask. if the updated param is going in same direction, increase lr, else decrease
+        # update the lr mask. self.lr_momentum is < 1.0. If a paramiter is positive and increasing (or negative and decreasing), increase lr,
+        # for that single paramiter. If a paramiter is negative and increasing or positive and decreasing, decrease lr for that single paramiter.
+        # to decrease lr, multiple by self.lr_momentum, to increase lr, divide by self.lr_momentum.
+
+        # not doing it this way anymore
+        # update.mul_(lr)
+
+        # Get signs of current last update and updates
+        last_polarity = state['last_polarity']
+        current_polarity = (update > 0).to(torch.bool)
+        sign_agreement = torch.where(
+            last_polarity == current_polarity, 1, -1)
+        state['last_polarity'] = current_polarity
+
+        lr_mask = state['lr_mask'].to(torch.float32)
+
+        # Update learning rate mask based on sign agreement
+        new_lr = torch.where(
+            sign_agreement > 0,
+            lr_mask * self.lr_pump_scale,  # Increase lr
+            lr_mask * self.lr_dump_scale  # Decrease lr
+        )
+
+        # Clip learning rates to bounds
+        new_lr = torch.clamp(
+            new_lr,
+            min=self.min_lr,
+            max=self.max_lr
+        )
+
+        # Apply the learning rate mask to the update
+        update.mul_(new_lr)
+
+        state['lr_mask'] = Auto8bitTensor(new_lr)
+        state['avg_lr'] = torch.mean(new_lr)
+
+        if group["weight_decay"] != 0:
+            p_data_fp32.add_(
+                p_data_fp32, alpha=(-group["weight_decay"] * new_lr))
+
+        p_data_fp32.add_(-update)
+
+        if p.dtype != torch.float32:
+            # apply stochastic rounding
+            copy_stochastic(p, p_data_fp32)
+
+    def step_foreach(self, group, params):
+        # same as step_param for a group of same shaped parameters stacked into one batch,
+        # per tensor reductions are done over every dim but the first
+        grad = torch.stack([p.grad for p in params]).to(torch.float32)
+        p_data_fp32 = torch.stack([p.data for p in params]).to(torch.float32)
+        view_shape = get_batch_view_shape(grad)
+
+        states = [self.state[p] for p in params]
+        factored = grad.dim() >= 3
+        state_keys = ["exp_avg_sq_row", "exp_avg_sq_col"] if factored else ["exp_avg_sq"]
+        for state in states:
+            for key in state_keys:
+                state[key] = state[key].to(grad)
+        batch_state = {key: torch.stack([state[key] for state in states]) for key in state_keys}
+
+        for state in states:
+            state["step"] += 1
+        for state, param_rms in zip(states, self._rms_batch(p_data_fp32).unbind(0)):
+            state["RMS"] = param_rms
+
+        beta2t = 1.0 - math.pow(states[0]["step"], group["decay_rate"])
+        eps = group["eps"]
+        if isinstance(eps, tuple) or isinstance(eps, list):
+            eps = eps[0]
+        update = (grad**2) + eps
+        if factored:
+            exp_avg_sq_row = batch_state["exp_avg_sq_row"]
+            exp_avg_sq_col = batch_state["exp_avg_sq_col"]
+
+            exp_avg_sq_row.mul_(beta2t).add_(
+                update.mean(dim=-1), alpha=(1.0 - beta2t))
+            exp_avg_sq_col.mul_(beta2t).add_(
+                update.mean(dim=-2), alpha=(1.0 - beta2t))
+
+            # Approximation of exponential moving average of square of gradient
+            update = self._approx_sq_grad(
+                exp_avg_sq_row, exp_avg_sq_col)
+            update.mul_(grad)
+        else:
+            exp_avg_sq = batch_state["exp_avg_sq"]
 
-                # calculate new lr mask. if the updated param is going in same direction, increase lr, else decrease
-                # update the lr mask. self.lr_momentum is < 1.0. If a paramiter is positive and increasing (or negative and decreasing), increase lr,
-                # for that single paramiter. If a paramiter is negative and increasing or positive and decreasing, decrease lr for that single paramiter.
-                # to decrease lr, multiple by self.lr_momentum, to increase lr, divide by self.lr_momentum.
+            exp_avg_sq.mul_(beta2t).add_(update, alpha=(1.0 - beta2t))
+            update = exp_avg_sq.rsqrt().mul_(grad)
 
-                # not doing it this way anymore
-                # update.mul_(lr)
+        update.div_(
+            (self._rms_batch(update) / group["clip_threshold"]).clamp_(min=1.0).view(view_shape))
 
-                # Get signs of current last update and updates
-                last_polarity = state['last_polarity']
-                current_polarity = (update > 0).to(torch.bool)
-                sign_agreement = torch.where(
-                    last_polarity == current_polarity, 1, -1)
-                state['last_polarity'] = current_polarity
+        # Get signs of current last update and updates
+        last_polarity = torch.stack([state['last_polarity'] for state in states])
+        current_polarity = (update > 0).to(torch.bool)
+        sign_agreement = torch.where(
+            last_polarity == current_polarity, 1, -1)
+        foreach_copy([state['last_polarity'] for state in states], list(current_polarity.unbind(0)))
 
-                lr_mask = state['lr_mask'].to(torch.float32)
+        lr_mask = stack_auto8bit_tensors([state['lr_mask'] for state in states])
 
-                # Update learning rate mask based on sign agreement
-                new_lr = torch.where(
-                    sign_agreement > 0,
-                    lr_mask * self.lr_pump_scale,  # Increase lr
-                    lr_mask * self.lr_dump_scale  # Decrease lr
-                )
+        # Update learning rate mask based on sign agreement
+        new_lr = torch.where(
+            sign_agreement > 0,
+            lr_mask * self.lr_pump_scale,  # Increase lr
+            lr_mask * self.lr_dump_scale  # Decrease lr
+        )
 
-                # Clip learning rates to bounds
-                new_lr = torch.clamp(
-                    new_lr,
-                    min=self.min_lr,
-                    max=self.max_lr
-                )
+        # Clip learning rates to bounds
+        new_lr = torch.clamp(
+            new_lr,
+            min=self.min_lr,
+            max=self.max_lr
+        )
 
-                # Apply the learning rate mask to the update
-                update.mul_(new_lr)
+        # Apply the learning rate mask to the update
+        update.mul_(new_lr)
 
-                state['lr_mask'] = Auto8bitTensor(new_lr)
-                state['avg_lr'] = torch.mean(new_lr)
+        update_auto8bit_tensors([state['lr_mask'] for state in states], new_lr)
+        for state, avg_lr in zip(states, new_lr.flatten(1).mean(dim=1).unbind(0)):
+            state['avg_lr'] = avg_lr
 
-                if group["weight_decay"] != 0:
-                    p_data_fp32.add_(
-                        p_data_fp32, alpha=(-group["weight_decay"] * new_lr))
+        if group["weight_decay"] != 0:
+            p_data_fp32.add_(p_data_fp32 * (-group["weight_decay"] * new_lr))
 
-                p_data_fp32.add_(-update)
+        p_data_fp32.add_(-update)
 
-                if p.dtype != torch.float32:
-                    # apply stochastic rounding
-                    copy_stochastic(p, p_data_fp32)
+        for key in state_keys:
+            foreach_copy([state[key] for state in states], list(batch_state[key].unbind(0)))
+        # apply stochastic rounding
+        copy_stochastic_foreach([p.data for p in params], p_data_fp32)
 
-        return loss
-    
     def initialize_state(self, p):
         state = self.state[p]
         state["step"] = 0
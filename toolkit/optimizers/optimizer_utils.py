@@ -1,6 +1,7 @@
 import torch
 from torch import Tensor
-from typing import Optional
+from collections import OrderedDict
+from typing import Optional, List
 from optimum.quanto import QBytesTensor
 
 
@@ -244,6 +245,97 @@ class Auto8bitTensor:
         return f"Auto8bitTensor({self.dequantize()})"
 
 
+# parameter dtypes the multi tensor optimizer steps handle, others go through the per parameter step
+FOREACH_DTYPES = (torch.float32, torch.bfloat16, torch.float16)
+# most elements stacked into one batch by a multi tensor step, bounds the temporary float32 copies
+FOREACH_CHUNK_NUMEL = 16 * 1024 * 1024
+# larger parameters are stepped one at a time. Their ops already amortize the per op overhead and stacking
+# them only adds copies. Kernel launches cost far more on gpus than dispatch does on cpu, so the limit is higher
+FOREACH_MAX_PARAM_NUMEL = {'cpu': 4096}
+FOREACH_DEFAULT_MAX_PARAM_NUMEL = 1024 * 1024
+
+
+def can_step_foreach(param) -> bool:
+    max_numel = FOREACH_MAX_PARAM_NUMEL.get(param.device.type, FOREACH_DEFAULT_MAX_PARAM_NUMEL)
+    return type(param.data) is torch.Tensor and param.dtype in FOREACH_DTYPES and \
+        not param.grad.is_sparse and param.numel() <= max_numel
+
+
+def get_foreach_param_groups(params, state, max_numel: int = FOREACH_CHUNK_NUMEL) -> List[list]:
+    """
+    Splits parameters into groups that can be stacked into one batch and stepped together. Parameters in a
+    group share device, dtype, shape and step count, so every per parameter reduction becomes a reduction
+    over the batch and all scalars derived from the step are the same for the whole group.
+    """
+    groups = OrderedDict()
+    for param in params:
+        key = (param.device, param.dtype, param.grad.dtype, tuple(param.shape), state[param].get('step', 0))
+        groups.setdefault(key, []).append(param)
+
+    chunks = []
+    for group_params in groups.values():
+        chunk = []
+        chunk_numel = 0
+        for param in group_params:
+            if len(chunk) > 0 and chunk_numel + param.numel() > max_numel:
+                chunks.append(chunk)
+                chunk = []
+                chunk_numel = 0
+            chunk.append(param)
+            chunk_numel += param.numel()
+        if len(chunk) > 0:
+            chunks.append(chunk)
+    return chunks
+
+
+def get_batch_view_shape(batch: Tensor) -> tuple:
+    # shape that broadcasts one value per tensor against a stacked batch
+    return (-1,) + (1,) * (batch.dim() - 1)
+
+
+def foreach_copy(targets: List[Tensor], sources: List[Tensor]) -> None:
+    if hasattr(torch, '_foreach_copy_'):
+        torch._foreach_copy_(targets, sources)
+    else:
+        for target, source in zip(targets, sources):
+            target.copy_(source)
+
+
+def copy_stochastic_foreach(targets: List[Tensor], source: Tensor) -> None:
+    """
+    Copies a stacked batch or flat concatenation of float32 values back into the tensors it was built from.
+    Lower precision targets are stochastically rounded in a single copy_stochastic pass over the whole
+    source instead of one pass per tensor. All targets must share a dtype.
+    """
+    if targets[0].dtype != torch.float32:
+        rounded = torch.empty_like(source, dtype=targets[0].dtype)
+        copy_stochastic(rounded, source)
+        source = rounded
+    sources = source.reshape(-1).split([target.numel() for target in targets])
+    foreach_copy(targets, [s.view_as(target) for s, target in zip(sources, targets)])
+
+
+def stack_auto8bit_tensors(tensors: List['Auto8bitTensor']) -> Tensor:
+    # dequantizes same shaped Auto8bitTensors into one float32 batch
+    batch = torch.stack([t.quantized for t in tensors]).to(torch.float32)
+    scales = torch.tensor([float(t.scale) for t in tensors], dtype=torch.float32, device=batch.device)
+    return batch.mul_(scales.view(get_batch_view_shape(batch)))
+
+
+def update_auto8bit_tensors(tensors: List['Auto8bitTensor'], batch: Tensor) -> None:
+    """
+    Quantizes a float32 batch back into the Auto8bitTensors it was stacked from, with the same per tensor
+    scale as building a new Auto8bitTensor from each one. Only needs a single sync for all the scales.
+    """
+    abs_maxes = torch.linalg.vector_norm(batch.flatten(1), float('inf'), dim=1).tolist()
+    scales = [abs_max / 127.0 if abs_max > 0 else 1.0 for abs_max in abs_maxes]
+    scale_batch = torch.tensor(scales, dtype=batch.dtype, device=batch.device).view(get_batch_view_shape(batch))
+    quantized = (batch / scale_batch).round_().clamp_(-127, 127).to(torch.int8)
+    foreach_copy([t.quantized for t in tensors], list(quantized.unbind(0)))
+    for t, scale in zip(tensors, scales):
+        t.scale = scale
+
+
 def stochastic_grad_accummulation(param):
     if hasattr(param, "_accum_grad"):
         grad_fp32 = param._accum_grad.clone().to(torch.float32)
@@ -2,7 +2,8 @@ import math
 import torch
 import torch.distributed as dist
 from torch.optim import Optimizer
-from toolkit.optimizers.optimizer_utils import copy_stochastic, Auto8bitTensor, stochastic_grad_accummulation
+from toolkit.optimizers.optimizer_utils import copy_stochastic, Auto8bitTensor, stochastic_grad_accummulation, \
+    can_step_foreach, get_foreach_param_groups, stack_auto8bit_tensors, update_auto8bit_tensors, copy_stochastic_foreach
 
 
 class Prodigy8bit(Optimizer):
@@ -46,6 +47,8 @@ class Prodigy8bit(Optimizer):
             If you're using sharded parameters, this should be set to True. The optimizer
             will attempt to auto-detect this, but if you're using an implementation other
             than PyTorch's builtin version, the auto-detection won't work.
+        foreach (bool):
+            Step parameters with the same shape together as stacked batches instead of one at a time (default True).
     """
 
     def __init__(self, params, lr=1.0,
@@ -53,7 +56,7 @@ class Prodigy8bit(Optimizer):
                  eps=1e-8, weight_decay=0, decouple=True,
                  use_bias_correction=False, safeguard_warmup=False,
                  d0=1e-6, d_coef=1.0, growth_rate=float('inf'),
-                 fsdp_in_use=False):
+                 fsdp_in_use=False, foreach=True):
         if not 0.0 < d0:
             raise ValueError("Invalid d0 value: {}".format(d0))
         if not 0.0 < lr:
@@ -81,6 +84,7 @@ class Prodigy8bit(Optimizer):
         self.d0 = d0
         super(Prodigy8bit, self).__init__(params, defaults)
 
+        self.foreach = foreach
         self.is_stochastic_rounding_accumulation = False
 
         # setup stochastic grad accum hooks
@@ -153,6 +157,8 @@ class Prodigy8bit(Optimizer):
         d_numerator = group['d_numerator']
         d_numerator *= beta3
 
+        # batches of parameters stepped together, per param group
+        foreach_param_groups = []
         for group in self.param_groups:
             decay = group['weight_decay']
             k = group['k']
@@ -165,12 +171,19 @@ class Prodigy8bit(Optimizer):
                 raise RuntimeError(
                     f"Setting different lr values in different parameter groups is only supported for values of 0")
 
+            foreach_params = []
             for p in group['params']:
                 if p.grad is None:
                     continue
                 if hasattr(p, "_fsdp_flattened"):
                     fsdp_in_use = True
 
+                if self.foreach and can_step_foreach(p):
+                    if 'step' not in self.state[p]:
+                        self.initialize_state(p)
+                    foreach_params.append(p)
+                    continue
+
                 grad = p.grad.data.to(torch.float32)
                 p_fp32 = p.clone().to(torch.float32)
 
@@ -182,16 +195,7 @@ class Prodigy8bit(Optimizer):
 
                 # State initialization
                 if 'step' not in state:
-                    state['step'] = 0
-                    state['s'] = Auto8bitTensor(
-                        torch.zeros_like(p_fp32.data).detach())
-                    state['p0'] = Auto8bitTensor(p_fp32.detach().clone())
-                    # Exponential moving average of gradient values
-                    state['exp_avg'] = Auto8bitTensor(
-                        torch.zeros_like(p_fp32.data).detach())
-                    # Exponential moving average of squared gradient values
-                    state['exp_avg_sq'] = Auto8bitTensor(
-                        torch.zeros_like(p_fp32.data).detach())
+                    self.initialize_state(p)
 
                 exp_avg = state['exp_avg'].to(torch.float32)
                 exp_avg_sq = state['exp_avg_sq'].to(torch.float32)
@@ -221,6 +225,44 @@ class Prodigy8bit(Optimizer):
                 state['s'] = Auto8bitTensor(s)
                 state['p0'] = Auto8bitTensor(p0)
 
+            # same as above for same shaped parameters stacked into batches, with one sync per batch
+            # for the d estimate instead of two per parameter
+            foreach_param_groups.append(get_foreach_param_groups(foreach_params, self.state))
+            for group_params in foreach_param_groups[-1]:
+                grad = torch.stack([p.grad.data for p in group_params]).to(torch.float32)
+                p_fp32 = torch.stack([p.data for p in group_params]).to(torch.float32)
+
+                # Apply weight decay (coupled variant)
+                if decay != 0 and not decouple:
+                    grad.add_(p_fp32, alpha=decay)
+
+                states = [self.state[p] for p in group_params]
+                exp_avg = stack_auto8bit_tensors([state['exp_avg'] for state in states])
+                exp_avg_sq = stack_auto8bit_tensors([state['exp_avg_sq'] for state in states])
+                s = stack_auto8bit_tensors([state['s'] for state in states])
+                p0 = stack_auto8bit_tensors([state['p0'] for state in states])
+
+                if group_lr > 0.0:
+                    for dot in (grad.flatten(1) * (p0 - p_fp32).flatten(1)).sum(dim=1).tolist():
+                        d_numerator += (d / d0) * dlr * dot
+
+                    # Adam EMA updates
+                    exp_avg.mul_(beta1).add_(grad, alpha=d * (1-beta1))
+                    exp_avg_sq.mul_(beta2).addcmul_(
+                        grad, grad, value=d * d * (1-beta2))
+
+                    if safeguard_warmup:
+                        s.mul_(beta3).add_(grad, alpha=((d / d0) * d))
+                    else:
+                        s.mul_(beta3).add_(grad, alpha=((d / d0) * dlr))
+                    d_denom += sum(s.abs().flatten(1).sum(dim=1).tolist())
+
+                # update state with stochastic rounding
+                update_auto8bit_tensors([state['exp_avg'] for state in states], exp_avg)
+                update_auto8bit_tensors([state['exp_avg_sq'] for state in states], exp_avg_sq)
+                update_auto8bit_tensors([state['s'] for state in states], s)
+                update_auto8bit_tensors([state['p0'] for state in states], p0)
+
         d_hat = d
 
         # if we have not done any progres, return
@@ -246,7 +288,7 @@ class Prodigy8bit(Optimizer):
             d_max = max(d_max, d_hat)
             d = min(d_max, d * growth_rate)
 
-        for group in self.param_groups:
+        for group, foreach_params in zip(self.param_groups, foreach_param_groups):
             group['d_numerator'] = global_d_numerator
             group['d_denom'] = global_d_denom
             group['d'] = d
@@ -257,8 +299,9 @@ class Prodigy8bit(Optimizer):
             k = group['k']
             eps = group['eps']
 
+            foreach_param_set = set(p for group_params in foreach_params for p in group_params)
             for p in group['params']:
-                if p.grad is None:
+                if p.grad is None or p in foreach_param_set:
                     continue
                 grad = p.grad.data.to(torch.float32)
                 p_fp32 = p.clone().to(torch.float32)
@@ -281,6 +324,69 @@ class Prodigy8bit(Optimizer):
                 # apply stochastic rounding
                 copy_stochastic(p.data, p_fp32.data)
 
+            for group_params in foreach_params:
+                p_fp32 = torch.stack([p.data for p in group_params]).to(torch.float32)
+
+                states = [self.state[p] for p in group_params]
+                exp_avg = stack_auto8bit_tensors([state['exp_avg'] for state in states])
+                exp_avg_sq = stack_auto8bit_tensors([state['exp_avg_sq'] for state in states])
+
+                for state in states:
+                    state['step'] += 1
+
+                denom = exp_avg_sq.sqrt().add_(d * eps)
+
+                # Apply weight decay (decoupled variant)
+                if decay != 0 and decouple:
+                    p_fp32.add_(p_fp32, alpha=-decay * dlr)
+
+                # Take step
+                p_fp32.addcdiv_(exp_avg, denom, value=-dlr)
+                # apply stochastic rounding
+                copy_stochastic_foreach([p.data for p in group_params], p_fp32)
+
             group['k'] = k + 1
 
         return loss
+
+    def initialize_state(self, p):
+        state = self.state[p]
+        p_fp32 = p.data.to(torch.float32)
+        state['step'] = 0
+        state['s'] = Auto8bitTensor(
+            torch.zeros_like(p_fp32).detach())
+        state['p0'] = Auto8bitTensor(p_fp32.detach().clone())
+        # Exponential moving average of gradient values
+        state['exp_avg'] = Auto8bitTensor(
+            torch.zeros_like(p_fp32).detach())
+        # Exponential moving average of squared gradient values
+        state['exp_avg_sq'] = Auto8bitTensor(
+            torch.zeros_like(p_fp32).detach())
+
+    def state_dict(self):
+        """Returns the state of the optimizer as a dict."""
+        state_dict = super().state_dict()
+
+        # Convert Auto8bitTensor objects to regular state dicts. The per param dicts are the live state, so
+        # they are rebuilt instead of changed in place
+        state_dict['state'] = {
+            param_id: {
+                key: {'_type': 'Auto8bitTensor', 'state': value.state_dict()}
+                if isinstance(value, Auto8bitTensor) else value
+                for key, value in param_state.items()
+            }
+            for param_id, param_state in state_dict['state'].items()
+        }
+
+        return state_dict
+
+    def load_state_dict(self, state_dict):
+        """Loads the optimizer state."""
+        # First, load the basic state
+        super().load_state_dict(state_dict)
+
+        # Then convert any Auto8bitTensor states back to objects
+        for param_id, param_state in self.state.items():
+            for key, value in param_state.items():
+                if isinstance(value, dict) and value.get('_type') == 'Auto8bitTensor':
+                    param_state[key] = Auto8bitTensor(value['state'])
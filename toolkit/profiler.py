@@ -0,0 +1,231 @@
+import json
+import os
+import time
+from collections import OrderedDict
+from typing import TYPE_CHECKING, List, Union
+
+import numpy as np
+import torch
+
+if TYPE_CHECKING:
+    from toolkit.config_modules import ProfilerConfig
+
+# percentiles reported for every span
+PROFILER_PERCENTILES = [50, 90, 99]
+
+
+class StepProfiler:
+    """
+    Records every Timer span for a window of training steps, with optional cuda event timing, and writes a
+    chrome trace and a per span summary to the output folder when the window ends.
+    """
+
+    def __init__(self, config: 'ProfilerConfig', output_dir: str):
+        self.config = config
+        self.output_dir = config.output_dir if config.output_dir is not None else output_dir
+        self.use_device_events = config.device_timing and torch.cuda.is_available()
+        self.active = False
+        self.finished = False
+        self.window_start_step = None
+        self.steps_done = 0
+        self.current_step = None
+        self.spans = []
+        self.open_spans = {}
+        self.torch_profiler = None
+        # host time of a cuda event recorded at the start of the window, to place gpu spans on the host timeline
+        self.reference_time = None
+        self.reference_event = None
+        self.window_start_time = None
+
+    def _sync(self):
+        if torch.cuda.is_available():
+            torch.cuda.synchronize()
+
+    def _start_window(self, step: int):
+        self.active = True
+        self.window_start_step = step
+        self.steps_done = 0
+        self.spans = []
+        self.open_spans = {}
+        if self.use_device_events:
+            self._sync()
+            self.reference_event = torch.cuda.Event(enable_timing=True)
+            self.reference_event.record()
+        self.reference_time = time.perf_counter()
+        self.window_start_time = self.reference_time
+        if self.config.torch_profiler:
+            activities = [torch.profiler.ProfilerActivity.CPU]
+            if torch.cuda.is_available():
+                activities.append(torch.profiler.ProfilerActivity.CUDA)
+            self.torch_profiler = torch.profiler.profile(activities=activities)
+            self.torch_profiler.__enter__()
+        print(f"Profiling steps {step} to {step + self.config.num_steps - 1}")
+
+    def step_start(self, step: int):
+        if not self.config.enabled or self.finished:
+            return
+        # resumed runs that start past start_step still get a window
+        if not self.active and step >= self.config.start_step:
+            self._start_window(step)
+        if self.active:
+            # an iteration that continued before step_end leaves its step open
+            if 'step' in self.open_spans:
+                self.step_end()
+                if not self.active:
+                    return
+            self.current_step = step
+            self.span_start('step')
+
+    def step_end(self):
+        if not self.active:
+            return
+        self.span_end('step')
+        self.steps_done += 1
+        if self.steps_done >= self.config.num_steps:
+            self.finish()
+
+    def span_start(self, name: str):
+        if not self.active:
+            return
+        if self.config.synchronize:
+            self._sync()
+        span = {'name': name, 'step': self.current_step}
+        if self.torch_profiler is not None:
+            # shows the span in the torch trace as well
+            span['record_function'] = torch.profiler.record_function(name)
+            span['record_function'].__enter__()
+        if self.use_device_events:
+            span['start_event'] = torch.cuda.Event(enable_timing=True)
+            span['start_event'].record()
+        span['start'] = time.perf_counter()
+        self.open_spans[name] = span
+
+    def span_end(self, name: str):
+        span = self.open_spans.pop(name, None)
+        if span is None:
+            return
+        if self.config.synchronize:
+            self._sync()
+        span['end'] = time.perf_counter()
+        if self.use_device_events:
+            span['end_event'] = torch.cuda.Event(enable_timing=True)
+            span['end_event'].record()
+        if 'record_function' in span:
+            span['record_function'].__exit__(None, None, None)
+            del span['record_function']
+        self.spans.append(span)
+
+    def span_cancel(self, name: str):
+        span = self.open_spans.pop(name, None)
+        if span is not None and 'record_function' in span:
+            span['record_function'].__exit__(None, None, None)
+
+    def finish(self):
+        # ends the window early if training stops inside it
+        if not self.active:
+            return
+        for name in list(self.open_spans.keys()):
+            self.span_cancel(name)
+        self.active = False
+        self.finished = True
+        if self.use_device_events:
+            # one sync for every event recorded in the window
+            self._sync()
+            for span in self.spans:
+                span['device_start'] = self.reference_time + \
+                    self.reference_event.elapsed_time(span['start_event']) / 1000
+                span['device_duration'] = span['start_event'].elapsed_time(span['end_event']) / 1000
+                del span['start_event']
+                del span['end_event']
+
+        end_step = self.window_start_step + self.steps_done - 1
+        file_suffix = f"{self.window_start_step}-{end_step}"
+        os.makedirs(self.output_dir, exist_ok=True)
+        if self.torch_profiler is not None:
+            self.torch_profiler.__exit__(None, None, None)
+            self.torch_profiler.export_chrome_trace(os.path.join(self.output_dir, f"torch_trace_{file_suffix}.json"))
+            self.torch_profiler = None
+
+        with open(os.path.join(self.output_dir, f"trace_{file_suffix}.json"), 'w') as f:
+            json.dump(self.get_chrome_trace(), f)
+        summary = self.get_summary()
+        with open(os.path.join(self.output_dir, f"summary_{file_suffix}.json"), 'w') as f:
+            json.dump(summary, f, indent=4)
+        self.print_summary(summary)
+        print(f"Profile written to {self.output_dir}")
+
+    def get_chrome_trace(self) -> dict:
+        events = []
+        for tid, track in enumerate(['host', 'gpu']):
+            events.append({'name': 'thread_name', 'ph': 'M', 'pid': 0, 'tid': tid, 'args': {'name': track}})
+        for span in self.spans:
+            events.append({
+                'name': span['name'],
+                'ph': 'X',
+                'pid': 0,
+                'tid': 0,
+                # microseconds from the start of the window
+                'ts': (span['start'] - self.window_start_time) * 1e6,
+                'dur': (span['end'] - span['start']) * 1e6,
+                'args': {'step': span['step']},
+            })
+            if 'device_duration' in span:
+                events.append({
+                    'name': span['name'],
+                    'ph': 'X',
+                    'pid': 0,
+                    'tid': 1,
+                    'ts': (span['device_start'] - self.window_start_time) * 1e6,
+                    'dur': span['device_duration'] * 1e6,
+                    'args': {'step': span['step']},
+                })
+        return {'traceEvents': events, 'displayTimeUnit': 'ms'}
+
+    def _get_stats(self, durations: List[float], step_total: float) -> OrderedDict:
+        values = np.array(durations)
+        stats = OrderedDict([
+            ('count', len(durations)),
+            ('total', float(values.sum())),
+            ('mean', float(values.mean())),
+        ])
+        for percentile in PROFILER_PERCENTILES:
+            stats[f"p{percentile}"] = float(np.percentile(values, percentile))
+        stats['max'] = float(values.max())
+        stats['step_share'] = float(values.sum() / step_total) if step_total > 0 else 0.0
+        return stats
+
+    def get_summary(self) -> OrderedDict:
+        # seconds, per span name, sorted by total host time
+        host = OrderedDict()
+        device = OrderedDict()
+        for span in self.spans:
+            host.setdefault(span['name'], []).append(span['end'] - span['start'])
+            if 'device_duration' in span:
+                device.setdefault(span['name'], []).append(span['device_duration'])
+        host_step_total = sum(host.get('step', []))
+        device_step_total = sum(device.get('step', []))
+
+        summary = OrderedDict([
+            ('start_step', self.window_start_step),
+            ('num_steps', self.steps_done),
+            ('spans', OrderedDict()),
+        ])
+        for name, durations in sorted(host.items(), key=lambda x: sum(x[1]), reverse=True):
+            span_summary = OrderedDict([('host', self._get_stats(durations, host_step_total))])
+            if name in device:
+                span_summary['device'] = self._get_stats(device[name], device_step_total)
+            summary['spans'][name] = span_summary
+        return summary
+
+    def print_summary(self, summary: Union[dict, None] = None):
+        summary = summary if summary is not None else self.get_summary()
+        print(f"\nProfile of steps {summary['start_step']} to {summary['start_step'] + summary['num_steps'] - 1}:")
+        print(f" {'span':<28} {'count':>6} {'mean ms':>9} {'p50 ms':>9} {'p90 ms':>9} {'p99 ms':>9} "
+              f"{'step %':>7} {'gpu mean ms':>12}")
+        for name, span_summary in summary['spans'].items():
+            host = span_summary['host']
+            device_mean = f"{span_summary['device']['mean'] * 1000:>12.2f}" if 'device' in span_summary else f"{'':>12}"
+            print(f" {name[:28]:<28} {host['count']:>6} {host['mean'] * 1000:>9.2f} {host['p50'] * 1000:>9.2f} "
+                  f"{host['p90'] * 1000:>9.2f} {host['p99'] * 1000:>9.2f} {host['step_share'] * 100:>6.1f}% "
+                  f"{device_mean}")
+        print('')
@@ -62,6 +62,23 @@ class PromptEmbeds:
             prompt_embeds.attention_mask = self.attention_mask.clone()
         return prompt_embeds
 
+    def save(self, path: str, metadata: Optional[dict] = None):
+        state_dict = {
+            'text_embeds': self.text_embeds.detach().cpu().contiguous(),
+        }
+        if self.pooled_embeds is not None:
+            state_dict['pooled_embeds'] = self.pooled_embeds.detach().cpu().contiguous()
+        if self.attention_mask is not None:
+            state_dict['attention_mask'] = self.attention_mask.detach().cpu().contiguous()
+        save_file(state_dict, path, metadata=metadata)
+
+    @classmethod
+    def load(cls, path: str, device='cpu') -> 'PromptEmbeds':
+        state_dict = load_file(path, device=device)
+        prompt_embeds = cls([state_dict['text_embeds'], state_dict.get('pooled_embeds', None)])
+        prompt_embeds.attention_mask = state_dict.get('attention_mask', None)
+        return prompt_embeds
+
 
 class EncodedPromptPair:
     def __init__(
@@ -135,7 +152,10 @@ def concat_prompt_embeds(prompt_embeds: list[PromptEmbeds]):
     pooled_embeds = None
     if prompt_embeds[0].pooled_embeds is not None:
         pooled_embeds = torch.cat([p.pooled_embeds for p in prompt_embeds], dim=0)
-    return PromptEmbeds([text_embeds, pooled_embeds])
+    concatenated = PromptEmbeds([text_embeds, pooled_embeds])
+    if all([p.attention_mask is not None for p in prompt_embeds]):
+        concatenated.attention_mask = torch.cat([p.attention_mask for p in prompt_embeds], dim=0)
+    return concatenated
 
 
 def concat_prompt_pairs(prompt_pairs: list[EncodedPromptPair]):
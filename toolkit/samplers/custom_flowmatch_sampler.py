@@ -4,6 +4,8 @@ from typing import Union
 from diffusers import FlowMatchEulerDiscreteScheduler
 import torch
 
+from toolkit.samplers.timestep_utils import get_timestep_indices, get_sigmas_for_timesteps
+
 
 class CustomFlowMatchEulerDiscreteScheduler(FlowMatchEulerDiscreteScheduler):
     def __init__(self, *args, **kwargs):
@@ -41,7 +43,7 @@ class CustomFlowMatchEulerDiscreteScheduler(FlowMatchEulerDiscreteScheduler):
 
     def get_weights_for_timesteps(self, timesteps: torch.Tensor, v2=False) -> torch.Tensor:
         # Get the indices of the timesteps
-        step_indices = [(self.timesteps == t).nonzero().item() for t in timesteps]
+        step_indices = get_timestep_indices(self.timesteps, timesteps).to(self.linear_timesteps_weights.device)
 
         # Get the weights for the timesteps
         if v2:
@@ -54,14 +56,7 @@ class CustomFlowMatchEulerDiscreteScheduler(FlowMatchEulerDiscreteScheduler):
     def get_sigmas(self, timesteps: torch.Tensor, n_dim, dtype, device) -> torch.Tensor:
         sigmas = self.sigmas.to(device=device, dtype=dtype)
         schedule_timesteps = self.timesteps.to(device)
-        timesteps = timesteps.to(device)
-        step_indices = [(schedule_timesteps == t).nonzero().item() for t in timesteps]
-
-        sigma = sigmas[step_indices].flatten()
-        while len(sigma.shape) < n_dim:
-            sigma = sigma.unsqueeze(-1)
-
-        return sigma
+        return get_sigmas_for_timesteps(sigmas, schedule_timesteps, timesteps, n_dim)
 
     def add_noise(
             self,
@@ -0,0 +1,30 @@
+import torch
+
+
+def get_timestep_indices(schedule_timesteps: torch.Tensor, timesteps: torch.Tensor) -> torch.Tensor:
+    """
+    Index of every timestep in a schedule, found with one searchsorted on the device instead of a
+    nonzero().item() sync per timestep. Schedules are sorted high to low like the diffusers schedulers.
+    Timesteps that are not in the schedule get the index of the closest one.
+    """
+    # searchsorted needs ascending values
+    ascending = schedule_timesteps.flip(0)
+    timesteps = timesteps.to(device=ascending.device, dtype=ascending.dtype).flatten()
+    right = torch.searchsorted(ascending, timesteps).clamp(max=len(ascending) - 1)
+    left = (right - 1).clamp(min=0)
+    use_left = (timesteps - ascending[left]).abs() < (ascending[right] - timesteps).abs()
+    ascending_indices = torch.where(use_left, left, right)
+    return len(ascending) - 1 - ascending_indices
+
+
+def get_sigmas_for_timesteps(
+        sigmas: torch.Tensor,
+        schedule_timesteps: torch.Tensor,
+        timesteps: torch.Tensor,
+        n_dim: int,
+) -> torch.Tensor:
+    # sigma for each timestep, unsqueezed to broadcast against samples with n_dim dims
+    sigma = sigmas[get_timestep_indices(schedule_timesteps, timesteps).to(sigmas.device)].flatten()
+    while len(sigma.shape) < n_dim:
+        sigma = sigma.unsqueeze(-1)
+    return sigma
@@ -0,0 +1,184 @@
+import json
+import mmap
+import os
+from collections import OrderedDict
+from typing import Dict, List, Union
+
+import torch
+
+# shards roll over once they reach this size
+DEFAULT_MAX_SHARD_SIZE = 1024 * 1024 * 1024
+# tensor data is aligned so it can be viewed in place with any dtype
+ALIGNMENT = 64
+INDEX_FILENAME = 'index.jsonl'
+
+
+class ShardedTensorStore:
+    """
+    Append only store for many small state dicts (latents, clip embeddings, etc.)
+
+    Tensors are written back to back into a few large shard files and an index maps each key to the
+    location of its tensors. Reads memory map the shards and return tensors that view the mapped data
+    directly, so loading an item does not open a file or copy anything.
+
+    Layout:
+        {root}/index.jsonl         one json line per item. Later lines override earlier ones for the same key
+        {root}/shard_00000.bin     raw tensor data
+
+    Every writer appends to a shard it created itself, so concurrent jobs on the same folder do not
+    overwrite each other's data.
+    """
+
+    def __init__(self, root: str, max_shard_size: int = DEFAULT_MAX_SHARD_SIZE):
+        self.root = root
+        self.max_shard_size = max_shard_size
+        self.index: Dict[str, dict] = {}
+        self._index_offset = 0
+        self._mmaps: Dict[str, mmap.mmap] = {}
+        self._write_shard: Union[str, None] = None
+        self._write_file = None
+        self.load_index()
+
+    @property
+    def index_path(self):
+        return os.path.join(self.root, INDEX_FILENAME)
+
+    def load_index(self):
+        # only read what was appended since the last time we looked
+        if not os.path.exists(self.index_path):
+            return
+        with open(self.index_path, 'rb') as f:
+            f.seek(self._index_offset)
+            for line in f:
+                if not line.endswith(b'\n'):
+                    # partially written line from another writer, pick it up next time
+                    break
+                self._index_offset += len(line)
+                line = line.strip()
+                if len(line) == 0:
+                    continue
+                entry = json.loads(line.decode('utf-8'))
+                self.index[entry['key']] = entry
+
+    def __contains__(self, key: str):
+        if key not in self.index:
+            self.load_index()
+        return key in self.index
+
+    def __len__(self):
+        return len(self.index)
+
+    def keys(self) -> List[str]:
+        return list(self.index.keys())
+
+    def get_metadata(self, key: str) -> Union[dict, None]:
+        if key not in self:
+            raise KeyError(key)
+        return self.index[key].get('metadata', None)
+
+    def _get_mmap(self, shard: str, min_size: int) -> mmap.mmap:
+        mm = self._mmaps.get(shard, None)
+        if mm is None or len(mm) < min_size:
+            # shard grew since we mapped it. The old map is not closed since tensors handed out
+            # earlier may still view it, it is released once they are garbage collected
+            with open(os.path.join(self.root, shard), 'rb') as f:
+                # copy on write so torch gets a writable buffer without ever touching the file
+                mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_COPY)
+            self._mmaps[shard] = mm
+        return mm
+
+    def get(self, key: str) -> 'OrderedDict[str, torch.Tensor]':
+        if key not in self:
+            raise KeyError(key)
+        entry = self.index[key]
+        state_dict = OrderedDict()
+        for name, info in entry['tensors'].items():
+            dtype = getattr(torch, info['dtype'])
+            shape = info['shape']
+            numel = 1
+            for dim in shape:
+                numel *= dim
+            if numel == 0:
+                state_dict[name] = torch.empty(shape, dtype=dtype)
+                continue
+            mm = self._get_mmap(entry['shard'], info['offset'] + info['nbytes'])
+            tensor = torch.frombuffer(mm, dtype=dtype, count=numel, offset=info['offset'])
+            state_dict[name] = tensor.reshape(shape)
+        return state_dict
+
+    def _open_new_shard(self):
+        self.close_writer()
+        os.makedirs(self.root, exist_ok=True)
+        shard_idx = 0
+        while True:
+            shard = f'shard_{shard_idx:05d}.bin'
+            try:
+                # exclusive create so we never append to a shard another writer owns
+                fd = os.open(os.path.join(self.root, shard), os.O_CREAT | os.O_EXCL | os.O_WRONLY, 0o644)
+                break
+            except FileExistsError:
+                shard_idx += 1
+        self._write_shard = shard
+        self._write_file = os.fdopen(fd, 'wb')
+
+    def put(self, key: str, state_dict: Dict[str, torch.Tensor], metadata: Union[dict, None] = None):
+        if self._write_file is None or self._write_file.tell() >= self.max_shard_size:
+            self._open_new_shard()
+
+        tensors = OrderedDict()
+        for name, tensor in state_dict.items():
+            tensor = tensor.detach().cpu().contiguous()
+            offset = self._write_file.tell()
+            padding = (ALIGNMENT - offset % ALIGNMENT) % ALIGNMENT
+            if padding > 0:
+                self._write_file.write(b'\0' * padding)
+                offset += padding
+            data = tensor.reshape(-1).view(torch.uint8).numpy().tobytes()
+            self._write_file.write(data)
+            tensors[name] = {
+                'dtype': str(tensor.dtype).replace('torch.', ''),
+                'shape': list(tensor.shape),
+                'offset': offset,
+                'nbytes': len(data),
+            }
+        # data has to be on disk before the index points at it
+        self._write_file.flush()
+
+        entry = OrderedDict([
+            ('key', key),
+            ('shard', self._write_shard),
+            ('tensors', tensors),
+        ])
+        if metadata is not None:
+            entry['metadata'] = metadata
+        line = (json.dumps(entry) + '\n').encode('utf-8')
+        # single append write so lines from concurrent writers do not interleave
+        fd = os.open(self.index_path, os.O_CREAT | os.O_WRONLY | os.O_APPEND, 0o644)
+        try:
+            os.write(fd, line)
+        finally:
+            os.close(fd)
+        self.index[key] = entry
+
+    def close_writer(self):
+        if self._write_file is not None:
+            self._write_file.close()
+            self._write_file = None
+            self._write_shard = None
+
+    def close(self):
+        self.close_writer()
+        # maps are dropped rather than closed, tensors read from them may still be alive
+        self._mmaps = {}
+
+
+_open_stores: Dict[tuple, ShardedTensorStore] = {}
+
+
+def get_sharded_store(root: str) -> ShardedTensorStore:
+    # stores hold open file handles and maps, so they are kept per process instead of on
+    # file items, which get deep copied and sent to dataloader workers
+    store_key = (os.getpid(), os.path.abspath(root))
+    if store_key not in _open_stores:
+        _open_stores[store_key] = ShardedTensorStore(root)
+    return _open_stores[store_key]
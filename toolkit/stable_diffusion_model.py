@@ -91,7 +91,7 @@ DO_NOT_TRAIN_WEIGHTS = [
     "refiner_unet_time_embedding.linear_2.weight",
 ]
 
-DeviceStatePreset = Literal['cache_latents', 'generate']
+DeviceStatePreset = Literal['cache_latents', 'cache_clip', 'cache_text_embeddings', 'generate']
 
 
 class BlankNetwork:
@@ -912,6 +912,7 @@ class StableDiffusion:
             image_configs: List[GenerateImageConfig],
             sampler=None,
             pipeline: Union[None, StableDiffusionPipeline, StableDiffusionXLPipeline] = None,
+            max_batch_size: int = 1,
     ):
         merge_multiplier = 1.0
         flush()
@@ -1125,7 +1126,17 @@ class StableDiffusion:
                 if self.network is not None:
                     assert self.network.is_active
 
-                for i in tqdm(range(len(image_configs)), desc=f"Generating Images", leave=False):
+                batches = self.get_generate_image_batches(image_configs, sampler, max_batch_size)
+                for batch_indexes in tqdm(batches, desc=f"Generating Images", leave=False):
+                    if len(batch_indexes) > 1:
+                        self._generate_image_batch(
+                            pipeline,
+                            [image_configs[i] for i in batch_indexes],
+                            batch_indexes,
+                            sampler=sampler,
+                        )
+                        continue
+                    i = batch_indexes[0]
                     gen_config = image_configs[i]
 
                     extra = {}
@@ -1264,140 +1275,15 @@ class StableDiffusion:
                     conditional_embeds = conditional_embeds.to(self.device_torch, dtype=self.unet.dtype)
                     unconditional_embeds = unconditional_embeds.to(self.device_torch, dtype=self.unet.dtype)
 
-                    if self.is_xl:
-                        # fix guidance rescale for sdxl
-                        # was trained on 0.7 (I believe)
-
-                        grs = gen_config.guidance_rescale
-                        # if grs is None or grs < 0.00001:
-                        #     grs = 0.7
-                        # grs = 0.0
-
-                        if sampler.startswith("sample_"):
-                            extra['use_karras_sigmas'] = True
-                            extra = {
-                                **extra,
-                                **gen_config.extra_kwargs,
-                            }
-
-                        img = pipeline(
-                            # prompt=gen_config.prompt,
-                            # prompt_2=gen_config.prompt_2,
-                            prompt_embeds=conditional_embeds.text_embeds,
-                            pooled_prompt_embeds=conditional_embeds.pooled_embeds,
-                            negative_prompt_embeds=unconditional_embeds.text_embeds,
-                            negative_pooled_prompt_embeds=unconditional_embeds.pooled_embeds,
-                            # negative_prompt=gen_config.negative_prompt,
-                            # negative_prompt_2=gen_config.negative_prompt_2,
-                            height=gen_config.height,
-                            width=gen_config.width,
-                            num_inference_steps=gen_config.num_inference_steps,
-                            guidance_scale=gen_config.guidance_scale,
-                            guidance_rescale=grs,
-                            latents=gen_config.latents,
-                            generator=generator,
-                            **extra
-                        ).images[0]
-                    elif self.is_v3:
-                        img = pipeline(
-                            prompt_embeds=conditional_embeds.text_embeds,
-                            pooled_prompt_embeds=conditional_embeds.pooled_embeds,
-                            negative_prompt_embeds=unconditional_embeds.text_embeds,
-                            negative_pooled_prompt_embeds=unconditional_embeds.pooled_embeds,
-                            height=gen_config.height,
-                            width=gen_config.width,
-                            num_inference_steps=gen_config.num_inference_steps,
-                            guidance_scale=gen_config.guidance_scale,
-                            latents=gen_config.latents,
-                            generator=generator,
-                            **extra
-                        ).images[0]
-                    elif self.is_flux:
-                        if self.model_config.use_flux_cfg:
-                            img = pipeline(
-                                prompt_embeds=conditional_embeds.text_embeds,
-                                pooled_prompt_embeds=conditional_embeds.pooled_embeds,
-                                negative_prompt_embeds=unconditional_embeds.text_embeds,
-                                negative_pooled_prompt_embeds=unconditional_embeds.pooled_embeds,
-                                height=gen_config.height,
-                                width=gen_config.width,
-                                num_inference_steps=gen_config.num_inference_steps,
-                                guidance_scale=gen_config.guidance_scale,
-                                latents=gen_config.latents,
-                                generator=generator,
-                                **extra
-                            ).images[0]
-                        else:
-                            img = pipeline(
-                                prompt_embeds=conditional_embeds.text_embeds,
-                                pooled_prompt_embeds=conditional_embeds.pooled_embeds,
-                                # negative_prompt_embeds=unconditional_embeds.text_embeds,
-                                # negative_pooled_prompt_embeds=unconditional_embeds.pooled_embeds,
-                                height=gen_config.height,
-                                width=gen_config.width,
-                                num_inference_steps=gen_config.num_inference_steps,
-                                guidance_scale=gen_config.guidance_scale,
-                                latents=gen_config.latents,
-                                generator=generator,
-                                **extra
-                            ).images[0]
-                    elif self.is_pixart:
-                        # needs attention masks for some reason
-                        img = pipeline(
-                            prompt=None,
-                            prompt_embeds=conditional_embeds.text_embeds.to(self.device_torch, dtype=self.unet.dtype),
-                            prompt_attention_mask=conditional_embeds.attention_mask.to(self.device_torch,
-                                                                                       dtype=self.unet.dtype),
-                            negative_prompt_embeds=unconditional_embeds.text_embeds.to(self.device_torch,
-                                                                                       dtype=self.unet.dtype),
-                            negative_prompt_attention_mask=unconditional_embeds.attention_mask.to(self.device_torch,
-                                                                                                  dtype=self.unet.dtype),
-                            negative_prompt=None,
-                            # negative_prompt=gen_config.negative_prompt,
-                            height=gen_config.height,
-                            width=gen_config.width,
-                            num_inference_steps=gen_config.num_inference_steps,
-                            guidance_scale=gen_config.guidance_scale,
-                            latents=gen_config.latents,
-                            generator=generator,
-                            **extra
-                        ).images[0]
-                    elif self.is_auraflow:
-                        pipeline: AuraFlowPipeline = pipeline
-
-                        img = pipeline(
-                            prompt=None,
-                            prompt_embeds=conditional_embeds.text_embeds.to(self.device_torch, dtype=self.unet.dtype),
-                            prompt_attention_mask=conditional_embeds.attention_mask.to(self.device_torch,
-                                                                                       dtype=self.unet.dtype),
-                            negative_prompt_embeds=unconditional_embeds.text_embeds.to(self.device_torch,
-                                                                                       dtype=self.unet.dtype),
-                            negative_prompt_attention_mask=unconditional_embeds.attention_mask.to(self.device_torch,
-                                                                                                  dtype=self.unet.dtype),
-                            negative_prompt=None,
-                            # negative_prompt=gen_config.negative_prompt,
-                            height=gen_config.height,
-                            width=gen_config.width,
-                            num_inference_steps=gen_config.num_inference_steps,
-                            guidance_scale=gen_config.guidance_scale,
-                            latents=gen_config.latents,
-                            generator=generator,
-                            **extra
-                        ).images[0]
-                    else:
-                        img = pipeline(
-                            # prompt=gen_config.prompt,
-                            prompt_embeds=conditional_embeds.text_embeds,
-                            negative_prompt_embeds=unconditional_embeds.text_embeds,
-                            # negative_prompt=gen_config.negative_prompt,
-                            height=gen_config.height,
-                            width=gen_config.width,
-                            num_inference_steps=gen_config.num_inference_steps,
-                            guidance_scale=gen_config.guidance_scale,
-                            latents=gen_config.latents,
-                            generator=generator,
-                            **extra
-                        ).images[0]
+                    img = self._call_generate_pipeline(
+                        pipeline,
+                        conditional_embeds,
+                        unconditional_embeds,
+                        gen_config,
+                        generator,
+                        extra,
+                        sampler=sampler,
+                    )[0]
 
                     if self.refiner_unet is not None and gen_config.refiner_start_at < 1.0:
                         # slide off just the last 1280 on the last dim as refiner does not use first text encoder
@@ -1418,7 +1304,7 @@ class StableDiffusion:
                             negative_pooled_prompt_embeds=unconditional_embeds.pooled_embeds,
                             num_inference_steps=gen_config.num_inference_steps,
                             guidance_scale=gen_config.guidance_scale,
-                            guidance_rescale=grs,
+                            guidance_rescale=gen_config.guidance_rescale,
                             denoising_start=gen_config.refiner_start_at,
                             denoising_end=gen_config.num_inference_steps,
                             image=img.unsqueeze(0),
@@ -1471,6 +1357,268 @@ class StableDiffusion:
 
         flush()
 
+    def can_batch_generate_image(self, gen_config: GenerateImageConfig, sampler=None) -> bool:
+        # adapters condition on one image at a time, and the refiner and k-diffusion paths take a single image
+        if self.adapter is not None:
+            return False
+        if self.refiner_unet is not None and gen_config.refiner_start_at < 1.0:
+            return False
+        if sampler is not None and sampler.startswith("sample_"):
+            return False
+        return gen_config.latents is None
+
+    def get_generate_image_batches(
+            self,
+            image_configs: List[GenerateImageConfig],
+            sampler=None,
+            max_batch_size: int = 1,
+    ) -> List[List[int]]:
+        """
+        Groups image config indexes into batches that can share a pipeline call. Configs only share a batch when
+        the resolution, sampler settings and network multiplier match. Batches are ordered by their first config.
+        """
+        batches = []
+        open_batches = {}
+        for i, gen_config in enumerate(image_configs):
+            if max_batch_size <= 1 or not self.can_batch_generate_image(gen_config, sampler):
+                batches.append([i])
+                continue
+            key = (
+                gen_config.width,
+                gen_config.height,
+                gen_config.num_inference_steps,
+                gen_config.guidance_scale,
+                gen_config.guidance_rescale,
+                gen_config.network_multiplier,
+            )
+            if key not in open_batches or len(open_batches[key]) >= max_batch_size:
+                open_batches[key] = []
+                batches.append(open_batches[key])
+            open_batches[key].append(i)
+        return batches
+
+    def _generate_image_batch(
+            self,
+            pipeline,
+            gen_configs: List[GenerateImageConfig],
+            indexes: List[int],
+            sampler=None,
+    ):
+        if self.network is not None:
+            self.network.multiplier = gen_configs[0].network_multiplier
+        torch.manual_seed(gen_configs[0].seed)
+        torch.cuda.manual_seed(gen_configs[0].seed)
+        # a generator per image gives the same starting noise as generating them one at a time
+        generator = [torch.Generator().manual_seed(gen_config.seed) for gen_config in gen_configs]
+
+        # every positive prompt in one text encoder call. A missing prompt_2 falls back to the prompt,
+        # same as encoding it on its own
+        prompt_2 = None
+        if any([gen_config.prompt_2 is not None for gen_config in gen_configs]):
+            prompt_2 = [
+                gen_config.prompt_2 if gen_config.prompt_2 is not None else gen_config.prompt
+                for gen_config in gen_configs
+            ]
+        batch_conditional_embeds = self.encode_prompt(
+            [gen_config.prompt for gen_config in gen_configs], prompt_2, force_all=True
+        )
+
+        # the negative prompt is usually the same for every image, only encode it once
+        unconditional_cache = {}
+        conditional_embeds_list = []
+        unconditional_embeds_list = []
+        for idx, gen_config in enumerate(gen_configs):
+            conditional_embeds = PromptEmbeds([
+                batch_conditional_embeds.text_embeds[idx:idx + 1],
+                batch_conditional_embeds.pooled_embeds[idx:idx + 1]
+                if batch_conditional_embeds.pooled_embeds is not None else None,
+            ])
+            if batch_conditional_embeds.attention_mask is not None:
+                conditional_embeds.attention_mask = batch_conditional_embeds.attention_mask[idx:idx + 1]
+            unconditional_key = (gen_config.negative_prompt, gen_config.negative_prompt_2)
+            if unconditional_key not in unconditional_cache:
+                unconditional_cache[unconditional_key] = self.encode_prompt(
+                    gen_config.negative_prompt, gen_config.negative_prompt_2, force_all=True
+                )
+            unconditional_embeds = unconditional_cache[unconditional_key].clone()
+            gen_config.post_process_embeddings(
+                conditional_embeds,
+                unconditional_embeds,
+            )
+            conditional_embeds_list.append(conditional_embeds)
+            unconditional_embeds_list.append(unconditional_embeds)
+        conditional_embeds = concat_prompt_embeds(conditional_embeds_list)
+        unconditional_embeds = concat_prompt_embeds(unconditional_embeds_list)
+
+        if self.decorator is not None:
+            # apply the decorator to the embeddings
+            conditional_embeds.text_embeds = self.decorator(conditional_embeds.text_embeds)
+            unconditional_embeds.text_embeds = self.decorator(unconditional_embeds.text_embeds, is_unconditional=True)
+
+        conditional_embeds = conditional_embeds.to(self.device_torch, dtype=self.unet.dtype)
+        unconditional_embeds = unconditional_embeds.to(self.device_torch, dtype=self.unet.dtype)
+
+        images = self._call_generate_pipeline(
+            pipeline,
+            conditional_embeds,
+            unconditional_embeds,
+            gen_configs[0],
+            generator,
+            {},
+            sampler=sampler,
+        )
+        for img, gen_config, i in zip(images, gen_configs, indexes):
+            gen_config.save_image(img, i)
+            gen_config.log_image(img, i)
+        flush()
+
+    def _call_generate_pipeline(
+            self,
+            pipeline,
+            conditional_embeds: PromptEmbeds,
+            unconditional_embeds: PromptEmbeds,
+            gen_config: GenerateImageConfig,
+            generator,
+            extra: dict,
+            sampler=None,
+    ) -> list:
+        # embeds can hold a batch of prompts, gen_config supplies the settings they share
+        if self.is_xl:
+            # fix guidance rescale for sdxl
+            # was trained on 0.7 (I believe)
+
+            grs = gen_config.guidance_rescale
+            # if grs is None or grs < 0.00001:
+            #     grs = 0.7
+            # grs = 0.0
+
+            if sampler.startswith("sample_"):
+                extra['use_karras_sigmas'] = True
+                extra = {
+                    **extra,
+                    **gen_config.extra_kwargs,
+                }
+
+            images = pipeline(
+                # prompt=gen_config.prompt,
+                # prompt_2=gen_config.prompt_2,
+                prompt_embeds=conditional_embeds.text_embeds,
+                pooled_prompt_embeds=conditional_embeds.pooled_embeds,
+                negative_prompt_embeds=unconditional_embeds.text_embeds,
+                negative_pooled_prompt_embeds=unconditional_embeds.pooled_embeds,
+                # negative_prompt=gen_config.negative_prompt,
+                # negative_prompt_2=gen_config.negative_prompt_2,
+                height=gen_config.height,
+                width=gen_config.width,
+                num_inference_steps=gen_config.num_inference_steps,
+                guidance_scale=gen_config.guidance_scale,
+                guidance_rescale=grs,
+                latents=gen_config.latents,
+                generator=generator,
+                **extra
+            ).images
+        elif self.is_v3:
+            images = pipeline(
+                prompt_embeds=conditional_embeds.text_embeds,
+                pooled_prompt_embeds=conditional_embeds.pooled_embeds,
+                negative_prompt_embeds=unconditional_embeds.text_embeds,
+                negative_pooled_prompt_embeds=unconditional_embeds.pooled_embeds,
+                height=gen_config.height,
+                width=gen_config.width,
+                num_inference_steps=gen_config.num_inference_steps,
+                guidance_scale=gen_config.guidance_scale,
+                latents=gen_config.latents,
+                generator=generator,
+                **extra
+            ).images
+        elif self.is_flux:
+            if self.model_config.use_flux_cfg:
+                images = pipeline(
+                    prompt_embeds=conditional_embeds.text_embeds,
+                    pooled_prompt_embeds=conditional_embeds.pooled_embeds,
+                    negative_prompt_embeds=unconditional_embeds.text_embeds,
+                    negative_pooled_prompt_embeds=unconditional_embeds.pooled_embeds,
+                    height=gen_config.height,
+                    width=gen_config.width,
+                    num_inference_steps=gen_config.num_inference_steps,
+                    guidance_scale=gen_config.guidance_scale,
+                    latents=gen_config.latents,
+                    generator=generator,
+                    **extra
+                ).images
+            else:
+                images = pipeline(
+                    prompt_embeds=conditional_embeds.text_embeds,
+                    pooled_prompt_embeds=conditional_embeds.pooled_embeds,
+                    # negative_prompt_embeds=unconditional_embeds.text_embeds,
+                    # negative_pooled_prompt_embeds=unconditional_embeds.pooled_embeds,
+                    height=gen_config.height,
+                    width=gen_config.width,
+                    num_inference_steps=gen_config.num_inference_steps,
+                    guidance_scale=gen_config.guidance_scale,
+                    latents=gen_config.latents,
+                    generator=generator,
+                    **extra
+                ).images
+        elif self.is_pixart:
+            # needs attention masks for some reason
+            images = pipeline(
+                prompt=None,
+                prompt_embeds=conditional_embeds.text_embeds.to(self.device_torch, dtype=self.unet.dtype),
+                prompt_attention_mask=conditional_embeds.attention_mask.to(self.device_torch,
+                                                                           dtype=self.unet.dtype),
+                negative_prompt_embeds=unconditional_embeds.text_embeds.to(self.device_torch,
+                                                                           dtype=self.unet.dtype),
+                negative_prompt_attention_mask=unconditional_embeds.attention_mask.to(self.device_torch,
+                                                                                      dtype=self.unet.dtype),
+                negative_prompt=None,
+                # negative_prompt=gen_config.negative_prompt,
+                height=gen_config.height,
+                width=gen_config.width,
+                num_inference_steps=gen_config.num_inference_steps,
+                guidance_scale=gen_config.guidance_scale,
+                latents=gen_config.latents,
+                generator=generator,
+                **extra
+            ).images
+        elif self.is_auraflow:
+            pipeline: AuraFlowPipeline = pipeline
+
+            images = pipeline(
+                prompt=None,
+                prompt_embeds=conditional_embeds.text_embeds.to(self.device_torch, dtype=self.unet.dtype),
+                prompt_attention_mask=conditional_embeds.attention_mask.to(self.device_torch,
+                                                                           dtype=self.unet.dtype),
+                negative_prompt_embeds=unconditional_embeds.text_embeds.to(self.device_torch,
+                                                                           dtype=self.unet.dtype),
+                negative_prompt_attention_mask=unconditional_embeds.attention_mask.to(self.device_torch,
+                                                                                      dtype=self.unet.dtype),
+                negative_prompt=None,
+                # negative_prompt=gen_config.negative_prompt,
+                height=gen_config.height,
+                width=gen_config.width,
+                num_inference_steps=gen_config.num_inference_steps,
+                guidance_scale=gen_config.guidance_scale,
+                latents=gen_config.latents,
+                generator=generator,
+                **extra
+            ).images
+        else:
+            images = pipeline(
+                # prompt=gen_config.prompt,
+                prompt_embeds=conditional_embeds.text_embeds,
+                negative_prompt_embeds=unconditional_embeds.text_embeds,
+                # negative_prompt=gen_config.negative_prompt,
+                height=gen_config.height,
+                width=gen_config.width,
+                num_inference_steps=gen_config.num_inference_steps,
+                guidance_scale=gen_config.guidance_scale,
+                latents=gen_config.latents,
+                generator=generator,
+                **extra
+            ).images
+        return images
+
     def get_latent_noise(
             self,
             height=None,
@@ -2696,6 +2844,8 @@ class StableDiffusion:
             active_modules = ['vae']
         if device_state_preset in ['cache_clip']:
             active_modules = ['clip']
+        if device_state_preset in ['cache_text_embeddings']:
+            active_modules = ['text_encoder']
         if device_state_preset in ['generate']:
             active_modules = ['vae', 'unet', 'text_encoder', 'adapter', 'refiner_unet']
 
@@ -0,0 +1,180 @@
+import json
+import os
+import time
+from collections import OrderedDict
+from typing import TYPE_CHECKING, Union
+
+if TYPE_CHECKING:
+    from toolkit.config_modules import DatasetConfig
+    from toolkit.logging import EmptyLogger
+
+
+def get_dataset_name(dataset_config: Union['DatasetConfig', None]) -> str:
+    if dataset_config is None:
+        return 'unknown'
+    path = dataset_config.folder_path if dataset_config.folder_path is not None else dataset_config.dataset_path
+    if path is None:
+        return 'unknown'
+    return os.path.basename(os.path.normpath(path))
+
+
+def get_queue_depth(iterator) -> int:
+    """
+    Batches the dataloader has requested from its workers and not handed out yet. 0 means the training loop is
+    waiting on the workers.
+    """
+    depth = 0
+    # DevicePrefetcher holds one batch ahead of the dataloader
+    if hasattr(iterator, 'next_batch') and hasattr(iterator, 'iterator'):
+        if iterator.next_batch is not None:
+            depth += 1
+        iterator = iterator.iterator
+    # only multi process dataloader iterators have workers
+    return depth + getattr(iterator, '_tasks_outstanding', 0)
+
+
+class _WindowStats:
+    def __init__(self):
+        self.batches = 0
+        self.images = 0
+        self.pixels = 0
+        self.data_wait = 0.0
+
+    def add(self, images: int, pixels: int, data_wait: float):
+        self.batches += 1
+        self.images += images
+        self.pixels += pixels
+        self.data_wait += data_wait
+
+    def get_dict(self, window_time: float) -> OrderedDict:
+        return OrderedDict([
+            ('batches', self.batches),
+            ('images', self.images),
+            ('images_per_sec', self.images / window_time if window_time > 0 else 0.0),
+            ('data_wait', self.data_wait),
+            ('data_wait_mean', self.data_wait / self.batches if self.batches > 0 else 0.0),
+        ])
+
+
+class TrainingTelemetry:
+    """
+    Measures training throughput and how long the loop is blocked on the dataloader.
+
+    Batches are fetched through next_batch, which times the wait and reads the worker queue depth. step_start and
+    step_end bracket the training part of each step, so sampling and saving are left out of the rates. Every
+    report_every steps the window is written to the logger under telemetry/ and appended to a JSONL file, with a
+    breakdown by dataset and by bucket resolution.
+
+    data_wait_fraction is the share of step time spent waiting for batches. A high value with a queue depth near
+    0 means the run is input bound, more workers or caching latents will help. Near 0 means it is compute bound.
+    """
+
+    def __init__(
+            self,
+            logger: 'EmptyLogger',
+            jsonl_path: Union[str, None],
+            report_every: int = 100,
+            vae_scale_factor: int = 8,
+    ):
+        self.logger = logger
+        self.jsonl_path = jsonl_path
+        self.report_every = report_every
+        self.vae_scale_factor = vae_scale_factor
+        self.step_start_time = None
+        self.reset()
+
+    def reset(self):
+        self.window_start_time = time.time()
+        self.steps = 0
+        self.step_time = 0.0
+        self.queue_depths = []
+        self.total = _WindowStats()
+        self.datasets = OrderedDict()
+        self.buckets = OrderedDict()
+
+    def step_start(self):
+        self.step_start_time = time.perf_counter()
+
+    def step_end(self):
+        if self.step_start_time is None:
+            return
+        self.step_time += time.perf_counter() - self.step_start_time
+        self.steps += 1
+        self.step_start_time = None
+
+    def next_batch(self, iterator):
+        queue_depth = get_queue_depth(iterator)
+        start = time.perf_counter()
+        batch = next(iterator)
+        self.add_batch(batch, time.perf_counter() - start, queue_depth)
+        return batch
+
+    def add_batch(self, batch, data_wait: float, queue_depth: int):
+        self.queue_depths.append(queue_depth)
+        file_items = getattr(batch, 'file_items', None)
+        if not file_items:
+            self.total.add(0, 0, data_wait)
+            return
+        pixels = sum([x.crop_width * x.crop_height for x in file_items])
+        self.total.add(len(file_items), pixels, data_wait)
+        # batches come from a single bucket, the wait is split by image between datasets
+        dataset_images = OrderedDict()
+        dataset_pixels = OrderedDict()
+        for file_item in file_items:
+            name = get_dataset_name(file_item.dataset_config)
+            dataset_images[name] = dataset_images.get(name, 0) + 1
+            dataset_pixels[name] = dataset_pixels.get(name, 0) + file_item.crop_width * file_item.crop_height
+        for name, images in dataset_images.items():
+            if name not in self.datasets:
+                self.datasets[name] = _WindowStats()
+            self.datasets[name].add(images, dataset_pixels[name], data_wait * images / len(file_items))
+        bucket = f"{file_items[0].crop_width}x{file_items[0].crop_height}"
+        if bucket not in self.buckets:
+            self.buckets[bucket] = _WindowStats()
+        self.buckets[bucket].add(len(file_items), pixels, data_wait)
+
+    def get_report(self, step: int) -> OrderedDict:
+        window_time = self.step_time
+        report = OrderedDict([
+            ('step', step),
+            ('time', time.time()),
+            ('steps', self.steps),
+            ('window_time', time.time() - self.window_start_time),
+            ('step_time', window_time),
+            ('step_time_mean', window_time / self.steps if self.steps > 0 else 0.0),
+        ])
+        report.update(self.total.get_dict(window_time))
+        report['pixels_per_sec'] = self.total.pixels / window_time if window_time > 0 else 0.0
+        report['latent_pixels_per_sec'] = report['pixels_per_sec'] / (self.vae_scale_factor ** 2)
+        report['data_wait_fraction'] = self.total.data_wait / window_time if window_time > 0 else 0.0
+        report['compute_time'] = window_time - self.total.data_wait
+        report['queue_depth_mean'] = sum(self.queue_depths) / len(self.queue_depths) if self.queue_depths else 0.0
+        report['queue_depth_min'] = min(self.queue_depths) if self.queue_depths else 0
+        report['datasets'] = OrderedDict([(k, v.get_dict(window_time)) for k, v in self.datasets.items()])
+        report['buckets'] = OrderedDict([(k, v.get_dict(window_time)) for k, v in self.buckets.items()])
+        return report
+
+    def log_report(self, report: OrderedDict):
+        log_dict = OrderedDict()
+        for key in ['images_per_sec', 'pixels_per_sec', 'latent_pixels_per_sec', 'step_time_mean',
+                    'data_wait_mean', 'data_wait_fraction', 'queue_depth_mean', 'queue_depth_min']:
+            log_dict[f"telemetry/{key}"] = report[key]
+        for group in ['datasets', 'buckets']:
+            for name, stats in report[group].items():
+                log_dict[f"telemetry/{group}/{name}/images_per_sec"] = stats['images_per_sec']
+                log_dict[f"telemetry/{group}/{name}/data_wait_mean"] = stats['data_wait_mean']
+        self.logger.log(log_dict)
+
+        if self.jsonl_path is not None:
+            if os.path.dirname(self.jsonl_path) != '':
+                os.makedirs(os.path.dirname(self.jsonl_path), exist_ok=True)
+            with open(self.jsonl_path, 'a') as f:
+                f.write(json.dumps(report) + '\n')
+
+    def maybe_report(self, step: int) -> Union[OrderedDict, None]:
+        if not self.report_every or self.steps == 0 or step % self.report_every != 0:
+            return None
+        report = self.get_report(step)
+        self.log_report(report)
+        self.reset()
+        return report
@@ -9,23 +9,31 @@ class Timer:
         self.timers = OrderedDict()
         self.active_timers = {}
         self.current_timer = None  # Used for the context manager functionality
+        # StepProfiler that also records every span while its window is active
+        self.profiler = None
 
     def start(self, timer_name):
         if timer_name not in self.timers:
             self.timers[timer_name] = deque(maxlen=self.max_buffer)
-        self.active_timers[timer_name] = time.time()
+        if self.profiler is not None:
+            self.profiler.span_start(timer_name)
+        self.active_timers[timer_name] = time.perf_counter()
 
     def cancel(self, timer_name):
         """Cancel an active timer."""
         if timer_name in self.active_timers:
             del self.active_timers[timer_name]
+        if self.profiler is not None:
+            self.profiler.span_cancel(timer_name)
 
     def stop(self, timer_name):
         if timer_name not in self.active_timers:
             raise ValueError(f"Timer '{timer_name}' was not started!")
 
-        elapsed_time = time.time() - self.active_timers[timer_name]
+        elapsed_time = time.perf_counter() - self.active_timers[timer_name]
         self.timers[timer_name].append(elapsed_time)
+        if self.profiler is not None:
+            self.profiler.span_end(timer_name)
 
         # Clean up active timers
         del self.active_timers[timer_name]
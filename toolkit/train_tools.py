@@ -188,6 +188,94 @@ def addnet_hash_legacy(b):
     return m.hexdigest()[0:8]
 
 
+# safetensors names for torch dtypes
+SAFETENSORS_DTYPES = {
+    torch.bool: 'BOOL',
+    torch.uint8: 'U8',
+    torch.int8: 'I8',
+    torch.int16: 'I16',
+    torch.float16: 'F16',
+    torch.bfloat16: 'BF16',
+    torch.int32: 'I32',
+    torch.float32: 'F32',
+    torch.float64: 'F64',
+    torch.int64: 'I64',
+}
+for _name, _st_name in [
+    ('float8_e5m2', 'F8_E5M2'), ('float8_e4m3fn', 'F8_E4M3'), ('uint16', 'U16'), ('uint32', 'U32'), ('uint64', 'U64')
+]:
+    # only in newer torch versions
+    if hasattr(torch, _name):
+        SAFETENSORS_DTYPES[getattr(torch, _name)] = _st_name
+# safetensors writes tensors sorted by this order, last first, then by name
+SAFETENSORS_DTYPE_ORDER = [
+    'BOOL', 'F4', 'F6_E2M3', 'F6_E3M2', 'U8', 'I8', 'F8_E5M2', 'F8_E4M3', 'F8_E8M0', 'I16', 'U16', 'F16', 'BF16',
+    'I32', 'U32', 'F32', 'C64', 'F64', 'I64', 'U64'
+]
+
+
+def get_safetensors_header(state_dict, metadata=None):
+    """
+    Returns the tensor names in the order safetensors.torch.save writes them and the exact bytes it writes
+    before the tensor data (header length and json header padded to 8 bytes). safetensors writes metadata keys
+    in no fixed order, with several keys only the order of those can differ.
+    """
+    names = sorted(
+        state_dict.keys(),
+        key=lambda k: (-SAFETENSORS_DTYPE_ORDER.index(SAFETENSORS_DTYPES[state_dict[k].dtype]), k)
+    )
+    header = {}
+    if metadata is not None:
+        header['__metadata__'] = metadata
+    offset = 0
+    for name in names:
+        tensor = state_dict[name]
+        nbytes = tensor.numel() * tensor.element_size()
+        header[name] = {
+            'dtype': SAFETENSORS_DTYPES[tensor.dtype],
+            'shape': list(tensor.shape),
+            'data_offsets': [offset, offset + nbytes],
+        }
+        offset += nbytes
+    header_bytes = json.dumps(header, separators=(',', ':'), ensure_ascii=False).encode('utf-8')
+    header_bytes += b' ' * ((8 - len(header_bytes) % 8) % 8)
+    return names, len(header_bytes).to_bytes(8, 'little') + header_bytes
+
+
+def addnet_hashes_for_state_dict(state_dict, metadata=None):
+    """
+    Same (addnet_hash_safetensors, addnet_hash_legacy) as hashing safetensors.torch.save(state_dict, metadata),
+    without serializing the whole thing. Tensors are hashed one at a time as the bytes they would be written as,
+    so memory stays at one tensor.
+    """
+    names, prefix = get_safetensors_header(state_dict, metadata)
+    hash_sha256 = hashlib.sha256()
+    # the legacy hash covers 64k bytes of the file starting at 1mb, usually inside the tensor data
+    legacy_start = 0x100000
+    legacy_end = legacy_start + 0x10000
+    legacy_bytes = bytearray()
+
+    def add_legacy_bytes(data, position):
+        start = max(legacy_start, position)
+        end = min(legacy_end, position + len(data))
+        if start < end:
+            legacy_bytes.extend(data[start - position:end - position])
+
+    add_legacy_bytes(prefix, 0)
+    position = len(prefix)
+    for name in names:
+        tensor = state_dict[name].detach()
+        if tensor.numel() == 0:
+            continue
+        data = memoryview(tensor.reshape(-1).view(torch.uint8).cpu().numpy())
+        hash_sha256.update(data)
+        add_legacy_bytes(data, position)
+        position += len(data)
+
+    legacy_hash = hashlib.sha256(bytes(legacy_bytes)).hexdigest()[0:8]
+    return hash_sha256.hexdigest(), legacy_hash
+
+
 if TYPE_CHECKING:
     from transformers import CLIPTextModel, CLIPTokenizer, CLIPTextModelWithProjection
 